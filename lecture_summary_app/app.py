@@ -8,9 +8,7 @@ import streamlit.components.v1 as components
 import glob
 import shutil
 import stat
-import threading
 import gc
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 遅延インポート（高速化：必要な時だけインポート）
 # from utils import file_loader, web_loader, summarizer, qa_agent, recommender
@@ -76,6 +74,51 @@ def highlight_keywords(text, keywords):
             text = text.replace(keyword, f"**{keyword}**")
     return text
 
+def render_page_search_results(keyword, text_data_list):
+    """元資料の全ページからキーワードを検索して出現箇所を表示（LLMは使わない）"""
+    if not keyword or not keyword.strip():
+        return
+    from utils import page_store
+    doc_sources = {item["hash"]: item["source"] for item in text_data_list if item.get("hash")}
+    page_hits = page_store.search(keyword, doc_sources, limit=20)
+    with st.expander(f"📄 元資料での出現箇所: {len(page_hits)}件", expanded=bool(page_hits)):
+        if not page_hits:
+            st.caption("元資料に一致するページはありませんでした")
+        for hit in page_hits:
+            st.markdown(f"- **{hit['source']}** (p.{hit['page']}): {hit['snippet']}")
+
+def use_llm_cache():
+    """このセッションでAI応答キャッシュを使うか（他のセッションの設定には影響しない）"""
+    return not st.session_state.get("bypass_llm_cache", False)
+
+def reset_tutor_for_category(category):
+    """
+    別のカテゴリの資料を読み込んだ場合、AIチューターの会話をリセット
+    （前のカテゴリの質問・回答が別の講義の質問に混ざらないように）
+    """
+    if st.session_state.get("tutor_category") == category:
+        return
+    st.session_state.tutor_memory = None
+    st.session_state.messages = []
+    st.session_state.tutor_category = category
+
+def render_material_lookup(query, kind, api_key, ai_provider):
+    """用語・数式の出現箇所を索引からすぐに表示し、その箇所だけを使ってAIが説明"""
+    from utils import qa_agent
+    matches = qa_agent.lookup(query, st.session_state.full_context, kind)
+    with st.expander(f"📄 資料内の出現箇所: {len(matches)}件", expanded=bool(matches)):
+        if not matches:
+            st.caption("資料内に一致する箇所はありませんでした")
+        for match in matches:
+            page = f" (p.{match['page']})" if match.get("page") else ""
+            st.markdown(f"- **{match['source']}**{page}: {match['highlighted']}")
+
+    with st.spinner(f"「{query}」の説明を生成中..."):
+        explanation = qa_agent.explain_matches(query, matches, api_key, ai_provider, kind, use_cache=use_llm_cache())
+    icon = "🔢" if kind == "formula" else "📚"
+    st.success(f"{icon} 「{query}」の説明:")
+    st.markdown(explanation)
+
 @st.cache_data
 def export_to_markdown(summary, integration, sources):
     """要約を Markdown 形式でエクスポート"""
@@ -166,11 +209,6 @@ def main():
                     st.session_state.user_api_key = stored_data.get('user_api_key', '')
                     st.session_state.ai_provider = stored_data.get('ai_provider', 'gemini')
                     
-                    # 環境変数にも設定
-                    if st.session_state.ai_provider == "gemini":
-                        os.environ["GOOGLE_API_KEY"] = st.session_state.user_api_key
-                    else:
-                        os.environ["OPENAI_API_KEY"] = st.session_state.user_api_key
         except:
             pass  # localStorageの読み込み失敗は無視
         
@@ -185,6 +223,8 @@ def main():
         st.session_state.full_context = None
         st.session_state.recommendations = []
         st.session_state.messages = []
+        st.session_state.tutor_memory = None  # AIチューターの会話履歴（最初の質問時に作成）
+        st.session_state.tutor_category = None  # 会話履歴の対象のカテゴリ（別のカテゴリを読み込むとリセット）
         st.session_state.category = "統合資料まとめ"  # Default category
         st.session_state.history = []  # 履歴機能
         st.session_state.search_keyword = ""  # 検索キーワード
@@ -353,12 +393,6 @@ def main():
                         # localStorageにも保存
                         set_local_storage(user_email, user_api_key, ai_provider_choice, True)
                         
-                        # 環境変数にも設定
-                        if ai_provider_choice == "gemini":
-                            os.environ["GOOGLE_API_KEY"] = user_api_key
-                        else:
-                            os.environ["OPENAI_API_KEY"] = user_api_key
-                        
                         st.success(f"✅ ようこそ **{user_email}** さん！")
                         st.balloons()
                         st.rerun()
@@ -382,11 +416,6 @@ def main():
                 # localStorageもクリア
                 clear_local_storage()
                 
-                # 環境変数もクリア
-                if "GOOGLE_API_KEY" in os.environ:
-                    del os.environ["GOOGLE_API_KEY"]
-                if "OPENAI_API_KEY" in os.environ:
-                    del os.environ["OPENAI_API_KEY"]
                 st.info("✅ ログアウトしました。再度ログインしてください。")
                 st.rerun()
         
@@ -468,12 +497,6 @@ def main():
             api_key = st.session_state.user_api_key
             ai_name = "Google Gemini" if st.session_state.ai_provider == "gemini" else "OpenAI ChatGPT"
             
-            # 環境変数に確実に設定（AI処理で使用）
-            if st.session_state.ai_provider == "gemini":
-                os.environ["GOOGLE_API_KEY"] = api_key
-            else:
-                os.environ["OPENAI_API_KEY"] = api_key
-            
             # APIキーの確認
             masked_key = mask_api_key(api_key)
             st.success(f"✅ **{ai_name}アカウント登録済み**")
@@ -510,7 +533,27 @@ def main():
                 - 各ファイルのサイズを小さくする
                 - 不要なページを削除してからアップロード
                 """)
-        
+
+            with st.expander("🗃️ AI応答キャッシュ", expanded=False):
+                from utils import llm_cache
+                st.caption("同じ資料・同じ質問へのAI応答を保存し、2回目以降は即座に表示します。")
+                # 設定はセッションごと（各処理に use_cache として渡す）
+                st.checkbox(
+                    "キャッシュを使わない（毎回AIに問い合わせる）",
+                    value=not llm_cache.ENABLED,
+                    disabled=not llm_cache.ENABLED,
+                    key="bypass_llm_cache"
+                )
+                cache_stats = llm_cache.get_stats()
+                st.caption(
+                    f"ヒット: {cache_stats['hits']}回 / ミス: {cache_stats['misses']}回"
+                    f"（ヒット率 {cache_stats['hit_rate']:.0%}）"
+                )
+                if st.button("🗑️ キャッシュを削除", use_container_width=True, key="clear_llm_cache"):
+                    llm_cache.clear_cache()
+                    llm_cache.reset_stats()
+                    st.success("✅ キャッシュを削除しました")
+
         st.divider()
 
         # Category with Save/Load/Delete
@@ -521,7 +564,8 @@ def main():
         data_dir = Path("data")
         existing_categories = []
         if data_dir.exists():
-            existing_categories = [d.name for d in data_dir.iterdir() if d.is_dir()]
+            # 先頭が "." のディレクトリ（ブロブストア等）はカテゴリではない
+            existing_categories = [d.name for d in data_dir.iterdir() if d.is_dir() and not d.name.startswith(".")]
         
         # Category selection or creation
         if existing_categories:
@@ -583,6 +627,7 @@ def main():
             deleted_base = Path("data/deleted")
             if deleted_base.exists():
                 current_time = time.time()
+                removed_any = False
                 for folder in deleted_base.iterdir():
                     if folder.is_dir():
                         # フォルダの更新日時をチェック
@@ -591,8 +636,14 @@ def main():
                         if days_old > 30:
                             try:
                                 shutil.rmtree(folder, onerror=lambda func, path, _: (os.chmod(path, stat.S_IWRITE), func(path)))
+                                removed_any = True
                             except:
                                 pass
+                
+                # 完全削除したファイルからしか参照されていないブロブも削除
+                if removed_any:
+                    from utils import file_loader
+                    file_loader.cleanup_orphan_blobs()
         
         cleanup_old_deleted_folders()
         
@@ -679,12 +730,6 @@ def main():
                     ai_name_btn = "Google Gemini" if ai_provider == "gemini" else "ChatGPT"
                     st.error(f"❌ {ai_name_btn}アカウントを登録してください！\n\n上のセクションで、{ai_name_btn}アカウントの接続情報が正しく入力されているか確認してください。")
                     st.session_state.is_processing = False
-                else:
-                    # 環境変数に確実に設定
-                    if ai_provider == "gemini":
-                        os.environ["GOOGLE_API_KEY"] = api_key.strip()
-                    else:
-                        os.environ["OPENAI_API_KEY"] = api_key.strip()
             
             if ai_provider != "extract_only" and not api_key:
                 ai_name_btn = "Google Gemini" if ai_provider == "gemini" else "ChatGPT"
@@ -692,7 +737,7 @@ def main():
                 pass
             else:
                 # 遅延インポート（使用時のみ） - 全モジュール一括インポート
-                from utils import file_loader, web_loader, summarizer, qa_agent, recommender
+                from utils import file_loader, web_loader, summarizer, qa_agent, recommender, extractor, manifest, text_cleaner
                 import glob
                 import shutil
                 
@@ -757,77 +802,56 @@ def main():
                         progress_bar.empty()
                         st.stop()
                     
-                    import glob
-                    saved_files = glob.glob(f"data/{category}/*")
+                    # マニフェストと比較して、新規・変更ファイルだけを読み込み直す
+                    category_dir = f"data/{category}"
+                    file_manifest = manifest.load_manifest(category_dir)
+                    file_changes = manifest.diff_directory(category_dir, file_manifest)
+                    saved_files = file_changes["paths"]
                     
-                    # ファイル数に基づく推定時間を表示
-                    estimated_read_time = len(saved_files) * 1  # 並列処理で高速化（1秒/ファイル）
-                    status_text.text(f"📄 {len(saved_files)}個のファイルを発見... (推定読込時間: 約{estimated_read_time}秒 - 並列処理中)")
+                    # マニフェストに基づく推定時間を表示（PDFは開かない）
+                    estimated_read_time = manifest.estimate_load_seconds(file_changes, file_manifest)
+                    status_text.text(
+                        f"📄 {len(saved_files)}個のファイルを発見（新規 {len(file_changes['new'])} / 変更 {len(file_changes['changed'])} / 変更なし {len(file_changes['unchanged'])}）"
+                        f"... (推定読込時間: 約{estimated_read_time}秒 - 並列処理中)"
+                    )
                     
                     # ファイルを並列で読み込み（高速化）
                     file_data_with_order = []
                     successful_count = 0
                     failed_count = 0
                     
-                    def load_single_file(path_and_num):
-                        """単一ファイルを読み込む関数（並列処理用）"""
-                        path, num = path_and_num
-                        filename = os.path.basename(path)
-                        try:
-                            if path.endswith('.pdf'):
-                                content = file_loader.load_pdf(path)
-                            else:
-                                content = file_loader.load_text(path)
-                            
-                            if not content:
-                                return {"status": "empty", "filename": filename, "error": "内容が空"}
-                            
-                            if "Error" in content[:50]:
-                                return {"status": "error", "filename": filename, "error": content[:100]}
-                            
-                            # 講義番号を抽出
-                            lecture_num = file_loader.extract_lecture_number(filename, content[:500])
-                            return {
-                                "status": "success",
-                                "filename": filename,
-                                "content": content,
-                                "order": lecture_num,
-                                "original_order": num
-                            }
-                        except Exception as e:
-                            return {"status": "error", "filename": filename, "error": str(e)}
-                    
-                    # 並列処理でファイル読み込み（最大4スレッド）
-                    with ThreadPoolExecutor(max_workers=4) as executor:
-                        file_paths_with_nums = [(path, num) for num, path in enumerate(saved_files)]
-                        futures = {executor.submit(load_single_file, path_num): path_num for path_num in file_paths_with_nums}
+                    # 並列処理でファイル読み込み（PDFはコア数ぶんのプロセス、TXTはスレッド）
+                    completed = 0
+                    for result in extractor.iter_load_results(saved_files, manifest.known_entries(file_manifest, file_changes)):
+                        completed += 1
                         
-                        completed = 0
-                        for future in as_completed(futures):
-                            completed += 1
-                            result = future.result()
-                            
-                            elapsed_so_far = int(time.time() - overall_start_time)
-                            status_text.text(f"📖 読み込み中 ({completed}/{len(saved_files)}) | 経過: {elapsed_so_far}秒")
-                            
-                            if result["status"] == "success":
-                                file_data_with_order.append({
-                                    "content": result["content"],
-                                    "source": result["filename"],
-                                    "order": result["order"],
-                                    "original_order": result["original_order"]
-                                })
-                                successful_count += 1
-                                lecture_num = result["order"]
-                                st.success(f"✅ 成功: {result['filename']} (第{lecture_num}回)" if lecture_num != 999 else f"✅ 成功: {result['filename']}")
-                            elif result["status"] == "empty":
-                                st.warning(f"⚠️ ファイルが空です: {result['filename']}")
-                                upload_errors.append(f"{result['filename']}: {result['error']}")
-                                failed_count += 1
-                            else:
-                                st.error(f"❌ 読み込みエラー: {result['filename']} - {result['error']}")
-                                upload_errors.append(f"{result['filename']}: {result['error']}")
-                                failed_count += 1
+                        elapsed_so_far = int(time.time() - overall_start_time)
+                        status_text.text(f"📖 読み込み中 ({completed}/{len(saved_files)}) | 経過: {elapsed_so_far}秒")
+                        
+                        if result["status"] == "success":
+                            file_data_with_order.append({
+                                "content": result["content"],
+                                "source": result["filename"],
+                                "order": result["order"],
+                                "original_order": result["original_order"],
+                                "hash": result["hash"]
+                            })
+                            successful_count += 1
+                            manifest.update_entry(file_manifest, os.path.join(category_dir, result["filename"]), result)
+                            lecture_num = result["order"]
+                            st.success(f"✅ 成功: {result['filename']} (第{lecture_num}回)" if lecture_num != 999 else f"✅ 成功: {result['filename']}")
+                        elif result["status"] == "empty":
+                            st.warning(f"⚠️ ファイルが空です: {result['filename']}")
+                            upload_errors.append(f"{result['filename']}: {result['error']}")
+                            failed_count += 1
+                        else:
+                            st.error(f"❌ 読み込みエラー: {result['filename']} - {result['error']}")
+                            upload_errors.append(f"{result['filename']}: {result['error']}")
+                            failed_count += 1
+                    
+                    # 削除されたファイルを除いてマニフェストを保存
+                    manifest.prune_entries(file_manifest, file_changes["removed"])
+                    manifest.save_manifest(category_dir, file_manifest)
                     
                     # 読み込み結果のサマリー
                     st.info(f"📊 読み込み完了: 成功 {successful_count}個 / 失敗 {failed_count}個 / 合計 {len(saved_files)}個")
@@ -837,7 +861,7 @@ def main():
                     
                     # text_dataに追加（ソート済み）
                     for item in file_data_with_order:
-                        text_data.append({"content": item["content"], "source": item["source"]})
+                        text_data.append({"content": item["content"], "source": item["source"], "hash": item["hash"]})
                     
                     # ソート結果をログ出力（デバッグ用）
                     if file_data_with_order:
@@ -898,6 +922,11 @@ def main():
                         status_text.empty()
                     else:
                         st.session_state.text_data_list = text_data
+                        reset_tutor_for_category(category)
+                        
+                        # 定型文（ヘッダー・フッター・ページ番号）の除去は読み込み時に1回だけ行い、
+                        # 要約・検索インデックスには整形済みの資料を渡す（抽出テキストのタブは元のまま表示）
+                        cleaned_data, _ = text_cleaner.clean_documents(text_data)
                         
                         # 2. Summarize (テキスト抽出モードはスキップ)
                         if ai_provider == "extract_only":
@@ -909,103 +938,106 @@ def main():
                         else:
                             ai_name_processing = "Google Gemini" if ai_provider == "gemini" else "ChatGPT"
                             
-                            # 推定処理時間の計算（文字数に基づく） - 1回のみ計算
-                            total_chars = sum(len(item['content']) for item in text_data)
-                            estimated_seconds = max(30, int(total_chars / 10000 * 30))
+                            # 推定処理時間の計算（トークン数と分割方法に基づく） - 1回のみ計算
+                            summary_plan = summarizer.plan_summary(
+                                cleaned_data, ai_provider=ai_provider, output_language=st.session_state.language,
+                                use_cache=use_llm_cache()
+                            )
+                            estimated_seconds = max(10, summary_plan["estimated_seconds"])
                             elapsed_so_far = int(time.time() - overall_start_time)
+                            print(f"📐 {summary_plan['description']}")
                             
                             status_text.text(f"🔗 {ai_name_processing}アカウントに接続中... (推定AI処理時間: 約{estimated_seconds}秒 | 経過: {elapsed_so_far}秒)")
+                            st.caption(
+                                f"📐 {summary_plan['description']}"
+                                + (f"（定型文除去で約{summary_plan['tokens_saved']:,}トークン削減）" if summary_plan['tokens_saved'] else "")
+                            )
                             progress_bar.progress(45)
                             
                             start_time = time.time()
-                            result_container = {"result": None, "error": None, "done": False}
                             
-                            # スレッドで使用する変数をローカルに保存（session_stateはスレッドからアクセス不可）
                             output_language = st.session_state.language
                             current_ai_provider = st.session_state.ai_provider
                             
-                            # 別スレッドで要約生成
-                            def generate_in_background():
-                                try:
-                                    summary_result = summarizer.generate_summary(
-                                        text_data, 
-                                        api_key, 
-                                        output_language=output_language,
-                                        ai_provider=current_ai_provider
-                                    )
-                                    result_container["result"] = summary_result
-                                except Exception as e:
-                                    result_container["error"] = e
-                                finally:
-                                    result_container["done"] = True
-                            
-                            # バックグラウンドスレッド開始
-                            thread = threading.Thread(target=generate_in_background)
-                            thread.start()
-                            
-                            # 動的な時間推定（10秒ごとに更新、1分ごとに再計算）
+                            # 生成中の要約・まとめを届いた順に表示（全文の完成を待たない）
                             progress_bar.progress(50)
-                            last_recalc_time = start_time
-                            recalc_interval = 60  # 1分ごとに再計算
+                            preview_area = st.empty()
+                            with preview_area.container():
+                                with st.expander("📝 生成中の要約（プレビュー）", expanded=True):
+                                    summary_preview = st.empty()
+                                    integration_preview = st.empty()
                             
-                            while not result_container["done"]:
-                                # キャンセルチェック
-                                if st.session_state.cancel_processing:
-                                    st.session_state.is_processing = False
-                                    status_text.text("⏹️ 処理をキャンセルしました")
-                                    progress_bar.empty()
-                                    # バックグラウンドスレッドは継続するが、結果は無視
-                                    st.stop()
-                                
-                                elapsed = int(time.time() - start_time)
-                                
-                                # 1分ごとに推定時間を再計算（実測データから）
-                                if elapsed - (last_recalc_time - start_time) >= recalc_interval and elapsed > 30:
-                                    # 現在の進捗から残り時間を再推定
-                                    # 処理は「要約生成」と「まとめ生成」の2段階
-                                    # 前半60%が経過していると仮定して、残り40%の時間を推定
-                                    if elapsed > 0:
-                                        # 実測ベースの推定: 現在までの速度から全体時間を予測
-                                        estimated_total = int(elapsed * 1.8)  # 現在の位置から全体を推定
-                                        estimated_seconds = max(estimated_seconds, estimated_total)
-                                        last_recalc_time = time.time()
-                                
-                                remaining = max(0, estimated_seconds - elapsed)
-                                
-                                # 進捗率の計算（50%～90%の範囲で更新）
-                                if estimated_seconds > 0:
-                                    progress_percent = min(90, 50 + int((elapsed / estimated_seconds) * 40))
-                                else:
-                                    progress_percent = 70
-                                
-                                # 詳細な状態表示
-                                status_text.text(f"🤖 {ai_name_processing}で処理中... (経過: {elapsed}秒 / 推定残り: 約{remaining}秒) - 再計算: {int(time.time() - last_recalc_time)}秒前")
-                                progress_bar.progress(progress_percent)
-                                
-                                # 10秒待機（または完了を確認）
-                                for _ in range(100):  # 0.1秒×100回 = 10秒
-                                    if result_container["done"] or st.session_state.cancel_processing:
-                                        break
-                                    time.sleep(0.1)
-                            
-                            # スレッドの終了を待つ
-                            thread.join()
+                            streamed = {"summary": "", "integration": ""}
+                            summary_result = None
+                            stage_message = f"🤖 {ai_name_processing}で処理中..."
+                            last_render_time = 0.0
+                            cancelled = False
                             
-                            # 結果の処理
                             try:
-                                if result_container["error"]:
-                                    raise result_container["error"]
+                                for event in summarizer.generate_summary_stream(
+                                    cleaned_data, 
+                                    api_key, 
+                                    output_language=output_language,
+                                    ai_provider=current_ai_provider,
+                                    use_cache=use_llm_cache()
+                                ):
+                                    # キャンセルチェック
+                                    if st.session_state.cancel_processing:
+                                        cancelled = True
+                                        break
+                                    
+                                    if event["stage"] == "done":
+                                        summary_result = event
+                                    elif event["stage"] == "status":
+                                        if event["text"]:
+                                            stage_message = event["text"]
+                                    else:
+                                        streamed[event["stage"]] += event["text"]
+                                    
+                                    # 描画は0.2秒ごとに間引く（断片ごとに描画すると遅くなるため）
+                                    now = time.time()
+                                    if now - last_render_time < 0.2:
+                                        continue
+                                    last_render_time = now
+                                    
+                                    elapsed = int(now - start_time)
+                                    # 推定時間を超えた場合は実測から推定し直す
+                                    if elapsed > estimated_seconds:
+                                        estimated_seconds = int(elapsed * 1.2)
+                                    remaining = max(0, estimated_seconds - elapsed)
+                                    
+                                    # 進捗率の計算（50%～90%の範囲で更新）
+                                    progress_percent = min(90, 50 + int((elapsed / estimated_seconds) * 40))
+                                    status_text.text(f"{stage_message} (経過: {elapsed}秒 / 推定残り: 約{remaining}秒)")
+                                    progress_bar.progress(progress_percent)
+                                    if streamed["summary"]:
+                                        summary_preview.markdown(streamed["summary"] + "▌")
+                                    if streamed["integration"]:
+                                        integration_preview.markdown(streamed["integration"] + "▌")
                                 
-                                st.session_state.summary = result_container["result"].get("summary", "")
-                                st.session_state.integration = result_container["result"].get("integration", "")
-                                elapsed = int(time.time() - start_time)
-                                status_text.text(f"✅ 完了！(処理時間: {elapsed}秒)")
-                                progress_bar.progress(70)
-                                st.session_state.is_processing = False
+                                if not cancelled:
+                                    if summary_result is None:
+                                        raise RuntimeError("要約の生成が完了しませんでした")
+                                    
+                                    st.session_state.summary = summary_result.get("summary", "")
+                                    st.session_state.integration = summary_result.get("integration", "")
+                                    elapsed = int(time.time() - start_time)
+                                    preview_area.empty()
+                                    status_text.text(f"✅ 完了！(処理時間: {elapsed}秒)")
+                                    progress_bar.progress(70)
+                                    st.session_state.is_processing = False
                             except Exception as e:
                                 st.session_state.is_processing = False
                                 st.error(f"❌ 要約生成エラー: {str(e)} - APIキーを確認してください")
                                 raise
+                            
+                            if cancelled:
+                                st.session_state.is_processing = False
+                                status_text.text("⏹️ 処理をキャンセルしました")
+                                progress_bar.empty()
+                                preview_area.empty()
+                                # バックグラウンドの生成は継続するが、結果は無視
+                                st.stop()
                         
                         # 3. Initialize QA Context
                         status_text.text("💬 Q&A機能初期化中...")
@@ -1020,7 +1052,9 @@ def main():
                         
                         try:
                             from utils import qa_agent
-                            st.session_state.full_context = qa_agent.initialize_vector_store(text_data, api_key)
+                            # 保存済みファイルを処理した場合は、カテゴリの意味検索インデックスも更新する
+                            qa_category_dir = f"data/{category}" if source_type == "ファイル (PDF/TXT)" else None
+                            st.session_state.full_context = qa_agent.initialize_vector_store(cleaned_data, api_key, category_dir=qa_category_dir)
                         except Exception as e:
                             st.error(f"❌ Q&A初期化エラー: {str(e)}")
                         
@@ -1041,7 +1075,8 @@ def main():
                                 st.session_state.summary, 
                                 api_key, 
                                 skip_if_not_found=True,
-                                ai_provider=st.session_state.ai_provider
+                                ai_provider=st.session_state.ai_provider,
+                                use_cache=use_llm_cache()
                             )
                         except Exception as e:
                             st.error(f"❌ 推薦エラー: {str(e)}")
@@ -1123,6 +1158,10 @@ def main():
                 full_extracted_text += f"{'='*50}\n\n"
                 full_extracted_text += item['content']
             
+            # 元資料の全ページからキーワード検索
+            extracted_keyword = st.text_input("🔍 キーワード検索（元資料の全ページ）", placeholder="検索したいキーワードを入力", key="search_extracted")
+            render_page_search_results(extracted_keyword, st.session_state.text_data_list)
+            
             # テキストエリアに表示（コピペ可能）
             st.text_area(
                 "抽出されたテキスト（全選択してコピーしてください）",
@@ -1139,9 +1178,9 @@ def main():
             # 遅延インポート
             from utils import file_loader
             
-            for idx, item in enumerate(st.session_state.text_data_list, 1):
-                # 講義番号を再抽出して表示
-                lecture_num = file_loader.extract_lecture_number(item['source'], item['content'][:500])
+            # 講義番号をまとめて抽出（結果はキャッシュされるので再描画時は再計算しない）
+            lecture_nums = file_loader.extract_lecture_numbers(st.session_state.text_data_list)
+            for idx, (item, lecture_num) in enumerate(zip(st.session_state.text_data_list, lecture_nums), 1):
                 order_info = f"（第{lecture_num}回）" if lecture_num != 999 else "（順序不明）"
                 st.markdown(f"{idx}. **{item['source']}** {order_info} - {len(item['content'])}文字")
             
@@ -1201,6 +1240,9 @@ def main():
             
             st.markdown(displayed_text)
             
+            # 元資料の全ページからも検索
+            render_page_search_results(search_keyword, st.session_state.text_data_list)
+            
             # エクスポート機能
             st.divider()
             export_md = export_to_markdown(st.session_state.summary, st.session_state.integration, st.session_state.text_data_list)
@@ -1310,12 +1352,6 @@ def main():
                 if not api_key or len(api_key.strip()) < 20:
                     st.error("❌ APIキーが設定されていません。サイドバーでログインしてください。")
                     st.stop()
-                else:
-                    # 環境変数に確実に設定
-                    if st.session_state.ai_provider == "gemini":
-                        os.environ["GOOGLE_API_KEY"] = api_key.strip()
-                    else:
-                        os.environ["OPENAI_API_KEY"] = api_key.strip()
             
             # 用語・数式検索機能を追加
             st.subheader("🔍 検索機能")
@@ -1337,43 +1373,14 @@ def main():
                 term_query = st.text_input("わからない用語や単語を入力", placeholder="例: ニューラルネットワーク", key="term_search")
                 if st.button("用語を説明", key="term_explain_btn", use_container_width=True):
                     if term_query:
-                        with st.spinner(f"「{term_query}」を検索中..."):
-                            try:
-                                # APIキーの再確認
-                                if not api_key or len(api_key.strip()) < 20:
-                                    st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
-                                else:
-                                    # 環境変数に確実に設定
-                                    if st.session_state.ai_provider == "gemini":
-                                        os.environ["GOOGLE_API_KEY"] = api_key.strip()
-                                    else:
-                                        os.environ["OPENAI_API_KEY"] = api_key.strip()
-                                    
-                                    # 資料内から用語を検索して説明
-                                    explanation_prompt = f"""
-                                以下の資料内から「{term_query}」という用語について説明してください。
-                                
-                                【説明のルール】
-                                1. 資料内に記載がある場合は、その定義や意味を詳しく説明する
-                                2. 資料内に記載がない場合は、一般的な定義を簡潔に説明する
-                                3. どの資料から引用したかを明記する
-                                
-                                資料の内容:
-                                {st.session_state.full_context[:3000] if st.session_state.full_context else "資料が読み込まれていません"}
-                                """
-                                    
-                                    from utils import qa_agent
-                                    explanation = qa_agent.get_answer(
-                                        explanation_prompt, 
-                                        st.session_state.full_context,
-                                        api_key.strip(),
-                                        st.session_state.ai_provider
-                                    )
-                                    
-                                    st.success(f"📚 「{term_query}」の説明:")
-                                    st.markdown(explanation)
-                            except Exception as e:
-                                st.error(f"❌ 用語検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
+                        try:
+                            # APIキーの再確認
+                            if not api_key or len(api_key.strip()) < 20:
+                                st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
+                            else:
+                                render_material_lookup(term_query, "term", api_key.strip(), st.session_state.ai_provider)
+                        except Exception as e:
+                            st.error(f"❌ 用語検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
                     else:
                         st.warning("用語を入力してください")
             
@@ -1382,43 +1389,14 @@ def main():
                 formula_query = st.text_input("数式や記号を入力", placeholder="例: E=mc^2 または σ", key="formula_search")
                 if st.button("数式を説明", key="formula_explain_btn", use_container_width=True):
                     if formula_query:
-                        with st.spinner(f"「{formula_query}」を検索中..."):
-                            try:
-                                # APIキーの再確認
-                                if not api_key or len(api_key.strip()) < 20:
-                                    st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
-                                else:
-                                    # 環境変数に確実に設定
-                                    if st.session_state.ai_provider == "gemini":
-                                        os.environ["GOOGLE_API_KEY"] = api_key.strip()
-                                    else:
-                                        os.environ["OPENAI_API_KEY"] = api_key.strip()
-                                    
-                                    # 資料内から数式を検索して説明
-                                    formula_prompt = f"""
-                                以下の資料内から「{formula_query}」という数式または記号について説明してください。
-                                
-                                【重要なルール】
-                                1. **資料内に説明がある場合**: その説明をそのまま詳しく記載し、どのファイルから引用したかを明記する。
-                                2. **資料内に説明がない場合**: 「資料内にこの数式の説明は見つかりませんでした。一般的な意味は...」と前置きして簡潔に説明する。
-                                3. 数学・物理の文脈を考慮し、何を表しているかを明確にする。
-                                
-                                資料の内容:
-                                {st.session_state.full_context[:3000] if st.session_state.full_context else "資料が読み込まれていません"}
-                                """
-                                    
-                                    from utils import qa_agent
-                                    explanation = qa_agent.get_answer(
-                                        formula_prompt,
-                                        st.session_state.full_context,
-                                        api_key.strip(),
-                                        st.session_state.ai_provider
-                                    )
-                                    
-                                    st.success(f"🔢 「{formula_query}」の説明:")
-                                    st.markdown(explanation)
-                            except Exception as e:
-                                st.error(f"❌ 数式検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
+                        try:
+                            # APIキーの再確認
+                            if not api_key or len(api_key.strip()) < 20:
+                                st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
+                            else:
+                                render_material_lookup(formula_query, "formula", api_key.strip(), st.session_state.ai_provider)
+                        except Exception as e:
+                            st.error(f"❌ 数式検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
                     else:
                         st.warning("数式を入力してください")
         
@@ -1428,42 +1406,14 @@ def main():
             term_query = st.text_input("わからない用語や単語を入力", placeholder="例: ニューラルネットワーク", key="term_search_only")
             if st.button("用語を説明", key="term_explain_only_btn", use_container_width=True):
                 if term_query:
-                    with st.spinner(f"「{term_query}」を検索中..."):
-                        try:
-                            # APIキーの再確認
-                            if not api_key or len(api_key.strip()) < 20:
-                                st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
-                            else:
-                                # 環境変数に確実に設定
-                                if st.session_state.ai_provider == "gemini":
-                                    os.environ["GOOGLE_API_KEY"] = api_key.strip()
-                                else:
-                                    os.environ["OPENAI_API_KEY"] = api_key.strip()
-                                
-                                explanation_prompt = f"""
-                            以下の資料内から「{term_query}」という用語について説明してください。
-                            
-                            【説明のルール】
-                            1. 資料内に記載がある場合は、その定義や意味を詳しく説明する
-                            2. 資料内に記載がない場合は、一般的な定義を簡潔に説明する
-                            3. どの資料から引用したかを明記する
-                            
-                            資料の内容:
-                            {st.session_state.full_context[:3000] if st.session_state.full_context else "資料が読み込まれていません"}
-                            """
-                                
-                                from utils import qa_agent
-                                explanation = qa_agent.get_answer(
-                                    explanation_prompt,
-                                    st.session_state.full_context,
-                                    api_key.strip(),
-                                    st.session_state.ai_provider
-                                )
-                                
-                                st.success(f"📚 「{term_query}」の説明:")
-                                st.markdown(explanation)
-                        except Exception as e:
-                            st.error(f"❌ 用語検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
+                    try:
+                        # APIキーの再確認
+                        if not api_key or len(api_key.strip()) < 20:
+                            st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
+                        else:
+                            render_material_lookup(term_query, "term", api_key.strip(), st.session_state.ai_provider)
+                    except Exception as e:
+                        st.error(f"❌ 用語検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
                 else:
                     st.warning("用語を入力してください")
         
@@ -1472,42 +1422,14 @@ def main():
             formula_query = st.text_input("数式や記号を入力", placeholder="例: E=mc^2 または σ", key="formula_search_only")
             if st.button("数式を説明", key="formula_explain_only_btn", use_container_width=True):
                 if formula_query:
-                    with st.spinner(f"「{formula_query}」を検索中..."):
-                        try:
-                            # APIキーの再確認
-                            if not api_key or len(api_key.strip()) < 20:
-                                st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
-                            else:
-                                # 環境変数に確実に設定
-                                if st.session_state.ai_provider == "gemini":
-                                    os.environ["GOOGLE_API_KEY"] = api_key.strip()
-                                else:
-                                    os.environ["OPENAI_API_KEY"] = api_key.strip()
-                                
-                                formula_prompt = f"""
-                            以下の資料内から「{formula_query}」という数式または記号について説明してください。
-                            
-                            【重要なルール】
-                            1. **資料内に説明がある場合**: その説明をそのまま詳しく記載し、どのファイルから引用したかを明記する。
-                            2. **資料内に説明がない場合**: 「資料内にこの数式の説明は見つかりませんでした。一般的な意味は...」と前置きして簡潔に説明する。
-                            3. 数学・物理の文脈を考慮し、何を表しているかを明確にする。
-                            
-                            資料の内容:
-                            {st.session_state.full_context[:3000] if st.session_state.full_context else "資料が読み込まれていません"}
-                            """
-                                
-                                from utils import qa_agent
-                                explanation = qa_agent.get_answer(
-                                    formula_prompt,
-                                    st.session_state.full_context,
-                                    api_key.strip(),
-                                    st.session_state.ai_provider
-                                )
-                                
-                                st.success(f"🔢 「{formula_query}」の説明:")
-                                st.markdown(explanation)
-                        except Exception as e:
-                            st.error(f"❌ 数式検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
+                    try:
+                        # APIキーの再確認
+                        if not api_key or len(api_key.strip()) < 20:
+                            st.error("❌ APIキーが無効です。サイドバーで再ログインしてください。")
+                        else:
+                            render_material_lookup(formula_query, "formula", api_key.strip(), st.session_state.ai_provider)
+                    except Exception as e:
+                        st.error(f"❌ 数式検索エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。")
                 else:
                     st.warning("数式を入力してください")
         
@@ -1530,25 +1452,30 @@ def main():
                 with st.chat_message("assistant"):
                     with st.spinner("AIが回答を生成中..."):
                         if api_key and len(api_key.strip()) >= 20:
-                            # 環境変数に確実に設定（チャット機能用）
-                            if st.session_state.ai_provider == "gemini":
-                                os.environ["GOOGLE_API_KEY"] = api_key.strip()
-                            else:
-                                os.environ["OPENAI_API_KEY"] = api_key.strip()
-                            
                             try:
-                                response, sources = qa_agent.get_answer(
+                                # 回答は生成された順に少しずつ表示（全文を待たない）
+                                from utils import qa_agent, chat_memory
+                                # 前の質問を踏まえて回答（履歴は要約 + 直近のやり取りだけを送る）
+                                if st.session_state.get("tutor_memory") is None:
+                                    st.session_state.tutor_memory = chat_memory.ConversationMemory()
+                                answer_placeholder = st.empty()
+                                full_response = ""
+                                answer_stream = qa_agent.get_answer_stream(
                                     st.session_state.messages[-1]["content"], 
                                     st.session_state.full_context,
                                     api_key.strip(),
-                                    st.session_state.ai_provider
+                                    st.session_state.ai_provider,
+                                    memory=st.session_state.tutor_memory,
+                                    use_cache=use_llm_cache()
                                 )
-                                # Append sources to response
-                                full_response = response
-                                if sources:
-                                    full_response += "\n\n**根拠:**\n" + "\n".join([f"- {s}" for s in sources])
+                                for delta in answer_stream:
+                                    full_response += delta
+                                    answer_placeholder.markdown(full_response + "▌")
                                 
-                                st.markdown(full_response)
+                                # Append sources to response（回答がそろってから根拠を付ける）
+                                if answer_stream.sources:
+                                    full_response += "\n\n**根拠:**\n" + "\n".join([f"- {s}" for s in answer_stream.sources])
+                                answer_placeholder.markdown(full_response)
                                 st.session_state.messages.append({"role": "assistant", "content": full_response})
                             except Exception as e:
                                 error_msg = f"❌ 回答生成エラー: {str(e)}\n\n💡 APIキーが正しく設定されているか確認してください。"
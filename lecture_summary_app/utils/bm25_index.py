@@ -0,0 +1,204 @@
+import re
+import json
+import math
+import zlib
+import hashlib
+from collections import Counter
+from pathlib import Path
+
+from . import disk_store, text_cleaner
+
+# 検索インデックスの保存先（data/ 配下に置くとカテゴリ一覧に表示されてしまうため別ディレクトリ）
+INDEX_DIR = Path(".cache/bm25")
+
+# 保存するインデックスの合計最大サイズ: 100MB（超えた分は古い順に削除）
+MAX_INDEX_STORE_SIZE = 100 * 1024 * 1024
+
+# 分割・トークン化の方法を変えたら上げる（古いインデックスを使わないように）
+INDEX_VERSION = 1
+
+# 1つの抜粋（チャンク）の最大文字数（ページ内の段落をこの長さまでまとめる）
+CHUNK_CHARS = 600
+
+# BM25 のパラメータ（一般的な既定値）
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 質問ごとに送る抜粋の数
+DEFAULT_TOP_K = 8
+
+# 英数字の単語 / かな・漢字の連続
+_WORD_REGEX = re.compile(r"[a-z0-9]+(?:[._'][a-z0-9]+)*")
+_CJK_RUN_REGEX = re.compile(r"[ぁ-ヿ㐀-䶿一-鿿豈-﫿]+")
+_PARAGRAPH_REGEX = re.compile(r"\n\s*\n")
+
+def tokenize(text: str) -> list:
+    """
+    検索用にテキストをトークン化
+
+    日本語は単語の区切りがないため、かな・漢字の連続は文字 bigram（2文字ずつ）にする。
+    英数字は小文字の単語単位。全角英数字は半角として扱う。
+    """
+    text = text_cleaner.normalize_width(text).lower()
+    tokens = _WORD_REGEX.findall(text)
+    for run in _CJK_RUN_REGEX.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+def _split_passages(text: str, max_chars: int = CHUNK_CHARS) -> list:
+    """段落の区切りで max_chars 以下の抜粋に分ける（長い段落は文字数で切る）"""
+    passages = []
+    current = ""
+    for paragraph in _PARAGRAPH_REGEX.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces = [paragraph[i:i + max_chars] for i in range(0, len(paragraph), max_chars)]
+        for piece in pieces:
+            if current and len(current) + len(piece) + 1 > max_chars:
+                passages.append(current)
+                current = ""
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+def make_chunks(text_data_list, max_chars: int = CHUNK_CHARS) -> list:
+    """
+    資料をページ・段落単位の抜粋に分ける（定型文・ページ番号は除く）
+
+    Args:
+        text_data_list: {"content", "source", ("hash")} の辞書のリスト
+            （text_cleaner.clean_documents で整形済みの資料なら整形し直さない）
+        max_chars: 1つの抜粋の最大文字数
+
+    Returns:
+        {"source", "page", "text"} の辞書のリスト（ページが不明な資料は page が None）
+    """
+    cleaned, _ = text_cleaner.clean_documents(text_data_list)
+    chunks = []
+    for item in cleaned:
+        for page_no, text in text_cleaner.iter_pages(item):
+            for passage in _split_passages(text, max_chars):
+                chunks.append({"source": item["source"], "page": page_no, "text": passage})
+    return chunks
+
+def format_passage(chunk: dict) -> str:
+    """抜粋をプロンプト用の文字列にする（ソース名とページ番号を見出しに付ける）"""
+    page = f" (p.{chunk['page']})" if chunk.get("page") else ""
+    return f"--- Source: {chunk['source']}{page} ---\n{chunk['text']}"
+
+class BM25Index:
+    """
+    抜粋（チャンク）の転置インデックスと BM25 によるランキング
+
+    postings は {トークン: [[チャンク番号, 出現回数], ...]}。
+    """
+
+    def __init__(self, chunks, postings=None, lengths=None):
+        self.chunks = chunks
+        if postings is None:
+            postings, lengths = self._build(chunks)
+        self.postings = postings
+        self.lengths = lengths
+        self.avg_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    @staticmethod
+    def _build(chunks):
+        postings = {}
+        lengths = []
+        for chunk_id, chunk in enumerate(chunks):
+            counts = Counter(tokenize(f"{chunk['source']}\n{chunk['text']}"))
+            lengths.append(sum(counts.values()))
+            for token, count in counts.items():
+                postings.setdefault(token, []).append([chunk_id, count])
+        return postings, lengths
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def sources(self) -> list:
+        """索引済みのソース名（資料の順）"""
+        return list(dict.fromkeys(chunk["source"] for chunk in self.chunks))
+
+    def full_text(self) -> str:
+        """全抜粋を連結したテキスト（資料全体が必要な処理用）"""
+        return "\n\n".join(format_passage(chunk) for chunk in self.chunks)
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K) -> list:
+        """
+        質問に関連する抜粋を検索
+
+        Returns:
+            (スコア, 抜粋の辞書) のリスト（スコアの高い順、該当なしは空）
+        """
+        total = len(self.chunks)
+        if not total:
+            return []
+        scores = Counter()
+        for token, query_count in Counter(tokenize(query)).items():
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, count in postings:
+                norm = 1 - BM25_B + BM25_B * self.lengths[chunk_id] / self.avg_length
+                scores[chunk_id] += query_count * idf * count * (BM25_K1 + 1) / (count + BM25_K1 * norm)
+        return [(score, self.chunks[chunk_id]) for chunk_id, score in scores.most_common(top_k)]
+
+def _corpus_key(chunks) -> str:
+    payload = json.dumps([INDEX_VERSION, [[c["source"], c["page"], c["text"]] for c in chunks]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _index_path(key: str) -> Path:
+    return INDEX_DIR / f"{key}.json.z"
+
+def _load(key: str, chunks):
+    path = _index_path(key)
+    try:
+        with open(path, "rb") as f:
+            data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+    except (OSError, zlib.error, ValueError):
+        return None
+    disk_store.touch(path)  # LRU: 最終利用時刻として更新
+    return BM25Index(chunks, data["postings"], data["lengths"])
+
+def _save(key: str, index: BM25Index):
+    try:
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        data = {"postings": index.postings, "lengths": index.lengths}
+        disk_store.atomic_write(_index_path(key), zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"), 6))
+        evict_indexes()
+    except OSError as e:
+        print(f"⚠️ 検索インデックス保存エラー: {type(e).__name__}")
+
+def build_index(text_data_list) -> BM25Index:
+    """
+    資料の検索インデックスを作成（同じ資料の組み合わせは保存済みのものを読み込む）
+
+    Args:
+        text_data_list: {"content", "source", ("hash")} の辞書のリスト（整形済みの資料も可）
+    """
+    chunks = make_chunks(text_data_list)
+    key = _corpus_key(chunks)
+    index = _load(key, chunks)
+    if index is not None:
+        print(f"🔎 検索インデックス読み込み: {len(chunks)}件の抜粋")
+        return index
+    index = BM25Index(chunks)
+    _save(key, index)
+    print(f"🔎 検索インデックス作成: {len(chunks)}件の抜粋, {len(index.postings):,}語")
+    return index
+
+def evict_indexes(max_size: int = MAX_INDEX_STORE_SIZE):
+    """
+    合計サイズが上限を超えている場合、最終利用が古い順に削除
+    """
+    disk_store.evict(INDEX_DIR, "*.json.z", max_size)
+
+def clear_indexes():
+    """保存済みの検索インデックスをすべて削除"""
+    disk_store.clear(INDEX_DIR, "*.json.z")
@@ -0,0 +1,127 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import llm_client
+
+# そのまま残す直近のやり取りの数（1回 = 質問 + 回答）
+RECENT_TURNS = 4
+
+# 直近のやり取りの1発言あたりの最大文字数（長い回答は末尾を省略）
+MAX_MESSAGE_CHARS = 1500
+
+# 古いやり取りをまとめた要約の最大文字数
+SUMMARY_MAX_CHARS = 1200
+
+# 要約の更新に使うスレッド数（回答の生成を待たせないようにバックグラウンドで実行）
+SUMMARY_WORKERS = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="chat-memory")
+        return _executor
+
+def _clip(text: str, max_chars: int) -> str:
+    return text if len(text) <= max_chars else text[:max_chars] + "…（省略）"
+
+def _format_turns(turns) -> str:
+    return "\n".join(f"ユーザー: {question}\nAI: {answer}" for question, answer in turns)
+
+class ConversationMemory:
+    """
+    AIチューターの会話履歴（直近のやり取りはそのまま、古いやり取りは要約して保持）
+
+    プロンプトに入れる履歴は「要約 + 直近 RECENT_TURNS 回」だけなので、
+    会話が長くなっても1回の質問で送る量は一定以下に保たれる。
+    要約の更新はバックグラウンドで行い、完了するまでは前回の要約を使う。
+    """
+
+    def __init__(self, recent_turns: int = RECENT_TURNS):
+        self.recent_turns = recent_turns
+        self.turns = []          # まだ要約に含めていない (質問, 回答) のリスト
+        self.summary = ""
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._generation = 0     # clear() で増やす（要約中に消された履歴を消し直さないように）
+
+    def __len__(self):
+        with self._lock:
+            return len(self.turns)
+
+    def clear(self):
+        with self._lock:
+            self.turns = []
+            self.summary = ""
+            self._generation += 1
+
+    def add_turn(self, question: str, answer: str):
+        """やり取りを1回分追加"""
+        with self._lock:
+            self.turns.append((question, answer))
+
+    def last_question(self) -> str:
+        """直前の質問（続けて質問された場合の資料検索に使う）"""
+        with self._lock:
+            return self.turns[-1][0] if self.turns else ""
+
+    def context(self) -> str:
+        """
+        プロンプトに入れる会話履歴のテキスト（履歴がない場合は空文字）
+        """
+        with self._lock:
+            summary = self.summary
+            recent = self.turns[-self.recent_turns:] if self.recent_turns else []
+        parts = []
+        if summary:
+            parts.append(f"（これまでの会話の要約）\n{summary}")
+        if recent:
+            clipped = [(_clip(q, MAX_MESSAGE_CHARS), _clip(a, MAX_MESSAGE_CHARS)) for q, a in recent]
+            parts.append(f"（直近のやり取り）\n{_format_turns(clipped)}")
+        return "\n\n".join(parts)
+
+    def refresh_summary(self, llm, provider: str, use_cache: bool = True):
+        """
+        直近 RECENT_TURNS 回より古いやり取りを要約に取り込む（バックグラウンドで実行）
+
+        Args:
+            llm: 要約に使うチャットモデル
+            provider: 'gemini' / 'openai' / 'local'
+            use_cache: False の場合は応答キャッシュを使わない
+        """
+        with self._lock:
+            if self._refreshing or len(self.turns) <= self.recent_turns:
+                return
+            self._refreshing = True
+            old_turns = self.turns[:len(self.turns) - self.recent_turns]
+            summary = self.summary
+            generation = self._generation
+        _get_executor().submit(self._refresh, llm, provider, summary, old_turns, generation, use_cache)
+
+    def _refresh(self, llm, provider, summary, old_turns, generation, use_cache):
+        clipped = [(_clip(q, MAX_MESSAGE_CHARS), _clip(a, MAX_MESSAGE_CHARS)) for q, a in old_turns]
+        prompt = f"""
+        以下は学生とAIチューターの会話です。【これまでの要約】に【新しいやり取り】の内容を取り込み、
+        今後の質問に答えるために必要な情報（話題・学生の理解度・前提にしている定義や数式）を
+        {SUMMARY_MAX_CHARS}文字以内の日本語の箇条書きにまとめてください。
+
+        【これまでの要約】
+        {summary or "（なし）"}
+
+        【新しいやり取り】
+        {_format_turns(clipped)}
+        """
+        try:
+            new_summary = llm_client.invoke(llm, prompt, provider, use_cache=use_cache).strip()
+        except Exception as e:
+            print(f"⚠️ 会話の要約エラー: {type(e).__name__}")
+            new_summary = None
+        with self._lock:
+            if new_summary and generation == self._generation:
+                self.summary = _clip(new_summary, SUMMARY_MAX_CHARS)
+                # 要約している間に追加されたやり取りは残す
+                del self.turns[:len(old_turns)]
+            self._refreshing = False
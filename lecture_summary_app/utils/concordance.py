@@ -0,0 +1,283 @@
+import re
+import bisect
+import functools
+import unicodedata
+from array import array
+
+from . import text_cleaner
+
+# スニペット（KWIC）の一致箇所の前後の文字数
+WINDOW_CHARS = 80
+
+# 1回の検索で返す最大件数
+MAX_MATCHES = 20
+
+# 抜粋どうしを連結するときの区切り（検索語がまたがって一致しないように）
+_SEPARATOR = "\x00"
+
+# 上付き・下付きの数字（x² → x^2, a₁ → a_1）
+_SUPERSCRIPTS = {ch: "^" + digit for ch, digit in zip("⁰¹²³⁴⁵⁶⁷⁸⁹", "0123456789")}
+_SUBSCRIPTS = {ch: "_" + digit for ch, digit in zip("₀₁₂₃₄₅₆₇₈₉", "0123456789")}
+
+# LaTeX のコマンド → 数式の正規形（Unicode の記号）
+_LATEX_SYMBOLS = {
+    "alpha": "α", "beta": "β", "gamma": "γ", "delta": "δ", "epsilon": "ε", "varepsilon": "ε",
+    "zeta": "ζ", "eta": "η", "theta": "θ", "vartheta": "θ", "iota": "ι", "kappa": "κ",
+    "lambda": "λ", "mu": "μ", "nu": "ν", "xi": "ξ", "pi": "π", "rho": "ρ", "sigma": "σ",
+    "tau": "τ", "upsilon": "υ", "phi": "φ", "varphi": "φ", "chi": "χ", "psi": "ψ", "omega": "ω",
+    "Gamma": "Γ", "Delta": "Δ", "Theta": "Θ", "Lambda": "Λ", "Xi": "Ξ", "Pi": "Π",
+    "Sigma": "Σ", "Phi": "Φ", "Psi": "Ψ", "Omega": "Ω",
+    "sum": "∑", "prod": "∏", "int": "∫", "oint": "∮", "partial": "∂", "nabla": "∇",
+    "infty": "∞", "sqrt": "√", "pm": "±", "mp": "∓", "times": "·", "cdot": "·", "div": "÷",
+    "le": "≤", "leq": "≤", "ge": "≥", "geq": "≥", "ne": "≠", "neq": "≠", "approx": "≈",
+    "simeq": "≃", "equiv": "≡", "propto": "∝", "in": "∈", "notin": "∉", "subset": "⊂",
+    "subseteq": "⊆", "cup": "∪", "cap": "∩", "forall": "∀", "exists": "∃",
+    "to": "→", "rightarrow": "→", "leftarrow": "←", "Rightarrow": "⇒", "leftrightarrow": "↔",
+    "Leftrightarrow": "⇔", "ldots": "…", "cdots": "…", "dots": "…",
+}
+
+# 意味を持たない書式用の LaTeX コマンド（検索では無視）
+_LATEX_IGNORED = {
+    "left", "right", "displaystyle", "textstyle", "mathrm", "mathbf", "mathit", "mathsf",
+    "mathcal", "boldsymbol", "text", "operatorname", "big", "Big", "bigg", "Bigg",
+}
+
+# Unicode の記号の表記ゆれ → 正規形
+_SYMBOL_FOLDS = {"×": "·", "∙": "·", "⋅": "·", "*": "·", "−": "-", "–": "-", "∕": "/"}
+
+_FORMULA_TOKEN_REGEX = re.compile(r"\\[A-Za-z]+|\\.|[0-9A-Za-z぀-鿿]+|\s+|[ｦ-ﾝ][ﾞﾟ]?|.", re.DOTALL)
+
+# 1文字として扱う単位（結合文字・半角の濁点/半濁点は直前の文字とまとめる: "ｶﾞ" → "ガ"）
+_GRAPHEME_REGEX = re.compile(r".[\u0300-\u036f\u3099\u309a\uff9e\uff9f]*", re.DOTALL)
+_COMBINING_MARK_REGEX = re.compile(r"[\u0300-\u036f\u3099\u309a\uff9e\uff9f]")
+
+# 幅の正規化で変わる文字（全角英数字・記号・半角カナ）と結合文字の連続
+_WIDTH_RUN_REGEX = re.compile(r"[！-～　ｦ-ﾟ\u0300-\u036f\u3099\u309a]+")
+
+def normalize_term(text: str) -> str:
+    """用語検索用の正規化（全角/半角の違いと大文字/小文字を無視）"""
+    return text_cleaner.normalize_width(text).lower()
+
+def _formula_tokens(text: str):
+    """
+    数式の正規化（トークンごとに、正規化後の文字列と元のテキストでの範囲を返す）
+    """
+    for match in _FORMULA_TOKEN_REGEX.finditer(text):
+        token = match.group(0)
+        if token.startswith("\\"):
+            name = token[1:]
+            if name in _LATEX_SYMBOLS:
+                yield _LATEX_SYMBOLS[name], match.start(), match.end()
+            elif name in _LATEX_IGNORED or not name.isalpha():
+                continue  # \left, \, \; 等
+            elif name in ("dfrac", "tfrac"):
+                yield "\\frac", match.start(), match.end()
+            else:
+                yield token, match.start(), match.end()
+        elif token.isspace() or token in "{}$":
+            continue  # 空白・グループの括弧は表記によって有無が変わるため無視
+        elif token in _SUPERSCRIPTS:
+            yield _SUPERSCRIPTS[token], match.start(), match.end()
+        elif token in _SUBSCRIPTS:
+            yield _SUBSCRIPTS[token], match.start(), match.end()
+        else:
+            folded = _SYMBOL_FOLDS.get(token)
+            if folded is None:
+                folded = unicodedata.normalize("NFKC", token) if len(token) <= 2 else token
+                folded = _SYMBOL_FOLDS.get(folded, folded)
+            yield folded, match.start(), match.end()
+
+def normalize_formula(text: str) -> str:
+    """
+    数式検索用の正規化
+
+    LaTeX（\\sigma, x^{2}, \\leq）・Unicode の数学記号（σ, x², ≤）・全角文字（ｘ＝１）を
+    同じ表記にそろえ、空白と {} を除く。例: "E = mc²" / "E=mc^{2}" / "Ｅ＝ｍｃ^2" → "E=mc^2"
+    """
+    return "".join(token for token, _, _ in _formula_tokens(text))
+
+def _formula_spans(text: str):
+    """
+    正規化後の文字列と、その各文字に対応する元のテキストでの範囲
+
+    Returns:
+        (正規化後の文字列, 開始位置の配列, 終了位置の配列) のタプル
+    """
+    parts, starts, ends = [], array("I"), array("I")
+    for token, start, end in _formula_tokens(text):
+        parts.append(token)
+        if end - start == len(token) and token.isalnum():
+            # 英数字・かな漢字の連続はそのまま
+            starts.extend(range(start, end))
+            ends.extend(range(start + 1, end + 1))
+        else:
+            # \sigma → σ 等はトークン全体に対応
+            starts.extend([start] * len(token))
+            ends.extend([end] * len(token))
+    return "".join(parts), starts, ends
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_grapheme(grapheme: str) -> str:
+    return normalize_term(grapheme)
+
+def _term_spans(text: str):
+    """
+    normalize_term と同じ正規化後の文字列と、その各文字に対応する元のテキストでの範囲
+
+    半角カナの濁点（"ｶﾞ" → "ガ"）のように正規化で文字数が変わる場合があるため、
+    幅を変える文字の連続は1文字（結合文字を含む単位）ずつ正規化して対応を取る。
+
+    Returns:
+        (正規化後の文字列, 開始位置の配列, 終了位置の配列) のタプル
+        （1文字ずつそのまま対応する場合、配列は None）
+    """
+    normalized = normalize_term(text)
+    if len(normalized) == len(text) and not _COMBINING_MARK_REGEX.search(text):
+        return normalized, None, None
+    parts, starts, ends = [], array("I"), array("I")
+
+    def add_graphemes(start, end):
+        for match in _GRAPHEME_REGEX.finditer(text, start, end):
+            folded = _normalize_grapheme(match.group(0))
+            parts.append(folded)
+            starts.extend([match.start()] * len(folded))
+            ends.extend([match.end()] * len(folded))
+
+    def add_plain(start, end):
+        segment = text[start:end].lower()
+        if len(segment) != end - start:
+            add_graphemes(start, end)  # 小文字にすると文字数が変わる文字（"İ" 等）を含む
+            return
+        parts.append(segment)
+        starts.extend(range(start, end))
+        ends.extend(range(start + 1, end + 1))
+
+    position = 0
+    for run in _WIDTH_RUN_REGEX.finditer(text):
+        add_plain(position, run.start())
+        add_graphemes(run.start(), run.end())
+        position = run.end()
+    add_plain(position, len(text))
+    return "".join(parts), starts, ends
+
+class _JoinedText:
+    """
+    全抜粋を正規化して1つの文字列に連結したもの（検索は str.find で全体を1回走査）
+
+    連結するテキストと元のテキストでの位置の対応表は、同じ spans_of から1回で作る。
+    """
+
+    def __init__(self, chunks, spans_of):
+        self.starts = []
+        self._offsets = {}  # 抜粋番号 → 正規化後の各文字の元の範囲（開始位置・終了位置の配列）
+        parts = []
+        position = 0
+        for chunk_id, chunk in enumerate(chunks):
+            normalized, starts, ends = spans_of(chunk["text"])
+            if starts is not None:
+                self._offsets[chunk_id] = (starts, ends)
+            self.starts.append(position)
+            parts.append(normalized)
+            position += len(normalized) + len(_SEPARATOR)
+        self.text = _SEPARATOR.join(parts)
+
+    def source_range(self, chunk_id: int, position: int, length: int):
+        """抜粋内の正規化後の位置 position から length 文字の、元のテキストでの範囲 (start, end)"""
+        offsets = self._offsets.get(chunk_id)
+        if offsets is None:
+            return position, position + length
+        starts, ends = offsets
+        return starts[position], ends[position + length - 1]
+
+    def find_all(self, needle: str, limit: int):
+        """(抜粋番号, 抜粋内の正規化後の位置) を出現順に返す"""
+        if not needle:
+            return
+        position = self.text.find(needle)
+        found = 0
+        while position >= 0 and found < limit:
+            chunk_id = bisect.bisect_right(self.starts, position) - 1
+            yield chunk_id, position - self.starts[chunk_id]
+            found += 1
+            position = self.text.find(needle, position + len(needle))
+
+class Concordance:
+    """
+    全ページの KWIC（キーワードの前後の文脈）索引と数式索引
+
+    用語は全角/半角・大文字/小文字を無視して、数式は LaTeX・Unicode の表記ゆれを無視して一致させる。
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self._terms = _JoinedText(chunks, _term_spans)
+        self._formulas = _JoinedText(chunks, _formula_spans)
+
+    def _matches(self, joined, needle, limit):
+        results = []
+        for chunk_id, position in joined.find_all(needle, limit * 4):
+            chunk = self.chunks[chunk_id]
+            start, end = joined.source_range(chunk_id, position, len(needle))
+            # 正規化で除いた閉じ括弧（x^{2} の "}"）も一致箇所に含める
+            text = chunk["text"]
+            while end < len(text) and text[end] == "}" and text.count("{", start, end) > text.count("}", start, end):
+                end += 1
+            results.append(self._snippet(chunk, start, end))
+            if len(results) >= limit:
+                break
+        return _dedupe(results)
+
+    @staticmethod
+    def _snippet(chunk, start: int, end: int) -> dict:
+        text = chunk["text"]
+        left = max(0, start - WINDOW_CHARS)
+        right = min(len(text), end + WINDOW_CHARS)
+        before = ("…" if left > 0 else "") + text[left:start]
+        after = text[end:right] + ("…" if right < len(text) else "")
+        return {
+            "source": chunk["source"],
+            "page": chunk.get("page"),
+            "match": text[start:end],
+            "snippet": (before + text[start:end] + after).replace("\n", " "),
+            "highlighted": (before + f"**{text[start:end]}**" + after).replace("\n", " "),
+        }
+
+    def search_term(self, query: str, limit: int = MAX_MATCHES) -> list:
+        """
+        用語の出現箇所を検索
+
+        Returns:
+            {"source", "page", "match", "snippet", "highlighted"} の辞書のリスト（資料の順）
+        """
+        needle = normalize_term(query.strip())
+        return self._matches(self._terms, needle, limit)
+
+    def search_formula(self, query: str, limit: int = MAX_MATCHES) -> list:
+        """
+        数式・記号の出現箇所を検索（表記ゆれを無視）
+
+        Returns:
+            search_term と同じ
+        """
+        needle = normalize_formula(query)
+        return self._matches(self._formulas, needle, limit)
+
+def _dedupe(results) -> list:
+    """同じ箇所（重なる抜粋）のスニペットを1つにする（同じ抜粋内の別の一致箇所は残す）"""
+    seen = set()
+    unique = []
+    for result in results:
+        key = (result["source"], result["page"], result["highlighted"])
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append(result)
+    return unique
+
+def format_matches(matches) -> str:
+    """スニペットをプロンプト用の文字列にする（ソース名とページ番号を見出しに付ける）"""
+    blocks = []
+    for match in matches:
+        page = f" (p.{match['page']})" if match.get("page") else ""
+        blocks.append(f"--- Source: {match['source']}{page} ---\n{match['snippet']}")
+    return "\n\n".join(blocks)
@@ -0,0 +1,71 @@
+import json
+import zlib
+import hashlib
+from pathlib import Path
+
+from . import disk_store
+
+# 講義ごとの部分要約の保存先（data/ 配下に置くとカテゴリ一覧に表示されてしまうため別ディレクトリ）
+DIGEST_DIR = Path(".cache/digests")
+
+# 保存する部分要約の合計最大サイズ: 50MB（超えた分は古い順に削除）
+MAX_DIGEST_STORE_SIZE = 50 * 1024 * 1024
+
+def make_key(content_hash: str, source: str, **settings) -> str:
+    """
+    部分要約のキーを作成（資料の内容ハッシュ + ソース名 + 要約の設定）
+
+    Args:
+        content_hash: ファイル内容のSHA-256
+        source: ソース名（出典として部分要約に含まれるため）
+        settings: 出力言語・モデル・プロンプトのバージョン等（変わると別エントリ扱い）
+    """
+    payload = json.dumps([content_hash, source, sorted(settings.items())], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _entry_path(key: str) -> Path:
+    return DIGEST_DIR / f"{key}.json.z"
+
+def get_digests(key: str):
+    """
+    保存済みの部分要約を取得
+
+    Returns:
+        [(ラベル, 部分要約), ...]（存在しない場合はNone）
+    """
+    path = _entry_path(key)
+    try:
+        with open(path, "rb") as f:
+            entries = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+    except (OSError, zlib.error, ValueError):
+        return None
+
+    disk_store.touch(path)  # LRU: 最終利用時刻として更新
+    return [tuple(entry) for entry in entries]
+
+def has_digests(key: str) -> bool:
+    """部分要約が保存済みか（読み込みはしない）"""
+    return _entry_path(key).exists()
+
+def put_digests(key: str, digests):
+    """
+    資料1つ分の部分要約を保存（上限を超えた場合は古いものから削除）
+    """
+    try:
+        DIGEST_DIR.mkdir(parents=True, exist_ok=True)
+        path = _entry_path(key)
+
+        disk_store.atomic_write(path, zlib.compress(json.dumps(list(digests), ensure_ascii=False).encode("utf-8"), 6))
+        evict_digests()
+    except OSError as e:
+        print(f"⚠️ 部分要約保存エラー: {type(e).__name__}")
+
+def evict_digests(max_size: int = MAX_DIGEST_STORE_SIZE):
+    """
+    合計サイズが上限を超えている場合、最終利用が古い順に削除
+    """
+    disk_store.evict(DIGEST_DIR, "*.json.z", max_size)
+
+def clear_digests():
+    """保存済みの部分要約をすべて削除"""
+    disk_store.clear(DIGEST_DIR, "*.json.z")
@@ -0,0 +1,103 @@
+import os
+import time
+import tempfile
+from pathlib import Path
+
+# 書き込み途中で異常終了したプロセスが残した一時ファイルを削除するまでの時間: 1時間
+STALE_TMP_SECONDS = 60 * 60
+
+_TMP_SUFFIX = ".tmp"
+
+def atomic_write(path, data: bytes):
+    """
+    一時ファイルに書いてから置き換え（書き込み途中のファイルを読ませない）
+
+    一時ファイルは同じディレクトリに一意な名前で作るため、同じプロセスの複数のスレッド
+    （Streamlit のセッション）が同じキーに同時に書き込んでも互いに壊さない。
+    名前は "." で始まるので、カテゴリ内のファイル一覧やキャッシュの glob には含まれない。
+
+    Raises:
+        OSError: 書き込みに失敗した場合（一時ファイルは削除する）
+    """
+    path = Path(path)
+    tmp = tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.name}.", suffix=_TMP_SUFFIX, delete=False)
+    try:
+        with tmp:
+            tmp.write(data)
+        os.replace(tmp.name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp.name)
+        except OSError:
+            pass
+        raise
+
+def touch(path):
+    """LRU: 最終利用時刻として更新日時を更新"""
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def evict(directory, pattern: str, max_size: int, ttl: float = None):
+    """
+    合計サイズが上限を超えている場合、最終利用（更新日時）が古い順に削除
+
+    Args:
+        directory: 保存先のディレクトリ
+        pattern: 対象のファイルの glob パターン（例: "*.json.z"）
+        max_size: 合計の最大サイズ（バイト）
+        ttl: 指定すると、最終利用から ttl 秒以上経過したファイルはサイズに関係なく削除
+    """
+    directory = Path(directory)
+    if not directory.exists():
+        return
+
+    now = time.time()
+    # 異常終了したプロセスが残した一時ファイル
+    for path in directory.glob(f".*{_TMP_SUFFIX}"):
+        try:
+            if now - path.stat().st_mtime > STALE_TMP_SECONDS:
+                path.unlink()
+        except OSError:
+            pass
+
+    entries = []
+    total_size = 0
+    for path in directory.glob(pattern):
+        try:
+            st = path.stat()
+        except OSError:
+            continue  # 他スレッドが削除済み
+        if ttl is not None and now - st.st_mtime > ttl:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total_size += st.st_size
+
+    if total_size <= max_size:
+        return
+
+    entries.sort()  # 古い順
+    for _, size, path in entries:
+        if total_size <= max_size:
+            break
+        try:
+            path.unlink()
+            total_size -= size
+        except OSError:
+            pass
+
+def clear(directory, pattern: str):
+    """pattern に一致するファイルをすべて削除"""
+    directory = Path(directory)
+    if not directory.exists():
+        return
+    for path in directory.glob(pattern):
+        try:
+            path.unlink()
+        except OSError:
+            pass
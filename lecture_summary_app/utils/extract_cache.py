@@ -0,0 +1,56 @@
+import zlib
+from pathlib import Path
+
+from . import disk_store
+
+# キャッシュ保存先（data/ 配下に置くとカテゴリ一覧に表示されてしまうため別ディレクトリ）
+CACHE_DIR = Path(".cache/extract")
+
+# キャッシュ全体の最大サイズ: 500MB（超えた分は古い順に削除）
+MAX_CACHE_SIZE = 500 * 1024 * 1024
+
+def _entry_path(content_hash: str, version: int) -> Path:
+    """キャッシュエントリのパス（内容ハッシュ + 抽出処理のバージョン）"""
+    return CACHE_DIR / f"{content_hash}-v{version}.txt.z"
+
+def get_cached_text(content_hash: str, version: int):
+    """
+    抽出済みテキストをキャッシュから取得
+
+    Args:
+        content_hash: ファイル内容のSHA-256
+        version: 抽出処理のバージョン（変わると別エントリ扱い）
+
+    Returns:
+        キャッシュ済みテキスト（存在しない場合はNone）
+    """
+    path = _entry_path(content_hash, version)
+    try:
+        with open(path, "rb") as f:
+            text = zlib.decompress(f.read()).decode("utf-8")
+    except (OSError, zlib.error, UnicodeDecodeError):
+        return None
+
+    disk_store.touch(path)  # LRU: 最終利用時刻として更新
+    return text
+
+def put_cached_text(content_hash: str, version: int, text: str):
+    """
+    抽出済みテキストをキャッシュに保存（上限を超えた場合は古いものから削除）
+    """
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        disk_store.atomic_write(_entry_path(content_hash, version), zlib.compress(text.encode("utf-8"), 6))
+        evict_cache()
+    except OSError as e:
+        print(f"⚠️ 抽出キャッシュ保存エラー: {type(e).__name__}")
+
+def evict_cache(max_size: int = MAX_CACHE_SIZE):
+    """
+    キャッシュ合計サイズが上限を超えている場合、最終利用が古い順に削除
+    """
+    disk_store.evict(CACHE_DIR, "*.txt.z", max_size)
+
+def clear_cache():
+    """キャッシュをすべて削除"""
+    disk_store.clear(CACHE_DIR, "*.txt.z")
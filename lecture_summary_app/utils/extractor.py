@@ -0,0 +1,160 @@
+import os
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from . import file_loader, extract_cache, page_store
+
+# ファイル単位の処理（ハッシュ計算・キャッシュ確認・TXT読み込み）を行うスレッド数の下限
+# PDFがある場合はプロセス数まで増やす（各スレッドは自分のPDFのページ抽出の完了を待つため）
+FILE_THREAD_WORKERS = 8
+
+# PDFのページ抽出用のプロセス数（CPU処理なのでコア数まで並列化）
+PDF_PROCESS_WORKERS = os.cpu_count() or 1
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def load_single_file(path_and_num, executor=None, known_entry=None):
+    """
+    単一ファイルを読み込む関数（並列処理用）
+
+    Args:
+        path_and_num: (ファイルパス, 元の並び順) のタプル
+        executor: PDFのページ範囲を並列抽出するプロセスプール（Noneなら逐次処理）
+        known_entry: 変更のないファイルのマニフェストエントリ（あればハッシュ計算を省略）
+
+    Returns:
+        status / filename / content / order / original_order / hash / pages を含む辞書
+    """
+    path, num = path_and_num
+    filename = os.path.basename(path)
+    try:
+        content = None
+        if known_entry:
+            # 変更なし: マニフェストのハッシュでキャッシュを引く（ファイルは読まない）
+            content_hash = known_entry["hash"]
+            content = extract_cache.get_cached_text(content_hash, file_loader.EXTRACTOR_VERSION)
+            if content is None:
+                known_entry = None  # キャッシュが消えていれば通常どおり読み込む
+
+        if content is None:
+            # 抽出キャッシュを先に確認（内容が同じなら再抽出しない）
+            content_hash = file_loader.compute_file_hash(path)
+            content = extract_cache.get_cached_text(content_hash, file_loader.EXTRACTOR_VERSION)
+
+        if content is None:
+            content, pages = file_loader.load_document(path, executor=executor)
+
+            # 正常に抽出できたものだけキャッシュ・ページストアに登録
+            if content and "Error" not in content[:50]:
+                extract_cache.put_cached_text(content_hash, file_loader.EXTRACTOR_VERSION, content)
+                page_store.add_document(content_hash, filename, pages)
+        elif not page_store.has_document(content_hash):
+            # キャッシュはあるがページストアに未登録（ページ単位のテキストを取り直す）
+            if path.endswith('.pdf'):
+                _, pages = file_loader.load_document(path, executor=executor)
+            else:
+                # TXTは全体を読み込まず、チャンクを逐次登録する
+                pages = (text for _, _, text in file_loader.iter_text_chunks(path))
+            if pages:
+                page_store.add_document(content_hash, filename, pages)
+
+        if not content:
+            return {"status": "empty", "filename": filename, "error": "内容が空"}
+
+        if "Error" in content[:50]:
+            return {"status": "error", "filename": filename, "error": content[:100]}
+
+        if known_entry and known_entry.get("lecture_number") is not None:
+            lecture_num = known_entry["lecture_number"]
+            pages = known_entry.get("pages")
+        else:
+            # 講義番号を抽出
+            lecture_num = file_loader.extract_lecture_number(filename, content[:500])
+            if path.endswith('.pdf'):
+                pages = file_loader.count_pdf_pages(path)
+            else:
+                pages = max(1, -(-len(content) // file_loader.TEXT_CHUNK_CHARS))  # TXTはチャンク数
+
+        return {
+            "status": "success",
+            "filename": filename,
+            "content": content,
+            "order": lecture_num,
+            "original_order": num,
+            "hash": content_hash,
+            "pages": pages
+        }
+    except Exception as e:
+        return {"status": "error", "filename": filename, "error": str(e)}
+
+def _get_process_pool():
+    """
+    PDF抽出用のプロセスプールを取得（起動コストが大きいので再実行間で使い回す）
+    """
+    global _process_pool
+    with _process_pool_lock:
+        # ワーカーが異常終了したプールは使えないので作り直す
+        if _process_pool is not None and getattr(_process_pool, "_broken", False):
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+        if _process_pool is None:
+            # fork は他のスレッド（ファイル読み込み・レート制限・会話要約等）が持っていたロックを
+            # 子プロセスに引き継いでデッドロックすることがあるため、spawn で起動する
+            # （ワーカーで実行する file_loader.extract_pdf_page_range はモジュールの関数として import できる）
+            _process_pool = ProcessPoolExecutor(
+                max_workers=PDF_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+def _reset_process_pool():
+    """プロセスプールを終了（次回呼び出し時に作り直す）"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+@atexit.register
+def _shutdown_process_pool():
+    _reset_process_pool()
+
+def iter_load_results(paths, known_entries=None):
+    """
+    複数ファイルを並列で読み込み、完了した順に結果を返すジェネレーター
+
+    ファイル単位の処理はスレッドで行い、PDFのページ抽出（CPU処理）は
+    ページ範囲に分割してプロセスプールで並列実行する。
+    プロセスプールが使えない環境ではスレッド内で逐次抽出する。
+
+    Args:
+        paths: 読み込むファイルパスのリスト（リスト内の位置が original_order になる）
+        known_entries: {ファイル名: マニフェストエントリ}（変更のないファイルのみ）
+
+    Yields:
+        load_single_file の結果辞書
+    """
+    if not paths:
+        return
+
+    process_pool = None
+    if any(path.endswith('.pdf') for path in paths):
+        try:
+            process_pool = _get_process_pool()
+        except (OSError, RuntimeError, NotImplementedError) as e:
+            print(f"⚠️ プロセスプールが使えないためスレッドで処理します: {type(e).__name__}")
+
+    known_entries = known_entries or {}
+    jobs = [(path, num) for num, path in enumerate(paths)]
+    # 20ページ未満のPDFはプロセスプールの1タスクなので、スレッド数がプロセス数より少ないと
+    # 同時に抽出されるPDFがスレッド数で頭打ちになりコア数まで使えない
+    thread_workers = FILE_THREAD_WORKERS if process_pool is None else max(FILE_THREAD_WORKERS, PDF_PROCESS_WORKERS)
+    with ThreadPoolExecutor(max_workers=min(thread_workers, len(jobs))) as thread_pool:
+        futures = [
+            thread_pool.submit(load_single_file, job, process_pool, known_entries.get(os.path.basename(job[0])))
+            for job in jobs
+        ]
+        for future in as_completed(futures):
+            yield future.result()
@@ -1,7 +1,13 @@
 import os
+import time
+import shutil
+import tempfile
 import fitz  # PyMuPDF
 from pathlib import Path
 import hashlib
+import codecs
+import functools
+import mmap
 import re
 
 # Maximum file size: 100MB (より多くのファイルに対応)
@@ -10,6 +16,124 @@ MAX_FILE_SIZE = 100 * 1024 * 1024
 # 許可される拡張子
 ALLOWED_EXTENSIONS = {'.pdf', '.txt'}
 
+# アップロードファイルの実体を内容ハッシュで1回だけ保存する場所
+# （先頭が "." なのでカテゴリ一覧には表示しない）
+BLOB_DIR = Path("data/.blobs")
+
+# アップロードを読み書きするチャンクサイズ: 1MB（メモリ使用量を一定に保つ）
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# ファイルの中身の形式チェック用（先頭バイト）
+PDF_MAGIC = b"%PDF-"
+BINARY_SIGNATURES = (b"%PDF-", b"PK\x03\x04", b"\x7fELF", b"MZ", b"\x89PNG", b"\xff\xd8\xff", b"GIF8")
+
+# PDFの最大処理ページ数
+MAX_PDF_PAGES = 100
+
+# TXTファイルを「ページ」として扱うチャンクの文字数
+TEXT_CHUNK_CHARS = 4000
+
+# 文字コード判定に使う先頭サンプルのサイズと、メモリマップで読み込むファイルサイズ
+ENCODING_SAMPLE_SIZE = 64 * 1024
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# ページ範囲並列抽出: 1範囲あたりのページ数と、分割を始めるページ数
+PAGE_RANGE_SIZE = 10
+PARALLEL_PAGE_THRESHOLD = 20
+
+# 抽出処理のバージョン（抽出ロジックを変えたら上げる → 古いキャッシュは使われなくなる）
+EXTRACTOR_VERSION = 2
+
+def compute_file_hash(file_path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    ファイル内容のSHA-256ハッシュを計算（大きいファイルも分割して読み込む）
+    
+    Args:
+        file_path: ハッシュを計算するファイルのパス
+        chunk_size: 1回に読み込むバイト数
+    
+    Returns:
+        16進数のハッシュ文字列
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# 講義番号のパターン（優先度順: 先に書いたものが優先）
+LECTURE_NUMBER_PATTERNS = [
+    r'第(\d+)回',           # 第1回、第2回
+    r'第(\d+)講',           # 第1講、第2講
+    r'lecture[\s_-]*(\d+)',  # lecture1, lecture_1, lecture-1
+    r'lec[\s_-]*(\d+)',      # lec1, lec_1
+    r'class[\s_-]*(\d+)',    # class1, class_1
+    r'week[\s_-]*(\d+)',     # week1, week_1
+    r'(\d+)回目',           # 1回目、2回目
+    r'(\d+)[\s_-]*(?:st|nd|rd|th)',  # 1st, 2nd, 3rd, 4th
+    r'^(\d+)[\s_\-\.]',     # 先頭の数字: "01.pdf", "1_lecture.pdf"
+]
+
+# 全パターンを1つの正規表現にまとめる（先読みで全位置を1回だけ走査）
+# 各パターンの数字部分を名前付きグループ n0, n1, ... にして、どのパターンが一致したか分かるようにする
+_LECTURE_NUMBER_REGEX = re.compile(
+    "(?=(?:" + "|".join(
+        pattern.replace(r'(\d+)', f'(?P<n{index}>\\d+)', 1)
+        for index, pattern in enumerate(LECTURE_NUMBER_PATTERNS)
+    ) + "))"
+)
+
+# 見つからない場合の講義番号（最後にソート）
+UNKNOWN_LECTURE_NUMBER = 999
+
+def _scan_lecture_number(text: str):
+    """
+    1回の走査で、優先度が最も高いパターンの最初の一致を探す
+    
+    Returns:
+        (パターンの番号, 講義番号)。見つからない場合はNone
+    """
+    best = None
+    for match in _LECTURE_NUMBER_REGEX.finditer(text):
+        index = int(match.lastgroup[1:])
+        if best is None or index < best[0]:
+            best = (index, int(match.group(match.lastgroup)))
+            if index == 0:
+                break  # 最優先のパターンが見つかれば終了
+    return best
+
+@functools.lru_cache(maxsize=4096)
+def _match_lecture_number_cached(filename: str, content_head: str):
+    # ファイル名から検索
+    found = _scan_lecture_number(filename.lower())
+    if found:
+        return found[1], LECTURE_NUMBER_PATTERNS[found[0]], "filename"
+    
+    # 内容から検索（最初の500文字のみ）
+    if content_head:
+        found = _scan_lecture_number(content_head)
+        if found:
+            return found[1], LECTURE_NUMBER_PATTERNS[found[0]], "content"
+    
+    return UNKNOWN_LECTURE_NUMBER, None, None
+
+def match_lecture_number(filename: str, content: str = ""):
+    """
+    ファイル名または内容から講義番号を抽出し、どのパターンで一致したかも返す
+    
+    Args:
+        filename: ファイル名
+        content: ファイル内容（オプション・最初の500文字のみ使用）
+    
+    Returns:
+        (講義番号, 一致したパターン, "filename" または "content") のタプル
+        見つからない場合は (999, None, None)
+    """
+    return _match_lecture_number_cached(filename, content[:500] if content else "")
+
 def extract_lecture_number(filename: str, content: str = "") -> int:
     """
     ファイル名または内容から講義番号を抽出
@@ -21,42 +145,19 @@ def extract_lecture_number(filename: str, content: str = "") -> int:
     Returns:
         講義番号（見つからない場合は999を返して最後にソート）
     """
-    # ファイル名から検索するパターン
-    patterns = [
-        r'第(\d+)回',           # 第1回、第2回
-        r'第(\d+)講',           # 第1講、第2講
-        r'lecture[\s_-]*(\d+)',  # lecture1, lecture_1, lecture-1
-        r'lec[\s_-]*(\d+)',      # lec1, lec_1
-        r'class[\s_-]*(\d+)',    # class1, class_1
-        r'week[\s_-]*(\d+)',     # week1, week_1
-        r'(\d+)回目',           # 1回目、2回目
-        r'(\d+)[\s_-]*(?:st|nd|rd|th)',  # 1st, 2nd, 3rd, 4th
-        r'^(\d+)[\s_\-\.]',     # 先頭の数字: "01.pdf", "1_lecture.pdf"
-    ]
+    return match_lecture_number(filename, content)[0]
+
+def extract_lecture_numbers(items) -> list:
+    """
+    複数の資料の講義番号をまとめて抽出（ファイル名と内容ごとに結果をキャッシュ）
     
-    # ファイル名から検索
-    filename_lower = filename.lower()
-    for pattern in patterns:
-        match = re.search(pattern, filename_lower)
-        if match:
-            try:
-                return int(match.group(1))
-            except (ValueError, IndexError):
-                pass
+    Args:
+        items: 'source' と 'content' を持つ辞書のリスト
     
-    # 内容から検索（最初の500文字のみ）
-    if content:
-        content_head = content[:500]
-        for pattern in patterns:
-            match = re.search(pattern, content_head)
-            if match:
-                try:
-                    return int(match.group(1))
-                except (ValueError, IndexError):
-                    pass
-    
-    # 見つからない場合は999を返す（最後にソート）
-    return 999
+    Returns:
+        講義番号のリスト（items と同じ順序）
+    """
+    return [extract_lecture_number(item['source'], item.get('content', '')) for item in items]
 
 def sanitize_filename(filename: str) -> str:
     """
@@ -95,11 +196,109 @@ def validate_file(uploaded_file, category):
     
     return True
 
+def _blob_path(content_hash: str, file_ext: str) -> Path:
+    """内容ハッシュからブロブの保存先を決める（先頭2文字でディレクトリを分散）"""
+    return BLOB_DIR / content_hash[:2] / f"{content_hash}{file_ext}"
+
+def _link_or_copy(src: Path, dst: Path):
+    """
+    ブロブをカテゴリのディレクトリに配置（ハードリンク、使えない場合はコピー）
+    一時ファイルを作ってから置き換えるので、途中の状態のファイルは見えない
+    """
+    tmp_path = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)  # ハードリンク非対応のファイルシステム
+    os.replace(tmp_path, dst)
+
+def _iter_upload_chunks(uploaded_file, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """アップロードファイルを先頭から固定サイズのチャンクで読み出す"""
+    uploaded_file.seek(0)
+    while True:
+        chunk = uploaded_file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def _validate_magic_bytes(first_chunk: bytes, file_ext: str):
+    """
+    先頭チャンクから中身の形式を検証（拡張子だけを偽装したファイルを防ぐ）
+    """
+    if file_ext == '.pdf':
+        # PDFヘッダーは先頭1024バイト以内にある
+        if PDF_MAGIC not in first_chunk[:1024]:
+            raise ValueError("❌ PDFファイルの形式ではありません（ファイルの中身を確認してください）")
+    else:
+        # UTF-16のテキストはNULバイトを含むのでBOMがあれば許可
+        if first_chunk.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return
+        if first_chunk.startswith(BINARY_SIGNATURES) or b"\x00" in first_chunk:
+            raise ValueError("❌ テキストファイルの形式ではありません（バイナリデータが含まれています）")
+
+def _check_upload_size(total_size: int):
+    """宣言サイズではなく実際に読み出したバイト数で上限を確認"""
+    if total_size > MAX_FILE_SIZE:
+        raise ValueError(f"❌ ファイルサイズが大きすぎます ({total_size / 1024 / 1024:.1f}MB以上 > 100MB)")
+
+def _hash_upload(uploaded_file, file_ext: str) -> str:
+    """
+    アップロードファイルを書き込まずにチャンク単位で読み、検証しながらハッシュを計算
+    
+    Returns:
+        内容のSHA-256（16進数）
+    """
+    sha256 = hashlib.sha256()
+    total_size = 0
+    for index, chunk in enumerate(_iter_upload_chunks(uploaded_file)):
+        if index == 0:
+            _validate_magic_bytes(chunk, file_ext)
+        total_size += len(chunk)
+        _check_upload_size(total_size)
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _write_upload_to_blob(uploaded_file, blob_path: Path, expected_hash: str):
+    """
+    チャンク単位で一時ファイルに書き込みながらハッシュを計算し、
+    内容が一致した場合だけブロブの位置にアトミックに置き換える
+    """
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=blob_path.parent, suffix=".tmp")
+    try:
+        sha256 = hashlib.sha256()
+        total_size = 0
+        with os.fdopen(fd, "wb") as f:
+            for chunk in _iter_upload_chunks(uploaded_file):
+                total_size += len(chunk)
+                _check_upload_size(total_size)
+                sha256.update(chunk)
+                f.write(chunk)
+        
+        if sha256.hexdigest() != expected_hash:
+            raise ValueError("❌ アップロード中にファイルの内容が変化しました。もう一度アップロードしてください。")
+        os.replace(tmp_path, blob_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
 def save_uploaded_file(uploaded_file, category):
     """
     Saves an uploaded file to the data/{category} directory.
+    The content is stored once in a content-addressed blob store
+    (data/.blobs) and the category file is a hardlink to that blob,
+    so identical uploads are neither written nor extracted twice.
+    The upload is read in fixed-size chunks, so memory use stays
+    bounded regardless of the file size.
     Returns the absolute path of the saved file.
     """
+    from . import manifest
+    
     try:
         # セキュリティ検証
         validate_file(uploaded_file, category)
@@ -116,9 +315,31 @@ def save_uploaded_file(uploaded_file, category):
         
         file_path = save_dir / safe_filename
         
-        # ファイル重複チェック（同じ内容のファイルを防ぐ）
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        # 1回目の読み出し: 書き込まずに実際のバイト数・中身の形式を検証しながらハッシュ計算
+        file_ext = Path(safe_filename).suffix.lower()
+        content_hash = _hash_upload(uploaded_file, file_ext)
+        blob_path = _blob_path(content_hash, file_ext)
+        
+        # ファイル重複チェック（同じ内容のブロブがあれば書き込まない）
+        if not blob_path.exists():
+            _write_upload_to_blob(uploaded_file, blob_path, content_hash)
+        
+        # カテゴリ内に同じ内容のファイルが既にあれば何もしない
+        category_manifest = manifest.load_manifest(save_dir)
+        known = category_manifest["files"].get(safe_filename)
+        if file_path.exists():
+            st = file_path.stat()
+            same_file = os.path.samefile(file_path, blob_path)
+            same_content = (known is not None and known.get("hash") == content_hash
+                            and known.get("size") == st.st_size and known.get("mtime") == st.st_mtime)
+            if same_file or same_content:
+                return str(file_path.absolute())
+        
+        _link_or_copy(blob_path, file_path)
+        
+        # マニフェストにハッシュを記録（読み込み時にハッシュを再計算しない）
+        manifest.record_file(category_manifest, file_path, content_hash)
+        manifest.save_manifest(save_dir, category_manifest)
         
         return str(file_path.absolute())
     
@@ -127,74 +348,311 @@ def save_uploaded_file(uploaded_file, category):
     except Exception as e:
         raise ValueError(f"❌ ファイル保存エラー: {str(e)}")
 
-def load_pdf(file_path):
+def cleanup_orphan_blobs(min_age_days: int = 30):
     """
-    Extracts text from a PDF file using PyMuPDF.
-    Handles large files by limiting pages.
-    Optimized for speed.
+    どのカテゴリからも参照されなくなったブロブを削除
+    （ハードリンク数が1 = ブロブストアのみが保持している状態）
+    """
+    if not BLOB_DIR.exists():
+        return
+    
+    now = time.time()
+    for blob_path in BLOB_DIR.glob("*/*"):
+        try:
+            st = blob_path.stat()
+            if st.st_nlink <= 1 and (now - st.st_mtime) / (24 * 3600) > min_age_days:
+                blob_path.unlink()
+        except OSError:
+            pass
+
+def plan_page_ranges(total_pages: int, range_size: int = PAGE_RANGE_SIZE):
+    """
+    ページ数を並列抽出用のページ範囲に分割
+    
+    Args:
+        total_pages: 処理するページ数
+        range_size: 1範囲あたりのページ数
+    
+    Returns:
+        (開始ページ, 終了ページ) のリスト（終了ページは含まない）
+    """
+    return [(start, min(start + range_size, total_pages)) for start in range(0, total_pages, range_size)]
+
+def iter_pdf_pages(file_path, start_page: int = 0, end_page: int = None):
+    """
+    PDFのページを1ページずつ抽出するジェネレーター（全ページをメモリに溜めない）
+    
+    Args:
+        file_path: PDFファイルのパス
+        start_page: 開始ページ（0始まり）
+        end_page: 終了ページ（含まない。Noneなら最大処理ページ数まで）
+    
+    Yields:
+        (ソース名, ページ番号（1始まり）, ページのテキスト) のタプル
+    """
+    source = os.path.basename(str(file_path))
+    doc = fitz.open(file_path)
+    try:
+        if end_page is None:
+            end_page = min(len(doc), MAX_PDF_PAGES)
+        for page_num in range(start_page, end_page):
+            # 高速化: "text"モードのみ使用（レイアウト情報不要）
+            yield source, page_num + 1, doc[page_num].get_text("text")
+    finally:
+        doc.close()
+
+def count_pdf_pages(file_path) -> int:
+    """PDFのページ数を取得（テキストは抽出しない）"""
+    doc = fitz.open(file_path)
+    try:
+        return len(doc)
+    finally:
+        doc.close()
+
+def extract_pdf_page_range(file_path, start_page: int, end_page: int) -> list:
+    """
+    PDFの指定範囲のページからテキストを抽出（並列処理用・ワーカーごとにPDFを開く）
+    
+    Args:
+        file_path: PDFファイルのパス
+        start_page: 開始ページ（0始まり）
+        end_page: 終了ページ（含まない）
+    
+    Returns:
+        範囲内の各ページのテキストのリスト
+    """
+    return [text for _, _, text in iter_pdf_pages(file_path, start_page, end_page)]
+
+def load_pdf_pages(file_path, executor=None):
+    """
+    PDFからページごとのテキストを抽出
+    
+    Args:
+        file_path: PDFファイルのパス
+        executor: ページ範囲を並列抽出するプロセスプール（Noneなら逐次処理）
+    
+    Returns:
+        (全体のテキスト, ページごとのテキストのリスト) のタプル
+        エラー時は (エラーメッセージ, 空リスト)
     """
-    text_content = ""
     try:
         # Check file size first
         file_size = os.path.getsize(file_path)
         if file_size > MAX_FILE_SIZE:
-            return f"⚠️ ファイルサイズが大きすぎます ({file_size / 1024 / 1024:.1f}MB > 100MB)。最初の100ページのみを処理します。"
+            return f"⚠️ ファイルサイズが大きすぎます ({file_size / 1024 / 1024:.1f}MB > 100MB)。最初の100ページのみを処理します。", []
         
         doc = fitz.open(file_path)
         total_pages = len(doc)  # doc.close()前に取得
-        max_pages = min(total_pages, 100)  # Limit to first 100 pages
+        doc.close()  # ページ抽出は範囲ごとに開き直す
+        max_pages = min(total_pages, MAX_PDF_PAGES)  # Limit to first 100 pages
         
-        # 高速化: テキスト抽出を並列化せず、シンプルに高速モードで実行
-        for page_num in range(max_pages):
-            page = doc[page_num]
-            # 高速化: "text"モードのみ使用（レイアウト情報不要）
-            text_content += page.get_text("text") + "\n"
+        pages = None
+        if executor is not None:
+            # 大きいPDFはページ範囲に分割して並列抽出（小さいPDFは1範囲 = 1タスク）
+            if max_pages >= PARALLEL_PAGE_THRESHOLD:
+                page_ranges = plan_page_ranges(max_pages)
+            else:
+                page_ranges = [(0, max_pages)]
+            try:
+                futures = [executor.submit(extract_pdf_page_range, file_path, start, end) for start, end in page_ranges]
+                pages = [page for future in futures for page in future.result()]  # ページ順に結合
+            except Exception as e:
+                print(f"⚠️ 並列抽出に失敗したため逐次処理します: {type(e).__name__}")
+                pages = None
         
-        doc.close()  # メモリ解放（高速化）
+        if pages is None:
+            pages = extract_pdf_page_range(file_path, 0, max_pages)
         
-        if total_pages > 100:
-            text_content += f"\n\n[注記: {total_pages - 100}ページ以降は処理されていません。]"
+        # 最後に1回だけ結合
+        text_content = "".join(page + "\n" for page in pages)
         
-        return text_content
+        if total_pages > MAX_PDF_PAGES:
+            text_content += f"\n\n[注記: {total_pages - MAX_PDF_PAGES}ページ以降は処理されていません。]"
+        
+        return text_content, pages
     except Exception as e:
-        return f"Error reading PDF: {str(e)}"
+        return f"Error reading PDF: {str(e)}", []
+
+def load_pdf(file_path, executor=None):
+    """
+    Extracts text from a PDF file using PyMuPDF.
+    Handles large files by limiting pages.
+    If an executor (e.g. a process pool) is given, page ranges are
+    extracted in parallel and stitched back together in page order.
+    """
+    return load_pdf_pages(file_path, executor)[0]
+
+def split_text_chunks(text: str, chunk_chars: int = TEXT_CHUNK_CHARS) -> list:
+    """
+    テキストを行単位のチャンクに分割（TXTファイルの「ページ」として使う）
+
+    要約の分割と同じ処理を文字数で使う（行の途中では切らない）。
+    """
+    from . import token_budget
+    return token_budget.split_to_budget(text, chunk_chars, measure=len)
+
+def iter_text_chunks(file_path, chunk_chars: int = TEXT_CHUNK_CHARS):
+    """
+    テキストファイルを行単位のチャンクに分けて逐次読み込むジェネレーター（ファイル全体をメモリに載せない）
+    
+    文字コードは load_text と同じく先頭のサンプルで判定し、最大 MAX_FILE_SIZE バイトまで読む。
+    チャンクはファイル全体を split_text_chunks で分けた場合と同じになる。
+    
+    Args:
+        file_path: テキストファイルのパス
+        chunk_chars: 1チャンクの最大文字数
+    
+    Yields:
+        (ソース名, チャンク番号（1始まり）, チャンクのテキスト) のタプル
+    """
+    source = os.path.basename(str(file_path))
+    with open(file_path, "rb") as f:
+        encoding = detect_encoding(f.read(ENCODING_SAMPLE_SIZE))
+        f.seek(0)
+        # 読めないバイトは load_text と同じく置換文字にする
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        remaining = MAX_FILE_SIZE  # バイト数で制限
+        pending = ""
+        chunk_no = 0
+        while remaining > 0:
+            block = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not block:
+                # 最後まで読んだ（途切れた文字があれば置換文字として出す）
+                pending += decoder.decode(b"", final=True)
+                break
+            remaining -= len(block)
+            chunks = split_text_chunks(pending + decoder.decode(block), chunk_chars)
+            # 最後のチャンクは続きの行とまとまる可能性があるので次のブロックに持ち越す
+            for chunk in chunks[:-1]:
+                chunk_no += 1
+                yield source, chunk_no, chunk
+            pending = chunks[-1] if chunks else ""
+        
+        for chunk in split_text_chunks(pending, chunk_chars):
+            chunk_no += 1
+            yield source, chunk_no, chunk
+
+def load_document(file_path, executor=None):
+    """
+    PDF/TXTファイルを読み込み、全体のテキストとページ（TXTはチャンク）を返す
+    
+    TXTのチャンクはファイルを読み直すジェネレーター（ページストアへの登録時に逐次読み込む）。
+    
+    Returns:
+        (全体のテキスト, ページごとのテキストのリスト（TXTはジェネレーター）) のタプル
+    """
+    if str(file_path).endswith('.pdf'):
+        return load_pdf_pages(file_path, executor)
+    
+    content = load_text(file_path)
+    if not content or "Error" in content[:50]:
+        return content, []
+    return content, (text for _, _, text in iter_text_chunks(file_path))
+
+def _japanese_score(text: str) -> float:
+    """
+    デコード結果が自然な日本語/英語テキストらしいかを採点（高いほど自然）
+    
+    EUC-JPのバイト列をCP932として読むと半角カナが大量に出るため、半角カナは減点する。
+    """
+    if not text:
+        return 0.0
+    natural = 0
+    halfwidth_kana = 0
+    for ch in text:
+        if ch < '\x80' or '\u3040' <= ch <= '\u30ff' or '\u4e00' <= ch <= '\u9fff' or '\u3000' <= ch <= '\u303f':
+            natural += 1
+        elif '\uff61' <= ch <= '\uff9f':
+            halfwidth_kana += 1
+    return (natural - 3 * halfwidth_kana) / len(text)
+
+def detect_encoding(data, sample_size: int = ENCODING_SAMPLE_SIZE) -> str:
+    """
+    バイト列の先頭サンプルから文字コードを判定（BOM → UTF-8 → 日本語の統計的判定）
+    
+    Args:
+        data: 判定するバイト列（bytes / memoryview / mmap）
+        sample_size: 判定に使う先頭のバイト数
+    
+    Returns:
+        判定した文字コード名
+    """
+    sample = memoryview(data)[:sample_size]
+    head = bytes(sample[:4])
+    
+    # BOM付きファイル
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    
+    # UTF-8として正しければUTF-8（ASCIIのみのファイルも含む）
+    # サンプル末尾で途切れたマルチバイト文字はエラーにしない
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    
+    # 日本語の文字コード候補をサンプルで試し、最も自然なものを選ぶ
+    best_encoding = None
+    best_score = None
+    for enc in ['cp932', 'euc-jp']:  # CP932はShift-JISの上位互換
+        try:
+            text = codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        score = _japanese_score(text)
+        if best_score is None or score > best_score:
+            best_encoding, best_score = enc, score
+    
+    # どれにも当てはまらない場合はLatin-1（どのバイト列でもデコード可能）
+    return best_encoding or 'latin-1'
+
+def _decode_buffer(data, encoding: str, truncated: bool) -> str:
+    """
+    バッファを1回だけデコード（途中で切り詰めた場合は末尾の途切れた文字を捨てる）
+    """
+    try:
+        return codecs.getincrementaldecoder(encoding)().decode(data, final=not truncated)
+    except UnicodeDecodeError:
+        # サンプル以降に不正なバイトがある場合は置換文字で読み込む
+        print(f"⚠️ 文字コード {encoding} で読めない箇所があるため置換して読み込みます")
+        return codecs.getincrementaldecoder(encoding)(errors="replace").decode(data, final=not truncated)
 
 def load_text(file_path):
     """
     Reads text from a text file.
-    Automatically detects encoding (UTF-8, Shift-JIS, etc.)
+    The file is read from disk once (memory-mapped when large),
+    the encoding is detected from a sampled prefix (BOM, UTF-8 check,
+    Japanese statistics), and the buffer is decoded once.
     Handles large files by limiting size.
     """
     try:
         file_size = os.path.getsize(file_path)
+        if file_size == 0:
+            return ""
         
-        # Try UTF-8 first
-        def try_read_with_encoding(encoding):
-            try:
-                if file_size > MAX_FILE_SIZE:
-                    with open(file_path, "r", encoding=encoding) as f:
-                        content = f.read(MAX_FILE_SIZE)
-                    return f"⚠️ ファイルサイズが大きすぎます ({file_size / 1024 / 1024:.1f}MB)。最初の{MAX_FILE_SIZE / 1024 / 1024:.0f}MBのみを処理します。\n\n{content}"
-                else:
-                    with open(file_path, "r", encoding=encoding) as f:
-                        return f.read()
-            except (UnicodeDecodeError, LookupError):
-                return None
-        
-        # 複数のエンコーディングを優先度順に試行（日本語ファイル対応）
-        encodings = ['utf-8', 'shift-jis', 'cp932', 'euc-jp', 'iso-8859-1', 'latin-1']
-        for enc in encodings:
-            result = try_read_with_encoding(enc)
-            if result is not None:
-                return result  # 成功したエンコーディングで読み込み完了
-        
-        # If all fail, use UTF-8 with error handling
-        if file_size > MAX_FILE_SIZE:
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read(MAX_FILE_SIZE)
+        truncated = file_size > MAX_FILE_SIZE
+        read_size = min(file_size, MAX_FILE_SIZE)
+        
+        with open(file_path, "rb") as f:
+            if file_size >= MMAP_THRESHOLD:
+                # 大きいファイルはメモリマップ（ディスクからの読み込みは1回・コピーなし）
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    view = memoryview(mm)[:read_size]
+                    try:
+                        encoding = detect_encoding(view)
+                        content = _decode_buffer(view, encoding, truncated)
+                    finally:
+                        view.release()
+            else:
+                data = f.read(read_size)
+                encoding = detect_encoding(data)
+                content = _decode_buffer(data, encoding, truncated)
+        
+        if truncated:
             return f"⚠️ ファイルサイズが大きすぎます ({file_size / 1024 / 1024:.1f}MB)。最初の{MAX_FILE_SIZE / 1024 / 1024:.0f}MBのみを処理します。\n\n{content}"
-        else:
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                return f.read()
+        return content
     except Exception as e:
         return f"Error reading text file: {str(e)}"
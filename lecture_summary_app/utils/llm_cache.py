@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import threading
+from pathlib import Path
+
+from . import disk_store
+
+# 応答キャッシュの保存先（data/ 配下に置くとカテゴリ一覧に表示されてしまうため別ディレクトリ）
+CACHE_DIR = Path(".cache/llm")
+
+# キャッシュ全体の最大サイズ: 100MB（超えた分は古い順に削除）
+MAX_CACHE_SIZE = 100 * 1024 * 1024
+
+# キャッシュの有効期限: 7日（資料が同じでもモデルの更新で回答は変わり得るため）
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# キーの形式のバージョン（プロンプトの正規化方法やキーに含める項目を変えたら上げる）
+CACHE_KEY_VERSION = 2
+
+# 環境変数 LLM_CACHE_DISABLED=1 でサーバー全体のキャッシュを無効にする（起動時に決まり、実行中は変えない）
+# セッションごとの切り替えは llm_client.invoke 等の use_cache 引数で行う
+ENABLED = os.environ.get("LLM_CACHE_DISABLED", "") not in ("1", "true", "True")
+
+_stats = {"hits": 0, "misses": 0, "writes": 0}
+_stats_lock = threading.Lock()
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    プロンプトを正規化（インデントや行末の空白・空行の違いで別エントリにしない）
+    """
+    lines = [re.sub(r"[ \t　]+", " ", line).strip() for line in str(prompt).splitlines()]
+    return "\n".join(line for line in lines if line)
+
+def make_key(provider: str, model: str, temperature, prompt: str, settings=None) -> str:
+    """
+    キャッシュキーを作成（プロバイダ・モデル・temperature・生成パラメータ・正規化したプロンプトのハッシュ）
+
+    Args:
+        settings: 応答を変えるその他の生成パラメータの辞書（最大出力トークン数等。Noneは空と同じ）
+    """
+    payload = json.dumps(
+        [CACHE_KEY_VERSION, provider, model, temperature, sorted((settings or {}).items()), normalize_prompt(prompt)],
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _entry_path(key: str) -> Path:
+    return CACHE_DIR / f"{key}.json.z"
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+def get(key: str, ttl: float = CACHE_TTL_SECONDS):
+    """
+    キャッシュ済みの応答を取得
+
+    Returns:
+        応答テキスト（存在しない・期限切れ・キャッシュ無効の場合はNone）
+    """
+    if not ENABLED:
+        return None
+
+    path = _entry_path(key)
+    try:
+        with open(path, "rb") as f:
+            entry = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+    except (OSError, zlib.error, ValueError):
+        _count("misses")
+        return None
+
+    if time.time() - entry.get("created", 0) > ttl:
+        # 期限切れは削除して取り直す
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        _count("misses")
+        return None
+
+    disk_store.touch(path)  # LRU: 最終利用時刻として更新
+    _count("hits")
+    return entry.get("content")
+
+def put(key: str, content: str):
+    """
+    応答をキャッシュに保存（上限を超えた場合は古いものから削除）
+    """
+    if not ENABLED or not content:
+        return
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        entry = json.dumps({"created": time.time(), "content": content}, ensure_ascii=False)
+        disk_store.atomic_write(_entry_path(key), zlib.compress(entry.encode("utf-8"), 6))
+        _count("writes")
+
+        evict_cache()
+    except OSError as e:
+        print(f"⚠️ 応答キャッシュ保存エラー: {type(e).__name__}")
+
+def evict_cache(max_size: int = MAX_CACHE_SIZE, ttl: float = CACHE_TTL_SECONDS):
+    """
+    期限切れのエントリを削除し、合計サイズが上限を超えている場合は最終利用が古い順に削除
+    """
+    # 最終利用から期限以上経過したものは作成日時に関係なく期限切れ
+    disk_store.evict(CACHE_DIR, "*.json.z", max_size, ttl)
+
+def clear_cache():
+    """キャッシュをすべて削除"""
+    disk_store.clear(CACHE_DIR, "*.json.z")
+
+def get_stats() -> dict:
+    """
+    ヒット・ミス数を取得（プロセス起動からの累計）
+
+    Returns:
+        {"hits", "misses", "writes", "hit_rate"} の辞書
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+def reset_stats():
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+from . import llm_cache, rate_limiter, providers
+
+# プロバイダごとの既定のモデル
+DEFAULT_MODELS = {
+    "gemini": "gemini-2.0-flash-exp",
+    "openai": "gpt-3.5-turbo",
+    "local": "local-extract",
+}
+
+# 応答を変える生成パラメータ（キャッシュキーに含める。最大出力トークン数は OpenAI が max_tokens、Gemini が max_output_tokens）
+GENERATION_PARAMS = (
+    "max_tokens", "max_output_tokens", "top_p", "top_k", "n", "stop",
+    "presence_penalty", "frequency_penalty", "seed",
+)
+
+# 使い回すクライアントの最大数（古いものから破棄）
+MAX_POOLED_CLIENTS = 32
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+# イベントループの中で作成したクライアント（非同期のHTTPセッションは最初に使ったループに結び付くため、
+# ループごとに分けて使い回す。ループが破棄されるとそのループのクライアントも破棄される）
+_loop_clients = weakref.WeakKeyDictionary()
+
+# run_async で使う共有のイベントループ（専用のスレッドで動かし続ける）
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+def _current_pool() -> OrderedDict:
+    """
+    現在のスレッドで使うクライアントのプール（_clients_lock を取得した状態で呼ぶ）
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _clients
+    pool = _loop_clients.get(loop)
+    if pool is None:
+        pool = _loop_clients[loop] = OrderedDict()
+    return pool
+
+def get_llm(provider, api_key, model=None, temperature=0.3, max_tokens=None):
+    """
+    チャットモデルを取得（同じ条件のクライアントは使い回し、HTTP接続も再利用される）
+
+    APIキーは環境変数を経由せずクライアントに直接渡すため、
+    複数のユーザーが同時に使っても互いのキーを上書きしない。
+
+    イベントループの中で呼び出した場合は、そのループ専用のクライアントを返す（answer_many 等の非同期の呼び出し用）。
+
+    Args:
+        provider: 'gemini' / 'openai' / 'local' など providers に登録済みのプロバイダ
+        api_key: APIキー
+        model: モデル名（省略時はプロバイダの既定のモデル）
+        temperature: 温度
+        max_tokens: 最大出力トークン数（Noneなら制限なし）
+
+    Returns:
+        LangChain のチャットモデル
+    """
+    model = model or DEFAULT_MODELS.get(provider, DEFAULT_MODELS["gemini"])
+    # キーそのものではなくハッシュで識別する
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+    pool_key = (provider, key_hash, model, temperature, max_tokens)
+
+    with _clients_lock:
+        pool = _current_pool()
+        llm = pool.get(pool_key)
+        if llm is not None:
+            pool.move_to_end(pool_key)
+            return llm
+
+    llm = providers.create_llm(provider, api_key, model, temperature, max_tokens)
+    with _clients_lock:
+        # 同時に作成された場合は先に登録されたものを使う
+        llm = pool.setdefault(pool_key, llm)
+        pool.move_to_end(pool_key)
+        while len(pool) > MAX_POOLED_CLIENTS:
+            pool.popitem(last=False)
+    return llm
+
+def clear_clients():
+    """使い回しているクライアントをすべて破棄"""
+    with _clients_lock:
+        _clients.clear()
+        _loop_clients.clear()
+
+def run_async(coro):
+    """
+    同期のコード（Streamlit のセッションのスレッド等）からコルーチンを実行して結果を返す
+
+    呼び出しのたびに asyncio.run で新しいループを作ると、前のループで作ったクライアントの
+    HTTPセッションが閉じたループに残るため、共有のイベントループ1つで実行し続ける。
+    """
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            threading.Thread(target=_shared_loop.run_forever, name="llm-async", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _shared_loop).result()
+
+def model_name(llm) -> str:
+    """チャットモデルのモデル名（ChatOpenAI は model_name、Gemini は model）"""
+    return str(getattr(llm, "model_name", None) or getattr(llm, "model", "") or "")
+
+def api_key_of(llm) -> str:
+    """チャットモデルに設定されたAPIキー（レート制限をキーごとに共有するため）"""
+    for name in ("google_api_key", "openai_api_key", "api_key"):
+        value = getattr(llm, name, None)
+        if value is not None:
+            return value.get_secret_value() if hasattr(value, "get_secret_value") else str(value)
+    return ""
+
+def generation_settings(llm) -> dict:
+    """
+    チャットモデルの応答を変える生成パラメータ（設定されているものだけ）
+
+    出力の上限が小さいときに途中で切れた応答を、上限の大きい呼び出しに返さないためにキャッシュキーに含める。
+    """
+    settings = {name: getattr(llm, name, None) for name in GENERATION_PARAMS}
+    settings.update(getattr(llm, "output_settings", None) or {})
+    return {name: value for name, value in settings.items() if value is not None}
+
+def _cache_key(llm, prompt, provider) -> str:
+    return llm_cache.make_key(
+        provider, model_name(llm), getattr(llm, "temperature", None), prompt, generation_settings(llm)
+    )
+
+def invoke(llm, prompt, provider, use_cache=True, api_key=None, max_retries=rate_limiter.MAX_RETRIES):
+    """
+    LLMを呼び出して応答テキストを返す（同じ条件の呼び出しはキャッシュから返す）
+
+    キャッシュのキーはプロバイダ・モデル・temperature・生成パラメータ・正規化したプロンプトから作る。
+    APIの呼び出しはプロバイダ + APIキーごとの共有リミッターを通し、
+    レート制限の場合は Retry-After に従って待機してから再試行する。
+    それ以外のAPIのエラーと、再試行しても429の場合は例外をそのまま送出する。
+
+    Args:
+        llm: LangChain のチャットモデル
+        prompt: プロンプト
+        provider: 'gemini' / 'openai' / 'local'
+        use_cache: False の場合はキャッシュを使わずに必ずAPIを呼び出す（セッションごとの設定を渡す）
+        api_key: リミッターの識別に使うAPIキー（省略時は llm から取得）
+        max_retries: レート制限時の最大試行回数
+
+    Returns:
+        応答テキスト
+    """
+    use_cache = use_cache and llm_cache.ENABLED
+    if use_cache:
+        key = _cache_key(llm, prompt, provider)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+    if api_key is None:
+        api_key = api_key_of(llm)
+    response = rate_limiter.call_with_limits(provider, api_key, lambda: llm.invoke(prompt), max_retries)
+    content = response.content
+
+    if use_cache:
+        llm_cache.put(key, content)
+    return content
+
+async def _ainvoke_model(llm, prompt):
+    """チャットモデルの非同期呼び出し（ainvoke が無いモデルは別スレッドで invoke）"""
+    if hasattr(llm, "ainvoke"):
+        return await llm.ainvoke(prompt)
+    return await asyncio.to_thread(llm.invoke, prompt)
+
+async def ainvoke(llm, prompt, provider, use_cache=True, api_key=None, max_retries=rate_limiter.MAX_RETRIES):
+    """
+    invoke の非同期版（キャッシュ・プロバイダ + APIキーごとのリミッターは同期の呼び出しと共有）
+
+    Args:
+        invoke と同じ
+
+    Returns:
+        応答テキスト
+    """
+    use_cache = use_cache and llm_cache.ENABLED
+    if use_cache:
+        key = _cache_key(llm, prompt, provider)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+    if api_key is None:
+        api_key = api_key_of(llm)
+    response = await rate_limiter.call_with_limits_async(
+        provider, api_key, lambda: _ainvoke_model(llm, prompt), max_retries
+    )
+    content = response.content
+
+    if use_cache:
+        llm_cache.put(key, content)
+    return content
+
+def _chunk_text(chunk) -> str:
+    """ストリーミングの断片からテキストを取り出す（Gemini は content がリストの場合がある）"""
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+    return content or ""
+
+def stream(llm, prompt, provider, use_cache=True, api_key=None, max_retries=rate_limiter.MAX_RETRIES):
+    """
+    LLMをストリーミングで呼び出し、応答テキストを断片ごとに返すジェネレーター
+
+    キャッシュ済みの場合は全文を1つの断片として返す。最後まで受信した応答だけをキャッシュする。
+    レート制限は最初の断片を受け取る前に限り、invoke と同じく待機して再試行する。
+
+    Args:
+        invoke と同じ
+
+    Yields:
+        応答テキストの断片
+    """
+    use_cache = use_cache and llm_cache.ENABLED
+    if use_cache:
+        key = _cache_key(llm, prompt, provider)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    if api_key is None:
+        api_key = api_key_of(llm)
+    limiter = rate_limiter.get_limiter(provider, api_key)
+    for attempt in range(max_retries):
+        chunks = []
+        with limiter.slot():
+            try:
+                for chunk in llm.stream(prompt):
+                    text = _chunk_text(chunk)
+                    if text:
+                        chunks.append(text)
+                        yield text
+            except Exception as e:
+                # 途中まで表示した応答はやり直せないので、そのままエラーにする
+                if chunks or not rate_limiter.is_rate_limit_error(e):
+                    raise
+                wait = limiter.on_rate_limited(rate_limiter.parse_retry_after(e))
+                if attempt >= max_retries - 1:
+                    raise
+                print(f"⏳ レート制限: {wait:.0f}秒待機中... (試行 {attempt+1}/{max_retries})")
+                continue
+        limiter.on_success()
+        if use_cache:
+            llm_cache.put(key, "".join(chunks))
+        return
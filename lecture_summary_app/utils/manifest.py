@@ -0,0 +1,155 @@
+import os
+import json
+import time
+from pathlib import Path
+
+from . import disk_store
+
+# マニフェストのファイル名（先頭が "." なので glob("data/{category}/*") には含まれない）
+MANIFEST_FILENAME = ".manifest.json"
+
+# マニフェスト形式のバージョン
+MANIFEST_VERSION = 1
+
+# 読込時間の推定値（秒）: 新規・変更ファイルは1ファイルあたり、変更なしはキャッシュから読むだけ
+SECONDS_PER_CHANGED_FILE = 1.0
+SECONDS_PER_UNCHANGED_FILE = 0.05
+
+def _manifest_path(category_dir) -> Path:
+    return Path(category_dir) / MANIFEST_FILENAME
+
+def load_manifest(category_dir) -> dict:
+    """
+    カテゴリのマニフェストを読み込む（存在しない・壊れている場合は空のマニフェスト）
+
+    Args:
+        category_dir: カテゴリのディレクトリ（data/{category}）
+
+    Returns:
+        {"version": int, "files": {ファイル名: エントリ}} の辞書
+    """
+    try:
+        with open(_manifest_path(category_dir), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION and isinstance(manifest.get("files"), dict):
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "files": {}}
+
+def save_manifest(category_dir, manifest: dict):
+    """
+    マニフェストを保存（一時ファイルに書いてから置き換え）
+    """
+    path = _manifest_path(category_dir)
+    if not path.parent.exists():
+        return
+    try:
+        disk_store.atomic_write(path, json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"))
+    except OSError as e:
+        print(f"⚠️ マニフェスト保存エラー: {type(e).__name__}")
+
+def diff_directory(category_dir, manifest: dict) -> dict:
+    """
+    ディレクトリの現在の状態とマニフェストを比較（ファイルは開かず stat のみ）
+
+    サイズと更新日時が一致するファイルは「変更なし」とみなす。
+
+    Returns:
+        paths: 現在のファイルパス一覧（名前順）
+        new / changed / unchanged: ファイル名のリスト
+        removed: マニフェストにあるが削除されたファイル名のリスト
+    """
+    category_dir = Path(category_dir)
+    entries = manifest.get("files", {})
+    result = {"paths": [], "new": [], "changed": [], "unchanged": [], "removed": []}
+
+    if not category_dir.exists():
+        result["removed"] = list(entries)
+        return result
+
+    current = {}
+    with os.scandir(category_dir) as it:
+        for entry in it:
+            # 隠しファイル（マニフェスト等）とサブディレクトリは対象外
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            current[entry.name] = entry.stat()
+
+    for name in sorted(current):
+        st = current[name]
+        result["paths"].append(os.path.join(str(category_dir), name))
+        known = entries.get(name)
+        if known is None:
+            result["new"].append(name)
+        elif known.get("size") == st.st_size and known.get("mtime") == st.st_mtime:
+            result["unchanged"].append(name)
+        else:
+            result["changed"].append(name)
+
+    result["removed"] = [name for name in entries if name not in current]
+    return result
+
+def update_entry(manifest: dict, path, result: dict):
+    """
+    読み込み結果でマニフェストのエントリを更新
+
+    Args:
+        manifest: 更新するマニフェスト
+        path: ファイルのパス
+        result: extractor.load_single_file の成功結果（hash / pages / content / order）
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    manifest.setdefault("files", {})[os.path.basename(path)] = {
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "hash": result["hash"],
+        "pages": result.get("pages"),
+        "chars": len(result["content"]),
+        "lecture_number": result["order"],
+        "updated": time.time(),
+    }
+
+def record_file(manifest: dict, path, content_hash: str):
+    """
+    保存したファイルのハッシュだけを記録（講義番号・ページ数は読み込み時に補完）
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    manifest.setdefault("files", {})[os.path.basename(path)] = {
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "hash": content_hash,
+        "updated": time.time(),
+    }
+
+def prune_entries(manifest: dict, names):
+    """削除されたファイルのエントリをマニフェストから取り除く"""
+    files = manifest.get("files", {})
+    for name in names:
+        files.pop(name, None)
+
+def known_entries(manifest: dict, changes: dict) -> dict:
+    """
+    変更のないファイルのエントリだけを返す（これらは再ハッシュ・再抽出しない）
+    """
+    files = manifest.get("files", {})
+    return {name: files[name] for name in changes["unchanged"] if name in files}
+
+def estimate_load_seconds(changes: dict, manifest: dict = None) -> int:
+    """
+    マニフェストとの差分から読込時間を推定（PDFを開かずに計算）
+
+    アップロード時にハッシュだけ記録されたファイル（まだ抽出していない）は変更ありとして数える。
+    """
+    files = (manifest or {}).get("files", {})
+    not_extracted = sum(1 for name in changes["unchanged"] if "chars" not in files.get(name, {"chars": 0}))
+    changed_count = len(changes["new"]) + len(changes["changed"]) + not_extracted
+    unchanged_count = len(changes["unchanged"]) - not_extracted
+    seconds = changed_count * SECONDS_PER_CHANGED_FILE + unchanged_count * SECONDS_PER_UNCHANGED_FILE
+    return max(1, int(seconds + 0.999)) if changes["paths"] else 0
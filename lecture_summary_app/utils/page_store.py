@@ -0,0 +1,309 @@
+import re
+import time
+import zlib
+import sqlite3
+import threading
+from pathlib import Path
+
+# ページストアのデータベース（data/ 配下に置くとカテゴリ一覧に表示されてしまうため別ディレクトリ）
+DB_PATH = Path(".cache/pages.db")
+
+# 検索結果のスニペットの前後の文字数
+SNIPPET_CONTEXT_CHARS = 60
+
+# trigram トークナイザは3文字未満の語を検索できないため、2文字の語は2文字ずつ区切った索引（bigram）で絞り込む
+# （1文字の語だけの検索は索引を使えないため、対象のページをすべて展開して走査する）
+MIN_FTS_TERM_LENGTH = 3
+BIGRAM_TERM_LENGTH = 2
+
+# 保存するページ本文（圧縮後）の合計最大サイズ: 200MB（超えた分は最終利用が古い資料から削除）
+MAX_PAGE_STORE_SIZE = 200 * 1024 * 1024
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+def _connect() -> sqlite3.Connection:
+    """
+    スレッドごとの接続を取得（sqlite3の接続はスレッド間で共有できない）
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "db_path", None) == DB_PATH:
+        return conn
+
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(DB_PATH), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")  # 読み込みと書き込みを並行できるように
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _ensure_schema(conn)
+    _local.conn = conn
+    _local.db_path = DB_PATH
+    return conn
+
+def _ensure_schema(conn: sqlite3.Connection):
+    with _schema_lock:
+        if str(DB_PATH) in _schema_ready:
+            return
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                hash TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                page_count INTEGER NOT NULL,
+                indexed_at REAL NOT NULL,
+                used_at REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                doc_hash TEXT NOT NULL,
+                page_no INTEGER NOT NULL,
+                text BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_doc ON pages (doc_hash, page_no);
+        """)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(documents)")]
+        if "used_at" not in columns:
+            # 以前のバージョンで作成したデータベース（登録日時を最終利用日時とみなす）
+            conn.execute("ALTER TABLE documents ADD COLUMN used_at REAL NOT NULL DEFAULT 0")
+            conn.execute("UPDATE documents SET used_at = indexed_at")
+        try:
+            # 本文は pages に圧縮して保存し、全文検索インデックスだけを持つ（contentless）
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts "
+                "USING fts5(text, content='', tokenize='trigram')"
+            )
+            if not _has_table(conn, "pages_bigram"):
+                conn.execute("CREATE VIRTUAL TABLE pages_bigram USING fts5(text, content='', tokenize='unicode61')")
+                # 登録済みのページも索引に追加（初回のみ）
+                for row_id, blob in conn.execute("SELECT id, text FROM pages").fetchall():
+                    conn.execute("INSERT INTO pages_bigram (rowid, text) VALUES (?, ?)", (row_id, _bigrams(_decompress(blob))))
+        except sqlite3.OperationalError as e:
+            # FTS5 / trigram が使えない SQLite の場合は全文走査で検索する
+            print(f"⚠️ 全文検索インデックスを作成できません（走査検索を使用）: {e}")
+        conn.commit()
+        _schema_ready.add(str(DB_PATH))
+
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row is not None
+
+def _has_fts(conn: sqlite3.Connection) -> bool:
+    return _has_table(conn, "pages_fts") and _has_table(conn, "pages_bigram")
+
+def _bigrams(text: str) -> str:
+    """
+    空白で区切られた語をそれぞれ2文字ずつ重ねて区切る（"確率の例" → "確率 率の の例"）
+
+    bigram 索引に登録するテキスト。2文字の検索語は必ずこのうちの1つと一致する。
+    """
+    return " ".join(
+        word[i:i + BIGRAM_TERM_LENGTH]
+        for word in text.split()
+        for i in range(max(1, len(word) - BIGRAM_TERM_LENGTH + 1))
+    )
+
+def _compress(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8"), 6)
+
+def _decompress(blob: bytes) -> str:
+    return zlib.decompress(blob).decode("utf-8")
+
+def has_document(doc_hash: str) -> bool:
+    """指定したハッシュの資料がページストアに登録済みか（登録済みなら最終利用日時を更新）"""
+    try:
+        conn = _connect()
+        with conn:
+            # LRU: 資料を読み込むたびに呼ばれるので、最終利用時刻として更新
+            cursor = conn.execute("UPDATE documents SET used_at = ? WHERE hash = ?", (time.time(), doc_hash))
+        return cursor.rowcount > 0
+    except sqlite3.Error:
+        return False
+
+def add_document(doc_hash: str, source: str, pages):
+    """
+    資料をページ単位で登録（同じハッシュの資料は内容が同じなので登録済みなら何もしない）
+
+    Args:
+        doc_hash: ファイル内容のSHA-256
+        source: ソース名（ファイル名）
+        pages: ページごとのテキストのリスト（ジェネレーターも可）
+    """
+    try:
+        conn = _connect()
+        with conn:
+            if conn.execute("SELECT 1 FROM documents WHERE hash = ?", (doc_hash,)).fetchone():
+                return
+            use_fts = _has_fts(conn)
+            page_count = 0
+            for page_no, text in enumerate(pages, 1):  # ジェネレーターも可（1ページずつ登録）
+                page_count = page_no
+                cursor = conn.execute(
+                    "INSERT INTO pages (doc_hash, page_no, text) VALUES (?, ?, ?)",
+                    (doc_hash, page_no, _compress(text)),
+                )
+                if use_fts:
+                    conn.execute("INSERT INTO pages_fts (rowid, text) VALUES (?, ?)", (cursor.lastrowid, text))
+                    conn.execute("INSERT INTO pages_bigram (rowid, text) VALUES (?, ?)", (cursor.lastrowid, _bigrams(text)))
+            now = time.time()
+            conn.execute(
+                "INSERT INTO documents (hash, source, page_count, indexed_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                (doc_hash, source, page_count, now, now),
+            )
+    except sqlite3.Error as e:
+        print(f"⚠️ ページストア登録エラー: {type(e).__name__}")
+        return
+    evict_documents(keep=doc_hash)
+
+def remove_document(doc_hash: str):
+    """資料をページストアと全文検索インデックスから削除"""
+    try:
+        conn = _connect()
+        with conn:
+            use_fts = _has_fts(conn)
+            rows = conn.execute("SELECT id, text FROM pages WHERE doc_hash = ?", (doc_hash,)).fetchall()
+            if use_fts:
+                # contentless テーブルは元のテキストを渡して削除する
+                for row_id, blob in rows:
+                    text = _decompress(blob)
+                    conn.execute(
+                        "INSERT INTO pages_fts (pages_fts, rowid, text) VALUES ('delete', ?, ?)",
+                        (row_id, text),
+                    )
+                    conn.execute(
+                        "INSERT INTO pages_bigram (pages_bigram, rowid, text) VALUES ('delete', ?, ?)",
+                        (row_id, _bigrams(text)),
+                    )
+            conn.execute("DELETE FROM pages WHERE doc_hash = ?", (doc_hash,))
+            conn.execute("DELETE FROM documents WHERE hash = ?", (doc_hash,))
+    except sqlite3.Error as e:
+        print(f"⚠️ ページストア削除エラー: {type(e).__name__}")
+
+def evict_documents(max_size: int = MAX_PAGE_STORE_SIZE, keep: str = None):
+    """
+    ページ本文の合計サイズが上限を超えている場合、最終利用が古い資料から削除
+
+    Args:
+        max_size: 圧縮後のページ本文の合計の最大サイズ（バイト）
+        keep: 削除しない資料のハッシュ（登録した直後の資料）
+    """
+    try:
+        conn = _connect()
+        rows = conn.execute(
+            "SELECT d.hash, d.used_at, COALESCE(SUM(LENGTH(p.text)), 0) FROM documents d "
+            "LEFT JOIN pages p ON p.doc_hash = d.hash GROUP BY d.hash"
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"⚠️ ページストア整理エラー: {type(e).__name__}")
+        return
+
+    total_size = sum(size for _, _, size in rows)
+    if total_size <= max_size:
+        return
+    for doc_hash, _, size in sorted(rows, key=lambda row: row[1]):  # 古い順
+        if total_size <= max_size:
+            break
+        if doc_hash == keep:
+            continue
+        remove_document(doc_hash)
+        total_size -= size
+
+def get_pages(doc_hash: str) -> list:
+    """
+    資料のページをページ番号順に取得
+
+    Returns:
+        (ページ番号, テキスト) のリスト（未登録の場合は空リスト）
+    """
+    try:
+        rows = _connect().execute(
+            "SELECT page_no, text FROM pages WHERE doc_hash = ? ORDER BY page_no", (doc_hash,)
+        ).fetchall()
+    except sqlite3.Error:
+        return []
+    return [(page_no, _decompress(blob)) for page_no, blob in rows]
+
+def _make_snippet(text: str, term: str) -> str:
+    """最初に一致した位置の前後を切り出す"""
+    pos = text.lower().find(term.lower())
+    if pos < 0:
+        pos = 0
+    start = max(0, pos - SNIPPET_CONTEXT_CHARS)
+    end = min(len(text), pos + len(term) + SNIPPET_CONTEXT_CHARS)
+    snippet = re.sub(r"\s+", " ", text[start:end]).strip()
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+def _match_query(terms) -> str:
+    """各語をフレーズとして AND でつないだ FTS5 の検索式"""
+    return " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def search(query: str, doc_sources: dict = None, limit: int = 20) -> list:
+    """
+    全ページからキーワードを検索（スペース区切りの語はすべて含むページのみ）
+
+    Args:
+        query: 検索キーワード
+        doc_sources: {資料のハッシュ: 表示するソース名}（指定した資料だけを検索）
+        limit: 最大件数
+
+    Returns:
+        {"source", "page", "snippet", "hash"} の辞書のリスト（関連度順）
+    """
+    terms = [term for term in query.split() if term]
+    if not terms:
+        return []
+    if doc_sources is not None and not doc_sources:
+        return []
+
+    try:
+        conn = _connect()
+        params = []
+        doc_filter = ""
+        if doc_sources is not None:
+            doc_filter = f"p.doc_hash IN ({','.join('?' * len(doc_sources))})"
+            params = list(doc_sources)
+
+        use_fts = _has_fts(conn)
+        fts_terms = [term for term in terms if len(term) >= MIN_FTS_TERM_LENGTH]
+        # 記号を含む2文字の語は bigram 索引のトークンにならないことがあるため、本文の確認だけで絞り込む
+        bigram_terms = [term for term in terms if len(term) == BIGRAM_TERM_LENGTH and term.isalnum()]
+        if use_fts and (fts_terms or bigram_terms):
+            # 各語をフレーズとして AND 検索（1文字の語は後で本文を確認して絞り込む）
+            table = "pages_fts" if fts_terms else "pages_bigram"
+            conditions = [f"{table} MATCH ?"]
+            match_params = [_match_query(fts_terms or bigram_terms)]
+            if fts_terms and bigram_terms:
+                conditions.append("p.id IN (SELECT rowid FROM pages_bigram WHERE pages_bigram MATCH ?)")
+                match_params.append(_match_query(bigram_terms))
+            if doc_filter:
+                conditions.append(doc_filter)
+            sql = (
+                f"SELECT p.doc_hash, p.page_no, p.text FROM {table} f "
+                f"JOIN pages p ON p.id = f.rowid WHERE {' AND '.join(conditions)} ORDER BY f.rank"
+            )
+            rows = conn.execute(sql, match_params + params)
+        else:
+            sql = "SELECT p.doc_hash, p.page_no, p.text FROM pages p" + (f" WHERE {doc_filter}" if doc_filter else "")
+            rows = conn.execute(sql + " ORDER BY p.doc_hash, p.page_no", params)
+
+        results = []
+        for doc_hash, page_no, blob in rows:
+            text = _decompress(blob)
+            lowered = text.lower()
+            if not all(term.lower() in lowered for term in terms):
+                continue
+            if doc_sources is not None:
+                source = doc_sources[doc_hash]
+            else:
+                row = conn.execute("SELECT source FROM documents WHERE hash = ?", (doc_hash,)).fetchone()
+                source = row[0] if row else doc_hash[:12]
+            results.append({
+                "source": source,
+                "page": page_no,
+                "snippet": _make_snippet(text, terms[0]),
+                "hash": doc_hash,
+            })
+            if len(results) >= limit:
+                break
+        return results
+    except sqlite3.Error as e:
+        print(f"⚠️ ページ検索エラー: {type(e).__name__}")
+        return []
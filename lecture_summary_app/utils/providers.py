@@ -0,0 +1,209 @@
+import os
+import re
+import time
+import asyncio
+import random
+import threading
+
+# ローカルスタブ（local プロバイダ）の既定の設定（環境変数で上書き可能）
+# APIキーなしで要約・Q&A・おすすめ資料の処理を実行・計測するためのもの
+LOCAL_DEFAULTS = {
+    "mode": "extract",           # "extract"（資料から要点を抜き出す）or "echo"（プロンプトの末尾を返す）
+    "latency": 0.0,              # 1回の呼び出しの応答開始までの秒数
+    "tokens_per_second": 0.0,    # 出力の速度（0なら待機なし）
+    "rate_limit_rate": 0.0,      # 429 を返す割合（0.0～1.0）
+    "retry_after": 1.0,          # 429 の Retry-After 秒数
+    "seed": 0,                   # 429 の発生順を決める乱数の種（同じ設定なら毎回同じ順序）
+    "max_output_chars": 2000,    # 出力の最大文字数
+}
+
+# 応答の内容を変える設定（キャッシュキーに含める。待ち時間や429の設定は応答を変えない）
+LOCAL_OUTPUT_SETTINGS = ("mode", "max_output_chars")
+
+_ENV_PREFIX = "LOCAL_LLM_"
+
+_providers = {}
+
+def register_provider(name: str, factory):
+    """
+    LLMプロバイダを登録
+
+    Args:
+        name: プロバイダ名（ai_provider に指定する名前）
+        factory: factory(api_key, model, temperature, max_tokens) でチャットモデルを返す関数。
+                 チャットモデルは invoke(prompt) と stream(prompt)（あれば非同期の ainvoke(prompt)）を持ち、
+                 戻り値（断片）の content に応答テキストが入っていること
+    """
+    _providers[name] = factory
+
+def available_providers() -> list:
+    """登録済みのプロバイダ名の一覧"""
+    return sorted(_providers)
+
+def create_llm(provider: str, api_key, model, temperature, max_tokens=None):
+    """
+    登録済みのプロバイダでチャットモデルを作成
+
+    Raises:
+        ValueError: 未登録のプロバイダの場合
+    """
+    factory = _providers.get(provider)
+    if factory is None:
+        raise ValueError(f"❌ 未対応のAIプロバイダです: {provider}（利用可能: {', '.join(available_providers())}）")
+    return factory(api_key, model, temperature, max_tokens)
+
+def _create_gemini(api_key, model, temperature, max_tokens):
+    # Lazy imports to prevent startup errors
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    # レート制限の再試行は rate_limiter が行うため、クライアント内部の再試行は無効にする
+    return ChatGoogleGenerativeAI(
+        model=model,
+        google_api_key=api_key,  # APIキーを明示的に渡す（環境変数は使わない）
+        temperature=temperature,
+        max_tokens=max_tokens,
+        max_retries=0,
+    )
+
+def _create_openai(api_key, model, temperature, max_tokens):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model=model,
+        openai_api_key=api_key,  # APIキーを明示的に渡す（環境変数は使わない）
+        temperature=temperature,
+        max_tokens=max_tokens,
+        max_retries=0,
+    )
+
+def local_settings(**overrides) -> dict:
+    """
+    ローカルスタブの設定（既定値 < 環境変数 LOCAL_LLM_* < 引数 の順に優先）
+    """
+    settings = dict(LOCAL_DEFAULTS)
+    for name, default in LOCAL_DEFAULTS.items():
+        value = os.environ.get(_ENV_PREFIX + name.upper())
+        if value is not None:
+            settings[name] = type(default)(value)
+    settings.update(overrides)
+    return settings
+
+class LocalResponse:
+    """ローカルスタブの応答（LangChain のメッセージと同じく content を持つ）"""
+
+    def __init__(self, content: str):
+        self.content = content
+
+class LocalRateLimitError(Exception):
+    """ローカルスタブが返す疑似的な429エラー（Retry-After ヘッダ付き）"""
+
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"429 TOO_MANY_REQUESTS (local stub): retry after {retry_after}s")
+        self.response = LocalResponse("")
+        self.response.status_code = 429
+        self.response.headers = {"retry-after": str(retry_after)}
+
+class LocalChatModel:
+    """
+    ネットワークを使わない決定的なチャットモデル（ベンチマーク・テスト用）
+
+    同じプロンプトには常に同じ応答を返す。応答開始までの待ち時間・出力速度・429の発生割合を設定できる。
+    """
+
+    def __init__(self, model="local-extract", temperature=0.0, max_tokens=None, **settings):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.settings = local_settings(**settings)
+        self.calls = 0
+        self.rate_limited = 0
+        self._random = random.Random(self.settings["seed"])
+        self._lock = threading.Lock()
+
+    @property
+    def output_settings(self) -> dict:
+        """応答の内容を変える設定（llm_client がキャッシュキーに含める）"""
+        return {name: self.settings[name] for name in LOCAL_OUTPUT_SETTINGS}
+
+    def _count_call(self):
+        """呼び出し回数を数え、設定に応じて疑似的な429を返す"""
+        with self._lock:
+            self.calls += 1
+            limited = self._random.random() < self.settings["rate_limit_rate"]
+            if limited:
+                self.rate_limited += 1
+        if limited:
+            raise LocalRateLimitError(self.settings["retry_after"])
+
+    def _start_call(self):
+        self._count_call()
+        if self.settings["latency"] > 0:
+            time.sleep(self.settings["latency"])
+
+    def _respond(self, prompt: str) -> str:
+        text = str(prompt)
+        limit = self.settings["max_output_chars"]
+        if self.settings["mode"] == "echo":
+            return text.strip()[-limit:]
+        return _extract_summary(text, limit)
+
+    def _pieces(self, content: str):
+        """出力を約4文字（1トークン相当）ずつに分ける"""
+        return [content[i:i + 4] for i in range(0, len(content), 4)]
+
+    def invoke(self, prompt):
+        self._start_call()
+        content = self._respond(prompt)
+        if self.settings["tokens_per_second"] > 0:
+            time.sleep(len(self._pieces(content)) / self.settings["tokens_per_second"])
+        return LocalResponse(content)
+
+    async def ainvoke(self, prompt):
+        self._count_call()
+        if self.settings["latency"] > 0:
+            await asyncio.sleep(self.settings["latency"])
+        content = self._respond(prompt)
+        if self.settings["tokens_per_second"] > 0:
+            await asyncio.sleep(len(self._pieces(content)) / self.settings["tokens_per_second"])
+        return LocalResponse(content)
+
+    def stream(self, prompt):
+        self._start_call()
+        delay = 1 / self.settings["tokens_per_second"] if self.settings["tokens_per_second"] > 0 else 0
+        for piece in self._pieces(self._respond(prompt)):
+            if delay:
+                time.sleep(delay)
+            yield LocalResponse(piece)
+
+def _extract_summary(prompt: str, limit: int) -> str:
+    """
+    プロンプトの資料部分から要点を抜き出して学習ノート風にまとめる（決定的）
+
+    資料の区切り（--- Source: ... --- 等）ごとに、最初の数行を箇条書きにする。
+    """
+    material = re.split(r"【(?:資料|部分要約|講義資料・参考情報|資料の該当箇所)】", prompt)[-1]
+    question = re.search(r"【ユーザーの質問】\s*(.+)", material, re.DOTALL)
+    if question:
+        material = material[:question.start()]
+
+    sections = re.split(r"^\s*--- (?:Source|部分要約): (.+?) ---\s*$", material, flags=re.MULTILINE)
+    output = ["# ローカル要約（スタブ）"]
+    if question:
+        output.append(f"質問: {question.group(1).strip()[:200]}")
+    # re.split は [前置き, ソース名, 本文, ソース名, 本文, ...] を返す
+    for source, body in zip(sections[1::2], sections[2::2]):
+        lines = [line.strip() for line in body.splitlines() if len(line.strip()) >= 4]
+        output.append(f"\n## {source.strip()}")
+        output.extend(f"- {line[:120]}" for line in lines[:3])
+        output.append(f"`[出典: {source.strip()}]`")
+    if len(sections) == 1:
+        lines = [line.strip() for line in material.splitlines() if len(line.strip()) >= 4]
+        output.extend(f"- {line[:120]}" for line in lines[:5])
+    return "\n".join(output)[:limit]
+
+def _create_local(api_key, model, temperature, max_tokens):
+    return LocalChatModel(model=model, temperature=temperature, max_tokens=max_tokens)
+
+register_provider("gemini", _create_gemini)
+register_provider("openai", _create_openai)
+register_provider("local", _create_local)
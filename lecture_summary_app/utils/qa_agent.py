@@ -1,84 +1,408 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
+# 質問ごとに送る抜粋の数
+RETRIEVAL_TOP_K = 8
 
-def initialize_vector_store(text_data_list, api_key):
+# 順位の統合（Reciprocal Rank Fusion）の定数: 大きいほど下位の結果も重視する
+RRF_K = 60
+
+class Corpus:
+    """
+    AIチューターが参照する資料の検索インデックス
+
+    キーワード検索（BM25）と、カテゴリの意味検索インデックス（ある場合）の結果を
+    順位で統合して返す。用語・数式検索用の KWIC 索引も持つ。
     """
-    In Long Context mode, this function simply aggregates text data.
-    We don't need a vector store anymore, but we keep the name for compatibility
-    with app.py (or we can return the list itself).
-    Returns: A string containing all context formatted for the LLM.
+
+    def __init__(self, lexical, semantic=None):
+        from .concordance import Concordance
+
+        self.lexical = lexical
+        self.semantic = semantic
+        self.concordance = Concordance(lexical.chunks)
+
+    def __len__(self):
+        return len(self.lexical)
+
+    def full_text(self) -> str:
+        return self.lexical.full_text()
+
+    def search(self, query: str, top_k: int = RETRIEVAL_TOP_K) -> list:
+        """
+        質問に関連する抜粋を検索
+
+        Returns:
+            (統合スコア, 抜粋の辞書) のリスト（スコアの高い順）
+        """
+        rankings = [self.lexical.search(query, top_k * 2)]
+        if self.semantic is not None:
+            rankings.append(self.semantic.search(query, top_k * 2))
+        scores = {}
+        chunks = {}
+        for results in rankings:
+            for rank, (_, chunk) in enumerate(results):
+                key = (chunk["source"], chunk["page"], chunk["text"])
+                scores[key] = scores.get(key, 0.0) + 1 / (RRF_K + rank + 1)
+                chunks[key] = chunk
+        ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+        return [(scores[key], chunks[key]) for key in ranked]
+
+def initialize_vector_store(text_data_list, api_key, category_dir=None):
+    """
+    資料の検索インデックスを作成
+
+    質問のたびに資料全体を送らず、質問に関連する抜粋だけを送るためのもの。
+    キーワード検索（BM25）のインデックスは同じ資料の組み合わせなら保存済みのものを読み込む。
+    category_dir を指定した場合は、カテゴリの意味検索インデックス（FAISS）も作成・更新して併用する。
+
+    Args:
+        text_data_list: {"content", "source", ("hash")} の辞書のリスト（整形済みの資料も可）
+        api_key: 未使用（互換性のため）
+        category_dir: カテゴリのディレクトリ（data/{category}）
+
+    Returns:
+        Corpus（資料がない場合はNone）
     """
+    from .bm25_index import build_index
+    from .text_cleaner import clean_documents
+
     if not text_data_list:
         return None
-        
-    full_context = ""
-    for item in text_data_list:
-        full_context += f"\n\n--- Source: {item['source']} ---\n"
-        full_context += item['content']
-    
-    return full_context
+    # 定型文の除去は1回だけ（両方のインデックスで同じ整形済みの資料を使う）
+    text_data_list, _ = clean_documents(text_data_list)
+    semantic = None
+    if category_dir:
+        try:
+            from . import semantic_index
+            semantic = semantic_index.build_index(category_dir, text_data_list)
+        except ImportError as e:
+            # numpy が無い環境ではキーワード検索のみ
+            print(f"⚠️ 意味検索インデックスを使用できません: {e}")
+    return Corpus(build_index(text_data_list), semantic)
 
-def get_answer(query, context_text, api_key, ai_provider="gemini"):
+def corpus_text(corpus) -> str:
     """
-    長いコンテキストを使用してユーザーの質問に回答（RAG不要）
-    
+    検索インデックス（または従来の全文コンテキスト）から資料全体のテキストを取得
+    """
+    if corpus is None:
+        return ""
+    if isinstance(corpus, str):
+        return corpus
+    return corpus.full_text()
+
+def retrieve_context(query, corpus, top_k=RETRIEVAL_TOP_K):
+    """
+    質問に関連する抜粋を検索してプロンプト用のテキストにする
+
     Args:
         query: ユーザーの質問
-        context_text: 講義資料の全コンテキスト
-        api_key: Google Gemini APIキー or OpenAI APIキー
-        ai_provider: 'gemini' or 'openai'
-    
+        corpus: initialize_vector_store の戻り値（全文の文字列も可）
+        top_k: 送る抜粋の数
+
     Returns:
-        (回答テキスト, ソースリスト) のタプル
+        (コンテキストのテキスト, ソース名のリスト) のタプル
     """
-    import os
-    
+    from .bm25_index import format_passage
+
+    if not corpus:
+        return "", []
+    if isinstance(corpus, str):
+        # 従来の全文コンテキスト（検索せずにそのまま送る）
+        return corpus, []
+
+    results = corpus.search(query, top_k)
+    if not results:
+        return "（質問に関連する箇所は資料内に見つかりませんでした）", []
+    passages = [chunk for _, chunk in results]
+    sources = list(dict.fromkeys(chunk["source"] for chunk in passages))
+    print(f"🔎 {len(passages)}/{len(corpus)}件の抜粋を送信（{len(sources)}資料）")
+    return "\n\n".join(format_passage(chunk) for chunk in passages), sources
+
+def _build_answer_request(query, context_text, api_key, ai_provider, history=""):
+    """
+    回答用のチャットモデルとプロンプトを準備
+
+    Args:
+        history: これまでの会話（ConversationMemory.context() の戻り値）
+
+    Returns:
+        (llm, prompt) のタプル
+
+    Raises:
+        ValueError: 資料がない場合・プロンプトがモデルの入力上限を超える場合
+    """
+    from .llm_client import get_llm, model_name
+    from .token_budget import check_prompt
+
     if not context_text:
-        return "❌ 資料が読み込まれていません。サイドバーから資料をアップロードしてください。", []
+        raise ValueError("❌ 資料が読み込まれていません。サイドバーから資料をアップロードしてください。")
 
-    # 環境変数に確実にAPIキーを設定
-    if ai_provider == "openai":
-        os.environ["OPENAI_API_KEY"] = api_key
-    else:
-        os.environ["GOOGLE_API_KEY"] = api_key
+    # Initialize Chat Model with optimized settings（同じキー・設定のクライアントは使い回す）
+    llm = get_llm(ai_provider, api_key, temperature=0.1)
 
-    # Initialize Chat Model with optimized settings
-    if ai_provider == "openai":
-        from langchain_openai import ChatOpenAI
-        llm = ChatOpenAI(model="gpt-3.5-turbo", openai_api_key=api_key, temperature=0.1)
-    else:
-        from langchain_google_genai import ChatGoogleGenerativeAI
-        # APIキーを明示的に渡す
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp",
-            google_api_key=api_key,
-            temperature=0.1
-        )
+    # 会話履歴は要約 + 直近のやり取りだけなので、会話が長くなってもプロンプトの大きさは一定以下
+    history_section = f"\n    【これまでの会話】\n    {history}\n" if history else ""
     
     # Prompt Construction
     prompt = f"""
     あなたは優秀なAIチューターです。
-    以下の【講義資料・参考情報】の全てを前提知識として、ユーザーの質問に答えてください。
+    以下の【講義資料・参考情報】（講義資料から質問に関連する箇所を抜き出したもの）に基づいて、ユーザーの質問に答えてください。
     
     【ルール】
     1. 資料に書かれている内容に基づいて回答すること。
     2. 資料にないことは「資料には記載がありません」と正直に伝えること。
     3. 必要に応じて、参照した資料のソース名（Source: ...）を引用して根拠を示すこと。
+    4. 【これまでの会話】がある場合は、その流れを踏まえて質問の意図（「それ」「さっきの式」等）を解釈すること。
     
     【講義資料・参考情報】
     {context_text}
-    
+    {history_section}
     【ユーザーの質問】
     {query}
     """
     
+    # モデルの入力上限を超える場合は送信しない（APIエラーで待たされるだけなので）
+    check_prompt(prompt, model_name(llm))
+    return llm, prompt
+
+def _answer_error_message(e):
+    """回答生成時の例外をユーザー向けのメッセージにする"""
+    error_message = f"❌ 回答生成エラー: {type(e).__name__}"
+    if "RESOURCE_EXHAUSTED" in str(e) or "429" in str(e):
+        error_message += " - APIのレート制限に達しました。少し待ってから再試行してください。"
+    else:
+        error_message += f" - {str(e)[:100]}"
+    return error_message
+
+# 用語・数式の説明で LLM に送るスニペットの最大数
+LOOKUP_MAX_MATCHES = 12
+
+_LOOKUP_LABELS = {"term": "用語", "formula": "数式または記号"}
+
+def lookup(query, corpus, kind="term"):
+    """
+    用語・数式の出現箇所を資料全体から検索（LLMは使わない）
+
+    Args:
+        query: 用語または数式
+        corpus: initialize_vector_store の戻り値
+        kind: "term"（用語）or "formula"（数式・記号。LaTeX・Unicode・全角の表記ゆれを無視）
+
+    Returns:
+        {"source", "page", "match", "snippet", "highlighted"} の辞書のリスト
+    """
+    concordance = getattr(corpus, "concordance", None)
+    if concordance is None or not query or not query.strip():
+        return []
+    if kind == "formula":
+        return concordance.search_formula(query)
+    return concordance.search_term(query)
+
+def explain_matches(query, matches, api_key, ai_provider="gemini", kind="term", use_cache=True):
+    """
+    検索した出現箇所（スニペット）だけを資料として、用語・数式を説明
+
+    Args:
+        query: 用語または数式
+        matches: lookup の戻り値
+        api_key: APIキー
+        ai_provider: 'gemini' / 'openai' / 'local'
+        kind: "term" or "formula"
+        use_cache: False の場合は応答キャッシュを使わない
+
+    Returns:
+        説明のテキスト（エラーの場合はエラーメッセージ）
+    """
+    from .concordance import format_matches
+    from .llm_client import get_llm, model_name, invoke
+    from .token_budget import check_prompt
+
+    label = _LOOKUP_LABELS.get(kind, _LOOKUP_LABELS["term"])
+    if matches:
+        context_text = format_matches(matches[:LOOKUP_MAX_MATCHES])
+    else:
+        context_text = "（資料内に一致する箇所はありませんでした）"
+
+    prompt = f"""
+    以下の【資料の該当箇所】は、講義資料から「{query}」が出現する箇所を抜き出したものです。
+    この{label}について説明してください。
+
+    【ルール】
+    1. 該当箇所に定義や説明がある場合は、それに基づいて詳しく説明し、引用したソース名とページを明記する。
+    2. 該当箇所に説明がない場合は、「資料内に説明は見つかりませんでした。一般的な意味は...」と前置きして簡潔に説明する。
+    3. 数式・記号の場合は、数学・物理の文脈を考慮し、何を表しているかを明確にする。
+
+    【資料の該当箇所】
+    {context_text}
+    """
+    try:
+        llm = get_llm(ai_provider, api_key, temperature=0.1)
+        check_prompt(prompt, model_name(llm))
+        return invoke(llm, prompt, ai_provider, use_cache=use_cache)
+    except ValueError as e:
+        return str(e)
+    except Exception as e:
+        return _answer_error_message(e)
+
+def _retrieval_query(query, memory):
+    """資料検索用の質問（続けての質問は「それ」等を含むことが多いので直前の質問も加える）"""
+    if memory is None:
+        return query
+    return f"{memory.last_question()}\n{query}".strip()
+
+def _remember(memory, query, answer, llm, ai_provider, use_cache=True):
+    """やり取りを会話履歴に追加し、古いやり取りの要約をバックグラウンドで更新"""
+    if memory is None:
+        return
+    memory.add_turn(query, answer)
+    memory.refresh_summary(llm, ai_provider, use_cache)
+
+def get_answer(query, corpus, api_key, ai_provider="gemini", memory=None, use_cache=True):
+    """
+    質問に関連する資料の抜粋を検索し、それを使ってユーザーの質問に回答
+    
+    Args:
+        query: ユーザーの質問
+        corpus: initialize_vector_store の戻り値（全文の文字列を渡した場合は全文を送る）
+        api_key: Google Gemini APIキー or OpenAI APIキー
+        ai_provider: 'gemini' / 'openai' / 'local'（APIキー不要のスタブ）
+        memory: 会話履歴（chat_memory.ConversationMemory）。指定すると前の質問を踏まえて回答し、
+                やり取りを履歴に追加する
+        use_cache: False の場合は応答キャッシュを使わずに必ずAPIを呼び出す（セッションごとの設定）
+    
+    Returns:
+        (回答テキスト, 参照した抜粋のソース名のリスト) のタプル
+    """
+    context_text, sources = retrieve_context(_retrieval_query(query, memory), corpus)
+    history = memory.context() if memory is not None else ""
+    try:
+        llm, prompt = _build_answer_request(query, context_text, api_key, ai_provider, history)
+    except ValueError as e:
+        return str(e), []
+
     try:
-        response = llm.invoke(prompt)
-        # Long Context モードでは、ソースの引用はテキスト内で行う
-        return response.content, [] 
+        from .llm_client import invoke
+        # 同じ資料への同じ質問はキャッシュから返す
+        answer = invoke(llm, prompt, ai_provider, use_cache=use_cache)
     except Exception as e:
-        error_message = f"❌ 回答生成エラー: {type(e).__name__}"
-        if "RESOURCE_EXHAUSTED" in str(e) or "429" in str(e):
-            error_message += " - APIのレート制限に達しました。少し待ってから再試行してください。"
-        else:
-            error_message += f" - {str(e)[:100]}"
-        return error_message, []
+        return _answer_error_message(e), []
+    _remember(memory, query, answer, llm, ai_provider, use_cache)
+    return answer, sources
+
+class AnswerStream:
+    """
+    get_answer_stream の戻り値
+
+    for 文で回答テキストの断片を返す。sources は参照した抜粋のソース名のリスト
+    （回答の生成に失敗した場合は空リスト）。
+    """
+
+    def __init__(self, deltas, sources):
+        self.sources = sources
+        self._deltas = deltas
+
+    def __iter__(self):
+        return self._deltas
+
+def get_answer_stream(query, corpus, api_key, ai_provider="gemini", memory=None, use_cache=True):
+    """
+    get_answer のストリーミング版（回答を生成された順に少しずつ返す）
+    
+    Args:
+        get_answer と同じ
+    
+    Returns:
+        AnswerStream（for 文で回答テキストの断片（エラーの場合はエラーメッセージ）を返し、
+        すべて受け取った後に sources で根拠のソース名を参照できる）
+    """
+    context_text, sources = retrieve_context(_retrieval_query(query, memory), corpus)
+    history = memory.context() if memory is not None else ""
+    try:
+        llm, prompt = _build_answer_request(query, context_text, api_key, ai_provider, history)
+    except ValueError as e:
+        return AnswerStream(iter([str(e)]), [])
+
+    def deltas():
+        from .llm_client import stream
+        received = []
+        try:
+            for delta in stream(llm, prompt, ai_provider, use_cache=use_cache):
+                received.append(delta)
+                yield delta
+        except Exception as e:
+            result.sources = []
+            yield ("\n\n" if received else "") + _answer_error_message(e)
+            return
+        _remember(memory, query, "".join(received), llm, ai_provider, use_cache)
+
+    result = AnswerStream(deltas(), sources)
+    return result
+
+# まとめて回答するときの同時実行数（さらにプロバイダ + APIキーごとのリミッターでも制限される）
+ANSWER_MANY_CONCURRENCY = 4
+
+async def answer_many(questions, corpus, api_key, ai_provider="gemini", max_concurrency=ANSWER_MANY_CONCURRENCY,
+                      use_cache=True):
+    """
+    複数の質問にまとめて回答し、完了した順に返す（問題集・演習問題の一括回答用）
+
+    応答キャッシュ・レート制限は get_answer と共有する。クライアントはイベントループごとに使い回す
+    （非同期のHTTPセッションは最初に使ったループに結び付くため）。
+
+    Args:
+        questions: 質問のリスト
+        corpus: initialize_vector_store の戻り値
+        api_key: APIキー
+        ai_provider: 'gemini' / 'openai' / 'local'
+        max_concurrency: 同時に回答を生成する質問の数
+        use_cache: False の場合は応答キャッシュを使わない
+
+    Yields:
+        (質問の番号, 回答テキスト, 参照した抜粋のソース名のリスト) のタプル（完了した順）
+    """
+    import asyncio
+    from .llm_client import ainvoke
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def answer(index, question):
+        async with semaphore:
+            context_text, sources = retrieve_context(question, corpus)
+            try:
+                llm, prompt = _build_answer_request(question, context_text, api_key, ai_provider)
+            except ValueError as e:
+                return index, str(e), []
+            try:
+                return index, await ainvoke(llm, prompt, ai_provider, use_cache=use_cache), sources
+            except Exception as e:
+                return index, _answer_error_message(e), []
+
+    tasks = [asyncio.ensure_future(answer(index, question)) for index, question in enumerate(questions)]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        # 途中で打ち切られた場合は残りの呼び出しを止める
+        for task in tasks:
+            task.cancel()
+
+def answer_all(questions, corpus, api_key, ai_provider="gemini", max_concurrency=ANSWER_MANY_CONCURRENCY,
+               use_cache=True):
+    """
+    answer_many の同期版（イベントループのないスレッド用）
+
+    呼び出しごとに新しいイベントループを作らず、llm_client の共有のループで実行する
+    （非同期のクライアントとそのHTTP接続を次の呼び出しでも使い回せる）。
+
+    Returns:
+        (回答テキスト, ソース名のリスト) のリスト（質問の順）
+    """
+    from .llm_client import run_async
+
+    async def collect():
+        results = [None] * len(questions)
+        async for index, answer, sources in answer_many(
+            questions, corpus, api_key, ai_provider, max_concurrency, use_cache
+        ):
+            results[index] = (answer, sources)
+        return results
+
+    return run_async(collect())
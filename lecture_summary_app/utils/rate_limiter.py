@@ -0,0 +1,320 @@
+import os
+import re
+import time
+import asyncio
+import random
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# プロバイダごとの初期レート（1秒あたりのリクエスト数）とバースト数
+# Gemini 無料枠は 10 RPM 程度、OpenAI は 60 RPM 程度から始めて実測で調整する
+# 有料枠などでは環境変数 {PROVIDER}_RATE_PER_MINUTE / {PROVIDER}_BURST（例: GEMINI_RATE_PER_MINUTE=1000）
+# または configure_limiter() で初期レートを変更できる
+PROVIDER_RATES = {
+    "gemini": {"rate": 10 / 60, "burst": 4},
+    "openai": {"rate": 60 / 60, "burst": 8},
+    "local": {"rate": 1000, "burst": 100},  # ローカルスタブ（疑似的な429で調整を確認する）
+}
+DEFAULT_RATE = {"rate": 10 / 60, "burst": 2}
+
+# 同時実行数の範囲（AIMD: 成功で少しずつ増やし、429で半分にする）
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 8
+INITIAL_CONCURRENCY = 4
+
+# レートの下限（初期レートに対する倍率）。上限は設けず、429 を受けるまで少しずつ増やす
+MIN_RATE_FACTOR = 0.1
+
+# 成功1回あたりのレートの増加量（初期レートに対する倍率）
+RATE_INCREASE_FACTOR = 0.05
+
+# Retry-After が無い場合の待機時間（秒）: 10秒から倍々で最大60秒
+BASE_BACKOFF_SECONDS = 10
+MAX_BACKOFF_SECONDS = 60
+
+# 待機時間のゆらぎ（同じキーを使う複数セッションが同時に再試行しないように）
+BACKOFF_JITTER = 0.2
+
+# レート制限時の再試行回数
+MAX_RETRIES = 3
+
+# 非同期の呼び出しが同時実行数の空きを確認する間隔（秒）
+ASYNC_POLL_SECONDS = 0.05
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """例外がレート制限（429 / RESOURCE_EXHAUSTED）によるものか"""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status == 429:
+        return True
+    error_str = str(error)
+    return "RESOURCE_EXHAUSTED" in error_str or "429" in error_str or "TOO_MANY_REQUESTS" in error_str
+
+def parse_retry_after(error: Exception):
+    """
+    例外から再試行までの待機秒数を取得
+
+    OpenAI は HTTP ヘッダの Retry-After、Gemini はエラー本文の retryDelay / "retry in Ns" を見る。
+
+    Returns:
+        待機秒数（わからない場合はNone）
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        for name in ("retry-after-ms", "retry-after"):
+            value = headers.get(name)
+            if value is None:
+                continue
+            try:
+                seconds = float(value)
+            except (TypeError, ValueError):
+                continue
+            return seconds / 1000 if name.endswith("-ms") else seconds
+
+    match = re.search(r"retry[_ ]?delay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", str(error), re.IGNORECASE)
+    if not match:
+        match = re.search(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", str(error), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+class RateLimiter:
+    """
+    プロバイダ + APIキーごとのレート制限（トークンバケット + AIMD による同時実行数の調整）
+
+    同じキーを使うすべての呼び出し（セッション・スレッドをまたいで）が共有する。
+    429 を受けるとレートと同時実行数を半分にし、Retry-After の間は全員が待機する。
+    成功が続くと少しずつ増やす（レートは上限を設けず、実際のクォータで 429 を受けるまで増やす）。
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.concurrency = float(INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_limits = 0
+        self.throttled = False   # レート待ちが発生したか（呼び出しが少ない間はレートを上げない）
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _try_acquire_locked(self):
+        """
+        枠の確保を試みる（self.cond を取得した状態で呼ぶ）
+
+        Returns:
+            (確保できたか, 次に試すまでの待機秒数。None は release() まで)
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.cooldown_until:
+            return False, self.cooldown_until - now
+        if self.in_flight >= int(self.concurrency):
+            return False, None
+        if self.tokens < 1:
+            self.throttled = True
+            return False, (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        return True, 0.0
+
+    def acquire(self):
+        """バケットにトークンがあり、同時実行数に空きができるまで待機"""
+        with self.cond:
+            while True:
+                acquired, wait = self._try_acquire_locked()
+                if acquired:
+                    return
+                self.cond.wait(wait)
+
+    async def acquire_async(self):
+        """acquire の非同期版（イベントループを止めずに待機）"""
+        while True:
+            with self.cond:
+                acquired, wait = self._try_acquire_locked()
+            if acquired:
+                return
+            await asyncio.sleep(ASYNC_POLL_SECONDS if wait is None else wait)
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def configure(self, rate: float, burst: int = None):
+        """初期レート（とバースト数）を変更し、現在のレートもそこから測り直す"""
+        with self.cond:
+            self.base_rate = rate
+            self.rate = rate
+            if burst is not None:
+                self.burst = burst
+                self.tokens = min(self.tokens, float(burst))
+            self.cond.notify_all()
+
+    def on_success(self):
+        """
+        成功: 同時実行数とレートを少しずつ増やす（加算的増加）
+
+        レートはレート待ちが発生しているときだけ増やす（呼び出しが少ないと 429 で確かめられないため）。
+        """
+        with self.cond:
+            self.consecutive_limits = 0
+            self.concurrency = min(MAX_CONCURRENCY, self.concurrency + 1 / self.concurrency)
+            if self.throttled:
+                self.rate += self.base_rate * RATE_INCREASE_FACTOR
+                self.throttled = False
+            self.cond.notify_all()
+
+    def on_rate_limited(self, retry_after=None) -> float:
+        """
+        429: 同時実行数とレートを半分にし、待機時間の間は新しい呼び出しを止める（乗算的減少）
+
+        Returns:
+            待機秒数
+        """
+        with self.cond:
+            self.consecutive_limits += 1
+            self.concurrency = max(MIN_CONCURRENCY, self.concurrency / 2)
+            self.rate = max(self.base_rate * MIN_RATE_FACTOR, self.rate / 2)
+            self.throttled = False
+            self.tokens = 0.0
+            if retry_after is None:
+                retry_after = min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** (self.consecutive_limits - 1))
+            wait = retry_after * (1 + random.uniform(0, BACKOFF_JITTER))
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + wait)
+            self.cond.notify_all()
+            return wait
+
+    @contextmanager
+    def slot(self):
+        """with 文で1回分の呼び出し枠を確保"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "rate_per_minute": self.rate * 60,
+                "concurrency": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "cooldown_seconds": max(0.0, self.cooldown_until - time.monotonic()),
+            }
+
+def _key_id(api_key) -> str:
+    """APIキーそのものは保持せず、ハッシュの先頭で識別する"""
+    return hashlib.sha256(str(api_key or "").encode("utf-8")).hexdigest()[:16]
+
+def provider_rate(provider: str) -> dict:
+    """
+    プロバイダの初期レートとバースト数（既定値 < 環境変数 {PROVIDER}_RATE_PER_MINUTE / {PROVIDER}_BURST）
+
+    Returns:
+        {"rate": 1秒あたりのリクエスト数, "burst": バースト数}
+    """
+    settings = dict(PROVIDER_RATES.get(provider, DEFAULT_RATE))
+    prefix = (provider or "").upper()
+    try:
+        rate_per_minute = os.environ.get(f"{prefix}_RATE_PER_MINUTE")
+        if rate_per_minute:
+            settings["rate"] = float(rate_per_minute) / 60
+        burst = os.environ.get(f"{prefix}_BURST")
+        if burst:
+            settings["burst"] = int(burst)
+    except ValueError:
+        print(f"⚠️ {prefix}_RATE_PER_MINUTE / {prefix}_BURST の値が不正なため既定のレートを使用します")
+        return dict(PROVIDER_RATES.get(provider, DEFAULT_RATE))
+    return settings
+
+def get_limiter(provider: str, api_key) -> RateLimiter:
+    """プロバイダ + APIキーごとの共有リミッターを取得（プロセス内で1つ）"""
+    key = (provider, _key_id(api_key))
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            settings = provider_rate(provider)
+            limiter = RateLimiter(settings["rate"], settings["burst"])
+            _limiters[key] = limiter
+        return limiter
+
+def configure_limiter(provider: str, api_key, rate_per_minute: float, burst: int = None):
+    """
+    APIキーごとに初期レートを設定（有料枠のキーなど、プロバイダの既定より多く送れる場合）
+
+    Args:
+        provider: 'gemini' / 'openai' / 'local'
+        api_key: APIキー（このキーのリミッターだけを変更）
+        rate_per_minute: 1分あたりのリクエスト数
+        burst: バースト数（Noneなら変更しない）
+
+    Raises:
+        ValueError: rate_per_minute が正でない場合
+    """
+    if rate_per_minute <= 0:
+        raise ValueError("❌ レートは1分あたり1回以上を指定してください")
+    get_limiter(provider, api_key).configure(rate_per_minute / 60, burst)
+
+def call_with_limits(provider: str, api_key, func, max_retries: int = MAX_RETRIES):
+    """
+    リミッターを通して func() を呼び出し、レート制限の場合は待機して再試行
+
+    Args:
+        provider: 'gemini' / 'openai' / 'local'
+        api_key: APIキー（同じキーの呼び出しでレートを共有）
+        func: 実際にAPIを呼び出す引数なしの関数
+        max_retries: 最大試行回数
+
+    Returns:
+        func() の戻り値（最後まで429の場合やその他のエラーは例外をそのまま送出）
+    """
+    limiter = get_limiter(provider, api_key)
+    for attempt in range(max_retries):
+        with limiter.slot():
+            try:
+                result = func()
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                wait = limiter.on_rate_limited(parse_retry_after(e))
+                if attempt >= max_retries - 1:
+                    raise
+                print(f"⏳ レート制限: {wait:.0f}秒待機中... (試行 {attempt+1}/{max_retries})")
+                continue
+        limiter.on_success()
+        return result
+
+async def call_with_limits_async(provider: str, api_key, func, max_retries: int = MAX_RETRIES):
+    """
+    call_with_limits の非同期版（同期の呼び出しと同じリミッターを共有）
+
+    Args:
+        func: 実際にAPIを呼び出す引数なしの関数（awaitable を返す）
+        その他は call_with_limits と同じ
+    """
+    limiter = get_limiter(provider, api_key)
+    for attempt in range(max_retries):
+        await limiter.acquire_async()
+        try:
+            result = await func()
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            wait = limiter.on_rate_limited(parse_retry_after(e))
+            if attempt >= max_retries - 1:
+                raise
+            print(f"⏳ レート制限: {wait:.0f}秒待機中... (試行 {attempt+1}/{max_retries})")
+            continue
+        finally:
+            limiter.release()
+        limiter.on_success()
+        return result
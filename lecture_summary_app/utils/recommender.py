@@ -1,29 +1,14 @@
-def recommend_sources(summary_text, api_key, skip_if_not_found=True, ai_provider="gemini"):
+def recommend_sources(summary_text, api_key, skip_if_not_found=True, ai_provider="gemini", use_cache=True):
     """
     Analyzes the summary to find key topics and searches for high-quality external resources.
     skip_if_not_found: Trueの場合、見つからなければ空リストを返す（無理に探さない）
     ai_provider: 'gemini' or 'openai'
+    use_cache: Falseの場合、応答キャッシュを使わない
     """
-    import os
     from .web_loader import search_web
+    from .llm_client import get_llm
     
-    # 環境変数に確実にAPIキーを設定
-    if ai_provider == "openai":
-        os.environ["OPENAI_API_KEY"] = api_key
-    else:
-        os.environ["GOOGLE_API_KEY"] = api_key
-    
-    if ai_provider == "openai":
-        from langchain_openai import ChatOpenAI
-        llm = ChatOpenAI(model="gpt-3.5-turbo", openai_api_key=api_key, temperature=0.7)
-    else:
-        from langchain_google_genai import ChatGoogleGenerativeAI
-        # APIキーを明示的に渡す
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp",
-            google_api_key=api_key,
-            temperature=0.3
-        )
+    llm = get_llm(ai_provider, api_key, temperature=0.7 if ai_provider == "openai" else 0.3)
     
     # 1. Extract Keywords
     prompt = f"""
@@ -34,8 +19,8 @@ def recommend_sources(summary_text, api_key, skip_if_not_found=True, ai_provider
     """
     
     try:
-        response = llm.invoke(prompt)
-        keywords = response.content.strip()
+        from .llm_client import invoke
+        keywords = invoke(llm, prompt, ai_provider, use_cache=use_cache).strip()
         print(f"🔍 抽出されたキーワード: {keywords}")
     except Exception as e:
         print(f"⚠️ キーワード抽出エラー: {e}")
@@ -0,0 +1,194 @@
+import io
+import json
+import math
+import zlib
+import hashlib
+from collections import Counter
+from pathlib import Path
+
+from . import bm25_index, disk_store, text_cleaner
+
+# カテゴリのディレクトリ内の保存先（先頭が "." なので資料一覧・カテゴリ一覧には含まれない）
+SEMANTIC_DIRNAME = ".semantic"
+
+# 埋め込みの次元数（特徴ハッシュのバケット数）
+EMBEDDING_DIM = 512
+
+# 埋め込み・分割の方法を変えたら上げる（古いインデックスは作り直す）
+INDEX_VERSION = 1
+
+# 質問ごとに返す抜粋の数
+DEFAULT_TOP_K = 8
+
+_VECTORS_FILENAME = "vectors.npy"
+_META_FILENAME = "index.json.z"
+
+def _feature(token: str):
+    """トークンのバケット番号と符号（Python の hash() は起動ごとに変わるため crc32 を使う）"""
+    h = zlib.crc32(token.encode("utf-8"))
+    return h % EMBEDDING_DIM, 1.0 if (h // EMBEDDING_DIM) & 1 else -1.0
+
+def embed(texts):
+    """
+    テキストを埋め込みベクトルにする（ネットワーク不要の特徴ハッシュ）
+
+    トークン（日本語は文字 bigram、英数字は単語）を符号付きでバケットに割り当て、
+    出現回数は 1 + log(tf) で重み付けして L2 正規化する。
+    ベクトルは他の資料に依存しないため、変更のあった資料だけを埋め込み直せる。
+
+    Returns:
+        (len(texts), EMBEDDING_DIM) の float32 配列
+    """
+    import numpy as np
+
+    vectors = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for token, count in Counter(bm25_index.tokenize(text)).items():
+            bucket, sign = _feature(token)
+            vectors[row, bucket] += sign * (1 + math.log(count))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _document_key(item) -> str:
+    """
+    資料の識別キー（ファイルは内容ハッシュ、Web資料は本文のハッシュ + 定型文除去の規則のバージョン）
+
+    除去の規則が変わると同じ資料でも抜粋が変わるため、別の資料として埋め込み直す。
+    """
+    content_hash = item.get("hash") or hashlib.sha256(item["content"].encode("utf-8")).hexdigest()
+    return f"{content_hash}:{text_cleaner.CLEANER_VERSION}"
+
+class SemanticIndex:
+    """
+    抜粋の埋め込みベクトルと FAISS（内積 = コサイン類似度）による近傍検索
+
+    faiss-cpu がない環境では numpy の行列積で全件を比較する。
+    """
+
+    def __init__(self, chunks, vectors, documents=None):
+        self.chunks = chunks
+        self.vectors = vectors
+        self.documents = documents or []
+        self._faiss_index = None
+        try:
+            import faiss
+        except ImportError:
+            return
+        self._faiss_index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        if len(chunks):
+            self._faiss_index.add(vectors)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K) -> list:
+        """
+        質問と意味的に近い抜粋を検索
+
+        Returns:
+            (類似度, 抜粋の辞書) のリスト（類似度の高い順、該当なしは空）
+        """
+        import numpy as np
+
+        if not self.chunks:
+            return []
+        query_vector = embed([query])
+        if not query_vector.any():
+            return []
+        top_k = min(top_k, len(self.chunks))
+        if self._faiss_index is not None:
+            scores, ids = self._faiss_index.search(query_vector, top_k)
+            pairs = zip(scores[0], ids[0])
+        else:
+            all_scores = self.vectors @ query_vector[0]
+            ids = np.argpartition(-all_scores, top_k - 1)[:top_k]
+            pairs = sorted(((all_scores[i], i) for i in ids), reverse=True)
+        return [(float(score), self.chunks[int(i)]) for score, i in pairs if i >= 0 and score > 0]
+
+def _load(directory: Path):
+    """保存済みのインデックスを読み込む（存在しない・壊れている・形式が古い場合はNone）"""
+    import numpy as np
+
+    try:
+        with open(directory / _META_FILENAME, "rb") as f:
+            meta = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        vectors = np.load(directory / _VECTORS_FILENAME)
+    except (OSError, zlib.error, ValueError):
+        return None
+    if meta.get("version") != INDEX_VERSION or vectors.shape != (len(meta["chunks"]), EMBEDDING_DIM):
+        return None
+    return meta["documents"], meta["chunks"], vectors
+
+def _save(directory: Path, documents, chunks, vectors):
+    """一時ファイルに書いてから置き換え（ベクトル → 目次の順に書き、読み込み時に件数を照合）"""
+    import numpy as np
+
+    try:
+        directory.mkdir(exist_ok=True)
+        buffer = io.BytesIO()
+        np.save(buffer, vectors)
+        disk_store.atomic_write(directory / _VECTORS_FILENAME, buffer.getvalue())
+
+        meta = {"version": INDEX_VERSION, "documents": documents, "chunks": chunks}
+        disk_store.atomic_write(
+            directory / _META_FILENAME,
+            zlib.compress(json.dumps(meta, ensure_ascii=False).encode("utf-8"), 6),
+        )
+    except OSError as e:
+        print(f"⚠️ 意味検索インデックス保存エラー: {type(e).__name__}")
+
+def build_index(category_dir, text_data_list) -> SemanticIndex:
+    """
+    カテゴリの意味検索インデックスを作成（新規・変更された資料だけを埋め込み直す）
+
+    Args:
+        category_dir: カテゴリのディレクトリ（data/{category}）。存在しない場合は保存しない
+        text_data_list: {"content", "source", ("hash")} の辞書のリスト
+
+    Returns:
+        SemanticIndex
+    """
+    import numpy as np
+
+    directory = Path(category_dir) / SEMANTIC_DIRNAME
+    stored = _load(directory)
+    reusable = {}
+    if stored:
+        documents, chunks, vectors = stored
+        for doc in documents:
+            start, end = doc["rows"]
+            reusable[doc["key"]] = (chunks[start:end], vectors[start:end])
+
+    keys = [_document_key(item) for item in text_data_list]
+    changed = [item for item, key in zip(text_data_list, keys) if key not in reusable]
+    if changed:
+        # 定型文は全資料から検出する（整形済みの資料ならそのまま）
+        text_data_list, _ = text_cleaner.clean_documents(text_data_list)
+
+    documents, all_chunks, parts = [], [], []
+    embedded = 0
+    renamed = 0
+    for item, key in zip(text_data_list, keys):
+        if key in reusable:
+            doc_chunks, doc_vectors = reusable[key]
+            # 内容が同じでもファイル名が変わっている場合がある（出典は現在の資料の名前にし、名前を含めて埋め込み直す）
+            if any(chunk["source"] != item["source"] for chunk in doc_chunks):
+                doc_chunks = [dict(chunk, source=item["source"]) for chunk in doc_chunks]
+                doc_vectors = embed([f"{c['source']}\n{c['text']}" for c in doc_chunks])
+                renamed += 1
+        else:
+            doc_chunks = bm25_index.make_chunks([item])
+            doc_vectors = embed([f"{c['source']}\n{c['text']}" for c in doc_chunks])
+            embedded += 1
+        documents.append({"key": key, "source": item["source"], "rows": [len(all_chunks), len(all_chunks) + len(doc_chunks)]})
+        all_chunks.extend(doc_chunks)
+        parts.append(doc_vectors)
+
+    vectors = np.vstack(parts).astype(np.float32) if parts else np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    # 同じ内容の資料が複数ある場合もあるので、キーの集合で比べる
+    removed = len(set(reusable) - set(keys))
+    if (embedded or removed or renamed or not stored) and Path(category_dir).is_dir():
+        _save(directory, documents, all_chunks, vectors)
+    print(f"🧭 意味検索インデックス: {len(all_chunks)}件の抜粋（再利用 {len(text_data_list) - embedded} / 埋め込み {embedded} 資料）")
+    return SemanticIndex(all_chunks, np.ascontiguousarray(vectors), documents)
@@ -1,166 +1,674 @@
-def generate_summary(text_data_list, api_key, output_language="ja", ai_provider="gemini"):
+from concurrent.futures import ThreadPoolExecutor
+
+from . import llm_client, token_budget
+
+# 1回のプロンプトで要約する最大文字数（これを超えると map-reduce で要約）
+SINGLE_PASS_MAX_CHARS = 60000
+
+# map 段階で1回に送る最大トークン数（大きい資料はこの単位に分割）
+MAP_CHUNK_TOKENS = 30000
+
+# map 段階の同時実行数（APIのレート制限に合わせて調整）
+MAP_MAX_CONCURRENCY = 4
+
+# reduce 段階で1回に統合する部分要約の最大トークン数（超える場合は段階的に統合）
+REDUCE_MAX_TOKENS = 60000
+
+# 部分要約プロンプトのバージョン（プロンプトを変えたら上げる。保存済みの部分要約を使わなくなる）
+MAP_PROMPT_VERSION = 1
+
+# まとめ（全体の流れ）生成に渡す資料の最大文字数
+INTEGRATION_MAX_CHARS = 8000
+
+# ストリーミング中に応答が届かない場合に状態を返す間隔（秒）
+STREAM_HEARTBEAT_SECONDS = 1.0
+
+# 指示文など資料以外のプロンプトのトークン数（入力予算から差し引く）
+PROMPT_OVERHEAD_TOKENS = 600
+
+# 処理時間の推定に使う出力トークン数（部分要約・学習ノート・まとめ）
+MAP_OUTPUT_TOKENS = 1500
+SUMMARY_OUTPUT_TOKENS = 4000
+INTEGRATION_OUTPUT_TOKENS = 1500
+
+def _invoke_with_retry(llm, prompt, error_label, provider, on_delta=None, use_cache=True):
     """
-    Generates a summary from a list of text data.
-    text_data_list: List of dicts with 'content' and 'source'.
-    output_language: 'ja' for Japanese, 'en' for English, etc.
-    ai_provider: 'gemini' or 'openai'
+    LLMを呼び出す（レート制限の待機・再試行は共有リミッターが行う）
+
+    Args:
+        llm: LangChain のチャットモデル
+        prompt: プロンプト
+        error_label: エラーメッセージに使う処理名（例: "要約生成"）
+        provider: 'gemini' or 'openai'（応答キャッシュ・リミッターのキーに使用）
+        on_delta: 指定するとストリーミングで呼び出し、届いた断片ごとに on_delta(断片) を呼ぶ
+        use_cache: False の場合は応答キャッシュを使わない
+
+    Returns:
+        (出力テキスト or エラーメッセージ, 成功したかどうか) のタプル
     """
-    import os
-    
-    # 環境変数に確実にAPIキーを設定
-    if ai_provider == "openai":
-        os.environ["OPENAI_API_KEY"] = api_key
-    else:
-        os.environ["GOOGLE_API_KEY"] = api_key
-    
-    # Lazy imports to prevent startup errors
-    if ai_provider == "openai":
-        from langchain_openai import ChatOpenAI
-        llm = ChatOpenAI(model="gpt-3.5-turbo", openai_api_key=api_key, temperature=0.7)
-    else:
-        from langchain_google_genai import ChatGoogleGenerativeAI
-        # Geminiの最新モデル名（temperature設定で高速化）
-        # APIキーを明示的に渡す
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp",  # 最新の高速モデル
-            google_api_key=api_key,  # APIキーを明示的に渡す
-            temperature=0.3,  # 低温度で高速化と一貫性向上
-            max_tokens=4096   # トークン数制限で高速化
-        )
-    
-    if not text_data_list:
-        return {"summary": "No content to summarize.", "integration": "No content available."}
+    from .rate_limiter import is_rate_limit_error
 
-    # 言語設定
-    language_instruction = {
-        "ja": "すべての出力は日本語で記述してください。",
-        "en": "Please write all output in English."
-    }.get(output_language, "すべての出力は日本語で記述してください。")
+    # モデルの入力上限を超えるプロンプトは送信しない（APIのエラーで待たされるだけなので）
+    try:
+        token_budget.check_prompt(prompt, llm_client.model_name(llm))
+    except ValueError as e:
+        return f"⚠️ {error_label}エラー: {str(e).lstrip('❌ ')}", False
 
-    # Combine all text content
-    full_text = ""
-    for item in text_data_list:
-        full_text += f"\n\n--- Source: {item['source']} ---\n"
-        full_text += item['content']
+    try:
+        if on_delta is None:
+            return llm_client.invoke(llm, prompt, provider, use_cache=use_cache), True
+        chunks = []
+        for delta in llm_client.stream(llm, prompt, provider, use_cache=use_cache):
+            chunks.append(delta)
+            on_delta(delta)
+        return "".join(chunks), True
+    except Exception as e:
+        if is_rate_limit_error(e):
+            return f"⚠️ {error_label}エラー: APIのレート制限に達しました。30秒後に再試行してください。", False
+        return f"⚠️ {error_label}エラー: {type(e).__name__} - {str(e)[:100]}", False
 
-    # LLM is already initialized above based on ai_provider
+def _build_full_text(text_data_list):
+    """すべての資料をソース名付きで結合"""
+    return "".join(f"\n\n--- Source: {item['source']} ---\n{item['content']}" for item in text_data_list)
 
-    # 1. Generate Summary（プロンプト最適化で高速化）
-    summary_prompt = f"""
+def _summary_prompt(language_instruction, material):
+    """統合学習ノート（要約）のプロンプト"""
+    return f"""
     {language_instruction}
-    
+
     複数の講義資料を統合し、重複を整理して体系的な学習ノートを作成してください。
-    
+
     【必須要件】
     1. 同じトピックは統合して1つにまとめる
     2. 共通テーマで見出しを作成
     3. すべての重要情報を含める
     4. 各セクションに出典を明記: `[出典: ファイル名]`
     5. LaTeX数式を保持: $E=mc^2$, $\\\\frac{{d}}{{dx}}$
-    
+
     【出力形式】
     # [タイトル]
-    
+
     ## 1. [トピック名]
     - 詳細解説
     - 具体例
     `[出典: ファイル名]`
-    
+
     ## 📚 重要用語集
     - 用語: 定義
-    
+
     【資料】
-    {full_text}
-    """
-    
-    import time
-    max_retries = 3  # リトライ回数削減（高速化）
-    retry_delay = 10  # 10秒待機（高速化）
-    
-    summary_result = None
-    
-    # Generate Summary
-    print("📝 要約を生成中...")
-    for attempt in range(max_retries):
-        try:
-            response = llm.invoke(summary_prompt)
-            summary_result = response.content
-            print("✅ 要約生成完了")
-            break
-        except Exception as e:
-            error_str = str(e)
-            if "RESOURCE_EXHAUSTED" in error_str or "429" in error_str or "TOO_MANY_REQUESTS" in error_str:
-                if attempt < max_retries - 1:
-                    wait_time = retry_delay * (attempt + 1)
-                    print(f"⏳ レート制限: {wait_time}秒待機中... (試行 {attempt+1}/{max_retries})")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    summary_result = f"⚠️ 要約生成エラー: APIのレート制限に達しました。30秒後に再試行してください。"
-            else:
-                summary_result = f"⚠️ 要約生成エラー: {type(e).__name__} - {str(e)[:100]}"
-            break
-    
-    if not summary_result:
-        summary_result = "⚠️ 要約生成エラーが発生しました"
-    
-    # 2. Generate Integration Summary (まとめ) - 待機時間なし（高速化）
-    integration_prompt = f"""
+    {material}
+    """
+
+def _map_prompt(language_instruction, source, content, part_label=""):
+    """map 段階: 1つの講義資料（またはその一部）の部分要約のプロンプト"""
+    return f"""
     {language_instruction}
-    
+
+    以下の講義資料{part_label}の内容を、後で他の資料と統合するための部分要約にしてください。
+
+    【必須要件】
+    1. 重要な概念・定義・具体例・数式をすべて残す
+    2. トピックごとに箇条書きで整理する
+    3. LaTeX数式を保持: $E=mc^2$
+    4. 出典を明記: `[出典: {source}]`
+
+    【資料】
+    --- Source: {source} ---
+    {content}
+    """
+
+def _combine_prompt(language_instruction, material):
+    """段階的な統合: 複数の部分要約を1つの部分要約にまとめるプロンプト"""
+    return f"""
+    {language_instruction}
+
+    以下の部分要約を重複を整理して1つの部分要約にまとめてください。
+    重要な概念・定義・数式と出典 `[出典: ファイル名]` はすべて残してください。
+
+    【部分要約】
+    {material}
+    """
+
+def _material_tokens(model, max_tokens):
+    """1回のプロンプトに入れる資料の最大トークン数（モデルの入力予算に収まるように調整）"""
+    return max(1000, min(max_tokens, token_budget.input_budget(model, PROMPT_OVERHEAD_TOKENS)))
+
+def _map_units(text_data_list, model=""):
+    """
+    map 段階の処理単位に分割（1講義 = 1単位、大きい資料は複数単位）
+
+    Returns:
+        (ソース名, 部分ラベル, テキスト) のリスト
+    """
+    units = []
+    max_tokens = _material_tokens(model, MAP_CHUNK_TOKENS)
+    for item in text_data_list:
+        chunks = token_budget.split_to_budget(item['content'], max_tokens)
+        for index, chunk in enumerate(chunks, 1):
+            part_label = f"（{index}/{len(chunks)}部）" if len(chunks) > 1 else ""
+            units.append((item['source'], part_label, chunk))
+    return units
+
+def _run_parallel(llm, prompts, error_label, max_concurrency, provider, use_cache=True):
+    """
+    複数のプロンプトを同時実行数を制限して並列に実行（結果は入力と同じ順序）
+
+    Returns:
+        (出力テキスト or エラーメッセージ, 成功したかどうか) のリスト
+    """
+    if not prompts:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(prompts)))) as executor:
+        return list(executor.map(
+            lambda prompt: _invoke_with_retry(llm, prompt, error_label, provider, use_cache=use_cache), prompts
+        ))
+
+def _digest_key(item, language_instruction, provider, model, temperature):
+    """講義1つ分の部分要約の保存キー（内容ハッシュのない資料は None）"""
+    from . import digest_store
+
+    if not item.get("hash"):
+        return None
+    return digest_store.make_key(
+        item["hash"],
+        item["source"],
+        language=language_instruction,
+        provider=provider,
+        model=model,
+        temperature=temperature,
+        chunk_tokens=MAP_CHUNK_TOKENS,
+        prompt_version=MAP_PROMPT_VERSION,
+    )
+
+def _uncached_documents(text_data_list, language_instruction, provider, model, temperature):
+    """部分要約が保存されていない資料（map 段階で要約が必要な資料）"""
+    from . import digest_store
+
+    uncached = []
+    for item in text_data_list:
+        key = _digest_key(item, language_instruction, provider, model, temperature)
+        if not key or not digest_store.has_digests(key):
+            uncached.append(item)
+    return uncached
+
+def _map_stage(llm, text_data_list, language_instruction, max_concurrency, provider, use_cache=True):
+    """
+    map 段階: 各講義（チャンク）を並列に部分要約
+
+    内容ハッシュのある資料は部分要約を保存しておき、内容が変わっていなければ再利用する
+    （講義が1つ追加された場合、要約し直すのはその講義だけ）。use_cache が False の場合は
+    保存済みの部分要約も使わずにすべて要約し直す（結果は保存する）。
+
+    Returns:
+        ([(ソース名+部分ラベル, 部分要約), ...], [(ソース名+部分ラベル, エラーメッセージ), ...]) のタプル
+        部分要約には成功した部分だけを含め、失敗した部分は2つ目のリストで返す
+    """
+    from . import digest_store
+
+    doc_digests = [None] * len(text_data_list)
+    doc_keys = [None] * len(text_data_list)
+    units = []
+    for index, item in enumerate(text_data_list):
+        doc_keys[index] = _digest_key(
+            item, language_instruction, provider, llm_client.model_name(llm), getattr(llm, "temperature", None)
+        )
+        if doc_keys[index]:
+            doc_digests[index] = digest_store.get_digests(doc_keys[index]) if use_cache else None
+            if doc_digests[index] is not None:
+                continue
+        units.extend((index,) + unit for unit in _map_units([item], llm_client.model_name(llm)))
+
+    reused = sum(1 for digests in doc_digests if digests is not None)
+    if reused:
+        print(f"♻️ {reused}件の講義は保存済みの部分要約を再利用")
+    print(f"🗺️ map段階: {len(units)}個の部分を並列要約中... (同時実行数: {max_concurrency})")
+    map_results = _run_parallel(
+        llm,
+        [_map_prompt(language_instruction, source, content, part_label) for _, source, part_label, content in units],
+        "部分要約生成",
+        max_concurrency,
+        provider,
+        use_cache,
+    )
+
+    new_digests = {}
+    failed_docs = set()
+    failures = []
+    for (index, source, part_label, _), (text, ok) in zip(units, map_results):
+        if not ok:
+            # エラーメッセージを講義の内容として統合しないように、部分要約からは除く
+            print(f"⚠️ 部分要約に失敗: {source}{part_label}")
+            failed_docs.add(index)
+            failures.append((f"{source}{part_label}", text))
+            continue
+        new_digests.setdefault(index, []).append((f"{source}{part_label}", text))
+
+    # すべての部分が成功した講義だけ保存（失敗した講義は次回要約し直す）
+    for index, digests in new_digests.items():
+        if index not in failed_docs and doc_keys[index]:
+            digest_store.put_digests(doc_keys[index], digests)
+        doc_digests[index] = digests
+
+    digests = [digest for item_digests in doc_digests if item_digests for digest in item_digests]
+    return digests, failures
+
+def _failure_note(failures) -> str:
+    """要約に含まれていない（部分要約に失敗した）部分を知らせる注記"""
+    if not failures:
+        return ""
+    return "\n\n⚠️ 部分要約の生成に失敗したため、次の部分は要約に含まれていません: " + "、".join(
+        label for label, _ in failures
+    )
+
+def _reduce_stage(llm, digests, language_instruction, max_concurrency, provider, on_delta=None, use_cache=True):
+    """
+    reduce 段階: 部分要約を1つの学習ノートに統合（多すぎる場合は段階的に統合）
+    """
+    merged = [f"--- 部分要約: {label} ---\n{text}" for label, text in digests]
+    reduce_tokens = _material_tokens(llm_client.model_name(llm), REDUCE_MAX_TOKENS)
+    while len(merged) > 1 and token_budget.estimate_tokens("\n\n".join(merged)) > reduce_tokens:
+        # 入力予算に収まるバッチに詰める（1つで予算を超える部分要約は分割される）
+        batches = token_budget.pack_sources([(str(index), text) for index, text in enumerate(merged)], reduce_tokens)
+        if len(batches) >= len(merged):
+            break  # 1つずつしか入らない場合はこれ以上まとめられない
+        print(f"🔁 部分要約を段階的に統合中... ({len(merged)} → {len(batches)})")
+        combined = _run_parallel(
+            llm,
+            [
+                _combine_prompt(language_instruction, "\n\n".join(part for *_, part in batch["parts"]))
+                for batch in batches
+            ],
+            "部分要約統合",
+            max_concurrency,
+            provider,
+            use_cache,
+        )
+        merged = [text for text, _ in combined]
+
+    print("🧩 reduce段階: 部分要約を統合中...")
+    summary_result, _ = _invoke_with_retry(
+        llm, _summary_prompt(language_instruction, "\n\n".join(merged)), "要約生成", provider, on_delta, use_cache
+    )
+    return summary_result
+
+def _integration_prompt(language_instruction, material):
+    """全体まとめのプロンプト"""
+    return f"""
+    {language_instruction}
+
     複数の資料から最重要ポイントと全体の流れをまとめてください。
-    
+
     【必須要件】
     1. 最も重要な3~5つのポイントを明確に
     2. 各資料の関係性と流れを示す
     3. 出典を明記: `[出典: ファイル名]`
-    
+
     【出力形式】
     # 📌 全体まとめ
-    
+
     ## 【最重要ポイント】
     - ポイント1 `[出典: ファイル名]`
     - ポイント2 `[出典: ファイル名]`
-    
+
     ## 【全体の流れ】
     [資料全体の流れを簡潔に説明]
-    
+
     ## 【実践的応用】
     [学んだことの活用方法]
-    
+
     【資料】
-    {full_text[:5000]}
-    """
-    
-    integration_result = None
-    
-    # Generate Integration Summary
-    print("📋 まとめを生成中...")
-    for attempt in range(max_retries):
+    {material}
+    """
+
+def _lecture_digests(texts_by_source, max_chars=INTEGRATION_MAX_CHARS):
+    """
+    講義ごとのダイジェストを作成（文字数の上限を全講義に均等に割り当てる）
+
+    先頭の資料だけで上限を使い切らないように、すべての講義を少しずつ含める。
+
+    Args:
+        texts_by_source: (ソース名, テキスト) のリスト
+
+    Returns:
+        まとめ用の資料テキスト
+    """
+    if not texts_by_source:
+        return ""
+    per_item = max(200, max_chars // len(texts_by_source))
+    parts = []
+    for source, text in texts_by_source:
+        excerpt = text.strip()
+        if len(excerpt) > per_item:
+            excerpt = excerpt[:per_item] + "…"
+        parts.append(f"--- Source: {source} ---\n{excerpt}")
+    return "\n\n".join(parts)
+
+def _choose_mode(full_text, mode, model, has_cached_digests=False):
+    """
+    要約方式を決定（1回のプロンプトがモデルの入力上限を超える場合は map-reduce に切り替え）
+
+    auto の場合、map-reduce は「講義数 + 2回」の呼び出しになるため、資料が大きい場合と
+    保存済みの部分要約を再利用できる場合だけ使う。それ以外は1回で要約し（呼び出し2回）、
+    部分要約は map-reduce が必要になったときに作る。
+    """
+    if mode == "auto":
+        over_budget = len(full_text) > SINGLE_PASS_MAX_CHARS
+        mode = "map_reduce" if over_budget or has_cached_digests else "single"
+    if mode == "single" and token_budget.estimate_tokens(full_text) > token_budget.input_budget(model, PROMPT_OVERHEAD_TOKENS):
+        print("📐 資料がモデルの入力上限を超えるため map-reduce で要約します")
+        mode = "map_reduce"
+    return mode
+
+def plan_summary(text_data_list, ai_provider="gemini", mode="auto", max_concurrency=MAP_MAX_CONCURRENCY,
+                 output_language="ja", use_cache=True):
+    """
+    要約を実行する前に、資料の分割方法・呼び出し回数・処理時間を見積もる（APIは呼ばない）
+
+    Args:
+        text_data_list: generate_summary と同じ資料のリスト
+        ai_provider: 'gemini' / 'openai' / 'local'（APIキー不要のスタブ）
+        mode: generate_summary と同じ要約方式
+        max_concurrency: map 段階の同時実行数
+        output_language: generate_summary と同じ出力言語（保存済みの部分要約の確認に使用）
+        use_cache: generate_summary と同じ（False の場合は保存済みの部分要約を使わない前提で見積もる）
+
+    Returns:
+        mode / model / total_tokens / input_budget / map_calls / calls /
+        estimated_seconds / description / tokens_saved（定型文除去で減ったトークン数）を含む辞書
+    """
+    import math
+
+    from .text_cleaner import clean_documents
+
+    model = llm_client.DEFAULT_MODELS.get(ai_provider, "")
+    text_data_list, clean_stats = clean_documents(text_data_list)
+    full_text = _build_full_text(text_data_list)
+    total_tokens = token_budget.estimate_tokens(full_text)
+    budget = token_budget.input_budget(model, PROMPT_OVERHEAD_TOKENS)
+    # map 段階で要約し直す資料（保存済みの部分要約は再利用される）
+    uncached = text_data_list
+    if use_cache:
+        uncached = _uncached_documents(
+            text_data_list, _language_instruction(output_language), ai_provider, model,
+            _llm_settings(ai_provider)["temperature"],
+        )
+    mode = _choose_mode(full_text, mode, model, len(uncached) < len(text_data_list))
+
+    integration_seconds = token_budget.estimate_call_seconds(
+        min(total_tokens, token_budget.estimate_tokens(full_text[:INTEGRATION_MAX_CHARS])), INTEGRATION_OUTPUT_TOKENS
+    )
+    if mode == "single":
+        map_calls = 0
+        calls = 2
+        # まとめは完成した要約から作るので、要約の後に続けて実行される
+        summary_seconds = token_budget.estimate_call_seconds(total_tokens, SUMMARY_OUTPUT_TOKENS)
+        summary_seconds += token_budget.estimate_call_seconds(SUMMARY_OUTPUT_TOKENS, INTEGRATION_OUTPUT_TOKENS)
+        integration_seconds = 0
+        description = f"一括要約: 約{total_tokens:,}トークン（入力上限 {budget:,}）を1回で要約 → まとめ1回"
+    else:
+        unit_tokens = [token_budget.estimate_tokens(content) for _, _, content in _map_units(uncached, model)]
+        map_calls = len(unit_tokens)
+        reused = len(text_data_list) - len(uncached)
+        concurrency = max(1, max_concurrency)
+        # 同時実行数ごとの「波」で処理されるので、各波で最も大きい部分の時間がかかる
+        map_seconds = sum(
+            token_budget.estimate_call_seconds(max(unit_tokens[i:i + concurrency]), MAP_OUTPUT_TOKENS)
+            for i in range(0, map_calls, concurrency)
+        )
+        reduce_tokens = _material_tokens(model, REDUCE_MAX_TOKENS)
+        digest_tokens = (map_calls + reused) * MAP_OUTPUT_TOKENS
+        merge_rounds = 0
+        while digest_tokens > reduce_tokens and merge_rounds < 5:
+            digest_tokens = math.ceil(digest_tokens / reduce_tokens) * MAP_OUTPUT_TOKENS
+            merge_rounds += 1
+        calls = map_calls + merge_rounds + 2
+        summary_seconds = map_seconds + token_budget.estimate_call_seconds(
+            min(digest_tokens, reduce_tokens), SUMMARY_OUTPUT_TOKENS
+        ) * (merge_rounds + 1)
+        description = (
+            f"map-reduce: 約{total_tokens:,}トークンを{len(text_data_list)}資料・{map_calls}部分に分割"
+            f"（同時{concurrency}件, 1回あたり上限 {_material_tokens(model, MAP_CHUNK_TOKENS):,}トークン）"
+            + (f"・{reused}資料は保存済みの部分要約を再利用" if reused else "")
+            + (f" → 段階統合{merge_rounds}回" if merge_rounds else "")
+            + " → 統合1回 + まとめ1回"
+        )
+
+    # map-reduce では要約とまとめは並行して実行される
+    estimated_seconds = max(summary_seconds, integration_seconds)
+    return {
+        "mode": mode,
+        "model": model,
+        "total_tokens": total_tokens,
+        "input_budget": budget,
+        "map_calls": map_calls,
+        "calls": calls,
+        "estimated_seconds": int(math.ceil(estimated_seconds)),
+        "description": description,
+        "tokens_saved": clean_stats["tokens_saved"],
+    }
+
+def generate_summary(text_data_list, api_key, output_language="ja", ai_provider="gemini",
+                     mode="auto", max_concurrency=MAP_MAX_CONCURRENCY, integration_source="digests",
+                     use_cache=True):
+    """
+    Generates a summary from a list of text data.
+    text_data_list: List of dicts with 'content' and 'source' (and 'hash' for files).
+          Boilerplate is removed first unless the list was already passed
+          through text_cleaner.clean_documents.
+    output_language: 'ja' for Japanese, 'en' for English, etc.
+    ai_provider: 'gemini', 'openai' or 'local' (offline deterministic stub)
+    mode: 'single' (one prompt), 'map_reduce' (summarize each lecture/chunk
+          in parallel, then merge) or 'auto' (map_reduce for large corpora and
+          when stored per-lecture digests can be reused by content hash)
+    max_concurrency: maximum number of parallel map-stage requests
+    integration_source: material for the integration (まとめ) prompt
+          'digests' (map_reduce: the per-lecture digests, runs concurrently
+          with the summary; single: the finished summary, runs after it),
+          'summary' (the finished summary, runs after it) or
+          'raw' (raw excerpt: the first 5000 chars of the material, runs
+          concurrently)
+          If the summary fails, raw excerpts of each lecture are used instead.
+    use_cache: False to bypass cached responses and stored digests (per-session setting)
+    """
+    if not text_data_list:
+        return {"summary": "No content to summarize.", "integration": "No content available."}
+
+    llm, text_data_list, language_instruction, full_text, mode = _prepare(
+        text_data_list, api_key, output_language, ai_provider, mode, use_cache=use_cache
+    )
+    return _run_stages(
+        llm, text_data_list, language_instruction, full_text, mode, ai_provider, max_concurrency, integration_source,
+        use_cache=use_cache,
+    )
+
+def generate_summary_stream(text_data_list, api_key, output_language="ja", ai_provider="gemini",
+                            mode="auto", max_concurrency=MAP_MAX_CONCURRENCY, integration_source="digests",
+                            use_cache=True):
+    """
+    Streaming variant of generate_summary (same arguments).
+    Yields event dicts as text arrives:
+      {"stage": "summary" | "integration", "text": delta}  generated text fragments
+      {"stage": "status", "text": message or None}        progress (None = heartbeat while waiting)
+      {"stage": "done", "summary": str, "integration": str}  final result (always last)
+    The summary and integration stream concurrently; in map_reduce mode the
+    summary starts streaming once the map stage is finished.
+    """
+    import queue
+    import threading
+
+    if not text_data_list:
+        yield {"stage": "done", "summary": "No content to summarize.", "integration": "No content available."}
+        return
+
+    events = queue.Queue()
+    result = {}
+
+    def worker():
         try:
-            response = llm.invoke(integration_prompt)
-            integration_result = response.content
-            print("✅ まとめ生成完了")
-            break
+            llm, cleaned_list, language_instruction, full_text, stage_mode = _prepare(
+                text_data_list, api_key, output_language, ai_provider, mode,
+                notify=lambda message: events.put(("status", message)), use_cache=use_cache,
+            )
+            result.update(_run_stages(
+                llm, cleaned_list, language_instruction, full_text, stage_mode, ai_provider,
+                max_concurrency, integration_source, on_event=lambda stage, text: events.put((stage, text)),
+                use_cache=use_cache,
+            ))
         except Exception as e:
-            error_str = str(e)
-            if "RESOURCE_EXHAUSTED" in error_str or "429" in error_str or "TOO_MANY_REQUESTS" in error_str:
-                if attempt < max_retries - 1:
-                    wait_time = retry_delay * (attempt + 1)
-                    print(f"⏳ レート制限: {wait_time}秒待機中... (試行 {attempt+1}/{max_retries})")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    integration_result = f"⚠️ まとめ生成エラー: APIのレート制限に達しました。30秒後に再試行してください。"
-            else:
-                integration_result = f"⚠️ まとめ生成エラー: {type(e).__name__} - {str(e)[:100]}"
+            result["error"] = e
+        finally:
+            events.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+    while True:
+        try:
+            event = events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+        except queue.Empty:
+            # 待機中もキャンセル確認や経過時間の表示ができるように定期的に返す
+            yield {"stage": "status", "text": None}
+            continue
+        if event is None:
             break
-    
+        yield {"stage": event[0], "text": event[1]}
+
+    if "error" in result:
+        raise result["error"]
+    yield {"stage": "done", "summary": result["summary"], "integration": result["integration"]}
+
+def _llm_settings(ai_provider):
+    """要約に使うチャットモデルの設定"""
+    # Geminiは低温度で高速化と一貫性向上・トークン数制限で高速化
+    if ai_provider == "openai":
+        return {"temperature": 0.7}
+    return {"temperature": 0.3, "max_tokens": 4096}
+
+def _language_instruction(output_language):
+    """出力言語の指示文"""
+    return {
+        "ja": "すべての出力は日本語で記述してください。",
+        "en": "Please write all output in English."
+    }.get(output_language, "すべての出力は日本語で記述してください。")
+
+def _prepare(text_data_list, api_key, output_language, ai_provider, mode, notify=None, use_cache=True):
+    """
+    チャットモデル・言語指示・結合テキスト・要約方式を準備
+
+    資料はページをまたいで繰り返されるヘッダー・フッター・ページ番号を除いてから使う
+    （text_cleaner.clean_documents で整形済みの資料はそのまま使う）。
+
+    Returns:
+        (llm, 定型文を除いた資料のリスト, language_instruction, full_text, mode) のタプル
+    """
+    from .text_cleaner import clean_documents, format_stats
+
+    text_data_list, clean_stats = clean_documents(text_data_list)
+    print(format_stats(clean_stats))
+    if notify is not None:
+        notify(format_stats(clean_stats))
+
+    llm = llm_client.get_llm(ai_provider, api_key, **_llm_settings(ai_provider))
+    language_instruction = _language_instruction(output_language)
+
+    # Combine all text content
+    full_text = _build_full_text(text_data_list)
+
+    model = llm_client.model_name(llm)
+    has_cached = mode == "auto" and use_cache and len(_uncached_documents(
+        text_data_list, language_instruction, ai_provider, model, getattr(llm, "temperature", None)
+    )) < len(text_data_list)
+    mode = _choose_mode(full_text, mode, model, has_cached)
+    return llm, text_data_list, language_instruction, full_text, mode
+
+def _run_stages(llm, text_data_list, language_instruction, full_text, mode, ai_provider,
+                max_concurrency, integration_source, on_event=None, use_cache=True):
+    """
+    要約とまとめを生成（on_event を指定するとストリーミングで on_event(段階, 断片) を呼ぶ）
+
+    Returns:
+        {"summary", "integration"} の辞書
+    """
+    def delta_handler(stage):
+        if on_event is None:
+            return None
+        return lambda delta: on_event(stage, delta)
+
+    def notify(message):
+        print(message)
+        if on_event is not None:
+            on_event("status", message)
+
+    # 要約とまとめは別スレッドで同時に生成（まとめは要約の完了を待たない）
+    with ThreadPoolExecutor(max_workers=2) as stage_pool:
+        # 1. Generate Summary（プロンプト最適化で高速化）
+        notify("📝 要約を生成中...")
+        digests = None
+        if mode == "map_reduce":
+            notify("🗺️ 講義ごとの部分要約を作成中...")
+            digests, failures = _map_stage(
+                llm, text_data_list, language_instruction, max_concurrency, ai_provider, use_cache
+            )
+            if digests:
+                notify("🧩 部分要約を統合中...")
+
+                def reduce_summary():
+                    summary = _reduce_stage(
+                        llm, digests, language_instruction, max_concurrency, ai_provider,
+                        delta_handler("summary"), use_cache,
+                    )
+                    # 失敗した部分は統合せず、要約の末尾で知らせる
+                    note = _failure_note(failures)
+                    if note and on_event is not None:
+                        on_event("summary", note)
+                    return summary + note
+
+                summary_future = stage_pool.submit(reduce_summary)
+            else:
+                # 成功した部分が1つもない（すべて失敗した、または要約できる内容がない）
+                message = failures[0][1] if failures else "⚠️ 要約生成エラー: 要約できる内容が資料にありませんでした"
+                summary_future = stage_pool.submit(lambda: message)
+                digests = None
+        else:
+            summary_future = stage_pool.submit(
+                lambda: _invoke_with_retry(
+                    llm, _summary_prompt(language_instruction, full_text), "要約生成", ai_provider,
+                    delta_handler("summary"), use_cache,
+                )[0]
+            )
+
+        # 2. Generate Integration Summary (まとめ) - 生の資料の先頭ではなく、要約済みの内容から
+        if integration_source == "raw":
+            integration_material = full_text[:5000]
+        elif integration_source == "digests" and digests:
+            # map 段階の部分要約を講義ごとに切り詰めて使う（追加のAPI呼び出しなし・要約と並行して生成）
+            integration_material = _lecture_digests(digests)
+        else:
+            # 一括要約（部分要約がない）の場合は、完成した要約を待ってから使う
+            summary_text = summary_future.result()
+            if summary_text and not summary_text.startswith("⚠️"):
+                integration_material = summary_text[:INTEGRATION_MAX_CHARS]
+            else:
+                # 要約に失敗した場合だけ、資料の抜粋（講義ごとの先頭部分）を使う
+                integration_material = _lecture_digests([(item['source'], item['content']) for item in text_data_list])
+
+        notify("📋 まとめを生成中...")
+        integration_future = stage_pool.submit(
+            _invoke_with_retry, llm, _integration_prompt(language_instruction, integration_material), "まとめ生成",
+            ai_provider, delta_handler("integration"), use_cache,
+        )
+
+        summary_result = summary_future.result()
+        print("✅ 要約生成完了")
+        integration_result, _ = integration_future.result()
+        print("✅ まとめ生成完了")
+
+    if not summary_result:
+        summary_result = "⚠️ 要約生成エラーが発生しました"
+
     if not integration_result:
         integration_result = "⚠️ まとめ生成エラーが発生しました"
-    
+
     return {
         "summary": summary_result or "エラーが発生しました",
         "integration": integration_result or "エラーが発生しました"
     }
-
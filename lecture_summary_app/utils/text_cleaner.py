@@ -0,0 +1,258 @@
+import re
+import unicodedata
+from collections import Counter
+
+from . import page_store, token_budget
+
+# 定型文・ページ番号の除去規則を変えたら上げる（整形済みの資料から作った保存済みの索引を作り直す）
+CLEANER_VERSION = 1
+
+# 資料のページの何割以上に出現する行をヘッダー・フッター等の定型文とみなすか
+BOILERPLATE_PAGE_RATIO = 0.5
+
+# ページ単位で判定する資料の最小ページ数（ページが少ないと偶然の重複と区別できない）
+MIN_PAGES_FOR_DETECTION = 4
+
+# 定型文とみなす行の文字数の範囲（短い行は数式の断片 "x" "=" 等、長い行は本文の可能性が高いので残す）
+MIN_BOILERPLATE_LINE_CHARS = 4
+MAX_BOILERPLATE_LINE_CHARS = 120
+
+# ページの先頭・末尾から何行までをページ番号の候補とするか
+PAGE_EDGE_LINES = 2
+
+# 「ページ」等の表記が付いたページ番号だけの行（"p. 12", "Page 12 of 30", "12ページ" 等）
+_PAGE_LABEL_REGEX = re.compile(
+    r"^[-–—\s]*(?:(?:p\.?|page|ページ|slide)\s*\d{1,4}(?:\s*(?:/|of)\s*\d{1,4})?\s*(?:ページ|頁)?"
+    r"|\d{1,4}\s*(?:ページ|頁))[-–—\s]*$",
+    re.IGNORECASE,
+)
+
+# 数字だけのページ番号の行（"12", "- 12 -", "12 / 30", "12 of 30"）
+# 分数（3/6）や符号付きの数（-1）も同じ形で抽出されるため、ページの端にある場合のみページ番号とみなす
+_PAGE_NUMBER_REGEX = re.compile(
+    r"^[-–—\s]*\d{1,4}\s*(?:(?:/|of)\s*\d{1,4})?[-–—\s]*$",
+    re.IGNORECASE,
+)
+
+# 全角英数字・記号（！～）、全角スペース、半角カナ
+_FULLWIDTH_REGEX = re.compile(r"[！-～　ｦ-ﾟ]+")
+
+# 文字（かな・漢字・英字）を含むか（記号と数字だけの行は数式の一部の可能性がある）
+_LETTER_REGEX = re.compile(r"[^\W\d_]")
+
+_SPACES_REGEX = re.compile(r"[ \t ]+")
+_BLANK_LINES_REGEX = re.compile(r"\n{3,}")
+
+def normalize_width(text: str) -> str:
+    """
+    全角英数字・記号・スペースを半角に、半角カナを全角にする（NFKC）
+
+    数式の上付き文字（x²）や丸数字などは意味が変わるため、NFKC は全角/半角の文字だけに適用する。
+    """
+    return _FULLWIDTH_REGEX.sub(lambda m: unicodedata.normalize("NFKC", m.group(0)), text)
+
+def normalize_whitespace(text: str) -> str:
+    """行内の連続する空白を1つにし、行末の空白と3行以上の空行をまとめる"""
+    lines = [_SPACES_REGEX.sub(" ", line).strip() for line in text.splitlines()]
+    return _BLANK_LINES_REGEX.sub("\n\n", "\n".join(lines)).strip()
+
+def _line_key(line: str) -> str:
+    """重複判定用の行のキー（幅・空白の違いは同じ行とみなす）"""
+    return _SPACES_REGEX.sub(" ", normalize_width(line)).strip()
+
+def _is_candidate(key: str) -> bool:
+    """定型文の候補になる行か"""
+    return MIN_BOILERPLATE_LINE_CHARS <= len(key) <= MAX_BOILERPLATE_LINE_CHARS and bool(_LETTER_REGEX.search(key))
+
+def is_page_number(line: str, at_page_edge: bool = False) -> bool:
+    """
+    ページ番号だけの行か
+
+    Args:
+        at_page_edge: ページの先頭・末尾の行か（数字・分数・符号付きの数だけの行は
+            ページの端にある場合のみページ番号とみなす）
+    """
+    key = _line_key(line)
+    if _PAGE_LABEL_REGEX.match(key):
+        return True
+    return at_page_edge and bool(_PAGE_NUMBER_REGEX.match(key))
+
+def _document_pages(item) -> list:
+    """資料のページごとのテキスト（ページストアにない資料は全体を1ページとして扱う）"""
+    if item.get("hash"):
+        pages = [text for _, text in page_store.get_pages(item["hash"])]
+        if pages:
+            return pages
+    return [item["content"]]
+
+def detect_boilerplate(text_data_list) -> set:
+    """
+    ページ・資料をまたいで繰り返される行（ヘッダー・フッター・講義名・著作権表示等）を検出
+
+    - 1つの資料のページの半分以上に出現する行
+    - 全資料の全ページの半分以上に出現する行
+
+    Returns:
+        定型文の行のキーの集合
+    """
+    doc_page_counts = []  # [(ページ数, {行キー: 出現ページ数})]
+    corpus_counts = Counter()
+    total_pages = 0
+    for item in text_data_list:
+        pages = _document_pages(item)
+        counts = Counter()
+        for page in pages:
+            keys = {_line_key(line) for line in page.splitlines()}
+            counts.update(key for key in keys if _is_candidate(key))
+        doc_page_counts.append((len(pages), counts))
+        corpus_counts.update(counts)
+        total_pages += len(pages)
+
+    boilerplate = set()
+    for page_count, counts in doc_page_counts:
+        if page_count < MIN_PAGES_FOR_DETECTION:
+            continue
+        threshold = max(2, page_count * BOILERPLATE_PAGE_RATIO)
+        boilerplate.update(key for key, count in counts.items() if count >= threshold)
+
+    if total_pages >= MIN_PAGES_FOR_DETECTION:
+        threshold = max(2, total_pages * BOILERPLATE_PAGE_RATIO)
+        boilerplate.update(key for key, count in corpus_counts.items() if count >= threshold)
+
+    # 定型文は全資料から除く（ページの少ない資料や1ページだけのTXTに出てきても定型文）
+    return boilerplate
+
+def _clean_lines(lines, boilerplate, edge_indexes=frozenset()) -> list:
+    kept = []
+    for index, line in enumerate(lines):
+        key = _line_key(line)
+        if key and (key in boilerplate or is_page_number(key, index in edge_indexes)):
+            continue
+        kept.append(normalize_width(line))
+    return kept
+
+def clean_page(page: str, boilerplate=frozenset()) -> str:
+    """
+    1ページ分のテキストから定型文とページ番号（ページの先頭・末尾の数字だけの行も含む）を除く
+    """
+    lines = page.splitlines()
+    non_empty = [index for index, line in enumerate(lines) if line.strip()]
+    edge_indexes = set(non_empty[:PAGE_EDGE_LINES] + non_empty[-PAGE_EDGE_LINES:])
+    return "\n".join(_clean_lines(lines, boilerplate, edge_indexes))
+
+def clean_text(text: str, boilerplate=frozenset()) -> str:
+    """
+    定型文・ページ番号の行を除き、全角文字と空白を正規化
+
+    Args:
+        text: 資料のテキスト
+        boilerplate: detect_boilerplate で検出した行のキーの集合
+    """
+    return normalize_whitespace("\n".join(_clean_lines(text.splitlines(), boilerplate)))
+
+def _clean_document(item, boilerplate):
+    """
+    資料1つ分を整形（ページストアにページがあればページ単位で処理し、ページ番号も除く）
+
+    Returns:
+        (整形したテキスト, [(ページ番号, テキスト内の開始位置), ...]) のタプル
+        ページが不明な部分のページ番号は None
+    """
+    content = item["content"]
+    pages = page_store.get_pages(item["hash"]) if item.get("hash") else []
+    paged_text = "".join(text + "\n" for _, text in pages)
+    if pages and content.startswith(paged_text):
+        # 全体のテキストはページを連結したもの（末尾に注記が付く場合がある）
+        units = [(page_no, normalize_whitespace(clean_page(text, boilerplate))) for page_no, text in pages]
+        units.append((None, clean_text(content[len(paged_text):], boilerplate)))
+    else:
+        units = [(None, clean_text(content, boilerplate))]
+
+    parts = []
+    page_offsets = []
+    position = 0
+    for page_no, text in units:
+        if not text:
+            continue
+        if parts:
+            position += 2  # ページの区切りの空行
+        page_offsets.append((page_no, position))
+        parts.append(text)
+        position += len(text)
+    return "\n\n".join(parts), page_offsets
+
+def is_cleaned(item) -> bool:
+    """clean_documents で整形済みの資料か"""
+    return "cleaning" in item
+
+def iter_pages(item):
+    """
+    整形済みの資料をページごとに分ける
+
+    Yields:
+        (ページ番号, ページのテキスト) のタプル（ページが不明な部分のページ番号は None）
+    """
+    content = item["content"]
+    offsets = item["cleaning"]["page_offsets"]
+    for index, (page_no, start) in enumerate(offsets):
+        end = offsets[index + 1][1] - 2 if index + 1 < len(offsets) else len(content)
+        yield page_no, content[start:end]
+
+def clean_documents(text_data_list):
+    """
+    プロンプトを作る前に、全資料から定型文を除いて正規化
+
+    カテゴリの読み込み時に1回だけ呼び、結果を要約・検索インデックスの作成に渡す。
+    整形済みの資料（戻り値の資料）だけのリストを渡した場合は整形し直さずにそのまま返す。
+
+    Args:
+        text_data_list: {"content", "source", ("hash")} の辞書のリスト
+
+    Returns:
+        (定型文を除いた資料のリスト, 統計の辞書) のタプル
+        資料には "cleaning"（ページの位置と整形前後の文字数・トークン数）を追加する
+        統計: documents / boilerplate_lines / chars_before / chars_after /
+              tokens_before / tokens_after / tokens_saved / saved_ratio
+    """
+    if text_data_list and all(is_cleaned(item) for item in text_data_list):
+        return list(text_data_list), _cleaning_stats(text_data_list)
+
+    raw = [item for item in text_data_list if not is_cleaned(item)]
+    boilerplate = detect_boilerplate(raw)
+    cleaned = []
+    for item in text_data_list:
+        if is_cleaned(item):
+            cleaned.append(item)
+            continue
+        content, page_offsets = _clean_document(item, boilerplate)
+        cleaned.append(dict(item, content=content, cleaning={
+            "page_offsets": page_offsets,
+            "chars_before": len(item["content"]),
+            "tokens_before": token_budget.estimate_tokens(item["content"]),
+            "tokens_after": token_budget.estimate_tokens(content),
+            "boilerplate_lines": len(boilerplate),
+        }))
+    return cleaned, _cleaning_stats(cleaned)
+
+def _cleaning_stats(cleaned) -> dict:
+    chars_before = sum(item["cleaning"]["chars_before"] for item in cleaned)
+    tokens_before = sum(item["cleaning"]["tokens_before"] for item in cleaned)
+    tokens_after = sum(item["cleaning"]["tokens_after"] for item in cleaned)
+    tokens_saved = max(0, tokens_before - tokens_after)
+    return {
+        "documents": len(cleaned),
+        "boilerplate_lines": max((item["cleaning"]["boilerplate_lines"] for item in cleaned), default=0),
+        "chars_before": chars_before,
+        "chars_after": sum(len(item["content"]) for item in cleaned),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_saved,
+        "saved_ratio": tokens_saved / tokens_before if tokens_before else 0.0,
+    }
+
+def format_stats(stats: dict) -> str:
+    """統計をログ・画面表示用の1行にする"""
+    return (
+        f"🧹 定型文除去: {stats['boilerplate_lines']}種類の繰り返し行を除去 "
+        f"（約{stats['tokens_saved']:,}トークン削減, {stats['saved_ratio']:.0%}）"
+    )
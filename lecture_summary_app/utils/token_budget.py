@@ -0,0 +1,168 @@
+import re
+
+# モデルごとのコンテキストウィンドウ（入力 + 出力のトークン数）
+MODEL_CONTEXT_WINDOWS = {
+    "gemini-2.0-flash": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+    "gemini-1.5-flash": 1_048_576,
+    "gpt-3.5-turbo": 16_385,
+    "gpt-4o": 128_000,
+    "gpt-4-turbo": 128_000,
+    "local": 128_000,
+}
+
+# モデルごとの最大出力トークン数（入力に使える量はウィンドウからこれを引いた残り）
+MODEL_MAX_OUTPUT_TOKENS = {
+    "gemini-2.0-flash": 8_192,
+    "gemini-1.5-pro": 8_192,
+    "gemini-1.5-flash": 8_192,
+    "gpt-3.5-turbo": 4_096,
+    "gpt-4o": 16_384,
+    "gpt-4-turbo": 4_096,
+    "local": 4_096,
+}
+
+# 一覧にないモデルは小さめのウィンドウとみなす（溢れて失敗するより分割する方が安全）
+DEFAULT_CONTEXT_WINDOW = 16_385
+DEFAULT_MAX_OUTPUT_TOKENS = 4_096
+
+# 1回の呼び出しで使う入力トークンの上限（ウィンドウが大きくても応答時間が延びるため抑える）
+MAX_INPUT_TOKENS_PER_CALL = 100_000
+
+# トークン数の推定値（GPT系・Gemini系のトークナイザで日本語/英語の講義資料を計測した概算）
+CJK_TOKENS_PER_CHAR = 1.0      # 漢字・かな・全角文字は1文字あたり約1トークン
+LATIN_CHARS_PER_TOKEN = 4.0    # 英単語・数字は約4文字で1トークン
+SYMBOL_TOKENS_PER_CHAR = 0.5   # 記号（LaTeXの \ { } 等）は2文字で約1トークン
+ESTIMATE_SAFETY_MARGIN = 1.1   # 推定の誤差を見込んで1割多めに見積もる
+
+# 処理時間の推定値（1回の呼び出し = 接続 + 入力の処理 + 出力の生成）
+SECONDS_PER_CALL = 3.0
+INPUT_TOKENS_PER_SECOND = 5_000
+OUTPUT_TOKENS_PER_SECOND = 60
+
+_CJK_REGEX = re.compile(r"[　-ヿ㐀-䶿一-鿿豈-﫿＀-￯]")
+_LATIN_REGEX = re.compile(r"[A-Za-z0-9À-ɏ]")
+_SPACE_REGEX = re.compile(r"\s")
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を推定（ネットワーク不要の概算）
+
+    日本語（CJK）と英語（ラテン文字）でトークンあたりの文字数が大きく異なるため、
+    文字種ごとに数えて合計する。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_REGEX.findall(text))
+    latin = len(_LATIN_REGEX.findall(text))
+    spaces = len(_SPACE_REGEX.findall(text))
+    symbols = max(0, len(text) - cjk - latin - spaces)
+    tokens = cjk * CJK_TOKENS_PER_CHAR + latin / LATIN_CHARS_PER_TOKEN + symbols * SYMBOL_TOKENS_PER_CHAR
+    return int(tokens * ESTIMATE_SAFETY_MARGIN) + 1
+
+def _lookup(table: dict, model: str, default: int) -> int:
+    """モデル名の前方一致で表を引く（"models/" 接頭辞や "-exp" 等の接尾辞を許容）"""
+    name = (model or "").split("/")[-1]
+    matches = [key for key in table if name.startswith(key)]
+    return table[max(matches, key=len)] if matches else default
+
+def context_window(model: str) -> int:
+    """モデルのコンテキストウィンドウ（トークン数）"""
+    return _lookup(MODEL_CONTEXT_WINDOWS, model, DEFAULT_CONTEXT_WINDOW)
+
+def max_output_tokens(model: str) -> int:
+    """モデルの最大出力トークン数"""
+    return _lookup(MODEL_MAX_OUTPUT_TOKENS, model, DEFAULT_MAX_OUTPUT_TOKENS)
+
+def input_budget(model: str, prompt_overhead: int = 0) -> int:
+    """
+    1回の呼び出しで資料に使える入力トークン数
+
+    Args:
+        model: モデル名
+        prompt_overhead: 指示文など資料以外のプロンプトのトークン数
+    """
+    budget = min(context_window(model) - max_output_tokens(model), MAX_INPUT_TOKENS_PER_CALL)
+    return max(0, budget - prompt_overhead)
+
+def check_prompt(prompt: str, model: str):
+    """
+    送信前にプロンプトがウィンドウに収まるか確認（溢れる場合は送信せずにエラー）
+
+    Raises:
+        ValueError: 入力がモデルの上限を超える場合
+    """
+    tokens = estimate_tokens(prompt)
+    limit = context_window(model) - max_output_tokens(model)
+    if tokens > limit:
+        raise ValueError(
+            f"❌ 入力が長すぎます（推定 {tokens:,} トークン / {model} の上限 {limit:,} トークン）。"
+            "資料を減らすか、より大きいモデルを選択してください。"
+        )
+
+def split_to_budget(text: str, max_size: int, measure=estimate_tokens) -> list:
+    """
+    テキストを行単位で max_size 以下の部分に分割（部分を連結すると元のテキストに戻る）
+
+    Args:
+        text: 分割するテキスト
+        max_size: 1つの部分の上限（measure で測った大きさ）
+        measure: 大きさの測り方（既定はトークン数の推定、len を渡すと文字数）
+    """
+    if measure(text) <= max_size:
+        return [text] if text else []
+    parts = []
+    current = []
+    current_size = 0
+    for line in text.splitlines(keepends=True):
+        line_size = measure(line)
+        if line_size > max_size:
+            # 1行で上限を超える場合は文字数で切る
+            step = max(1, int(len(line) * max_size / line_size))
+            pieces = [line[i:i + step] for i in range(0, len(line), step)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_size = measure(piece) if len(pieces) > 1 else line_size
+            if current and current_size + piece_size > max_size:
+                parts.append("".join(current))
+                current, current_size = [], 0
+            current.append(piece)
+            current_size += piece_size
+    if current:
+        parts.append("".join(current))
+    return parts
+
+def pack_sources(items, max_tokens: int) -> list:
+    """
+    資料を1回の呼び出しに収まるバッチに詰める（順序は維持、大きい資料は分割）
+
+    Args:
+        items: (ソース名, テキスト) のリスト
+        max_tokens: 1バッチの最大トークン数
+
+    Returns:
+        {"parts": [(ソース名, 部分番号, 部分数, テキスト)], "tokens": int} のリスト
+    """
+    batches = []
+    current = {"parts": [], "tokens": 0}
+    for source, text in items:
+        tokens = estimate_tokens(text)
+        if tokens > max_tokens:
+            parts = split_to_budget(text, max_tokens)
+            pieces = [(part_no, len(parts), part, estimate_tokens(part)) for part_no, part in enumerate(parts, 1)]
+        else:
+            pieces = [(1, 1, text, tokens)]
+        for part_no, part_count, part, piece_tokens in pieces:
+            if current["parts"] and current["tokens"] + piece_tokens > max_tokens:
+                batches.append(current)
+                current = {"parts": [], "tokens": 0}
+            current["parts"].append((source, part_no, part_count, part))
+            current["tokens"] += piece_tokens
+    if current["parts"]:
+        batches.append(current)
+    return batches
+
+def estimate_call_seconds(input_tokens: int, output_tokens: int = 2_000) -> float:
+    """1回の呼び出しの処理時間を推定（秒）"""
+    return SECONDS_PER_CALL + input_tokens / INPUT_TOKENS_PER_SECOND + output_tokens / OUTPUT_TOKENS_PER_SECOND